@@ -1,11 +1,105 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from src.rag.qa_chain import answer
+from src.models import llm_client
+from src.models.embed_cache import get_cache
+from src.models.embedder import embed_model_id
+from src.config import ANSWER_CACHE_ENABLED
+from src.rag.answer_cache import answer_caches
+from src.rag.collections import DEFAULT_COLLECTION, get_collection, list_collections
+from src.rag.filters import SearchFilter
+from src.rag.qa_chain import aanswer, aanswer_many, astream_answer, retrievers
+from src.rag.reranker import get_reranker
+from src.rag.retriever import Retriever
+from src.rag.sessions import Session, get_session_store
+from src.rag import tracing
+from src.rag.tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+
+class Filters(BaseModel):
+    """検索対象の絞り込み。属性内の複数の値は OR、属性同士は AND。"""
+
+    # data/raw/ からの相対パスの前方一致（例: "hr/" で人事の文書だけ）
+    source_prefix: list[str] | str | None = None
+    # 拡張子（"md", "pdf"）
+    doc_types: list[str] | None = None
+    # 元ファイルの更新日時の範囲（両端を含む。タイムゾーンなしはサーバーのローカル時刻）
+    modified_after: datetime | None = None
+    modified_before: datetime | None = None
+    # Markdown の front matter の tags
+    tags: list[str] | None = None
+
+    def to_search_filter(self) -> SearchFilter:
+        prefixes = [self.source_prefix] if isinstance(self.source_prefix, str) else self.source_prefix or []
+        return SearchFilter(
+            source_prefix=tuple(p.replace("\\", "/") for p in prefixes),
+            doc_types=tuple(self.doc_types or ()),
+            modified_after=self.modified_after.timestamp() if self.modified_after else None,
+            modified_before=self.modified_before.timestamp() if self.modified_before else None,
+            tags=tuple(self.tags or ()),
+        )
+
+
+def _search_filter(filters: Filters | None, retriever: Retriever) -> SearchFilter | None:
+    if filters is None:
+        return None
+    search_filter = filters.to_search_filter()
+    if not search_filter.is_empty and retriever.filters is None:
+        # フィルタ用の属性はこの機能の導入後のビルドで作られる
+        raise HTTPException(
+            status_code=400,
+            detail="The index has no filter attributes; rebuild it with python -m src.ingestion.build_index",
+        )
+    return search_filter
+
+
+async def _retriever(collection: str | None) -> tuple[str, Retriever]:
+    """コレクション名と、その公開中のスナップショットの Retriever。
+
+    常駐していなければスレッドで読み込む（読み込み中もイベントループを止めない）。
+    名前が不正なら 400、インデックスがなければ 404。
+    """
+    try:
+        name = get_collection(collection).name
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    retriever = retrievers.get_resident(name)
+    if retriever is None:
+        try:
+            retriever = await asyncio.to_thread(retrievers.get, name)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Collection {name!r} has no index")
+    return name, retriever
+
+
+async def _session(session_id: str | None) -> Session | None:
+    """session_id の会話。省略時は None（会話の履歴を使わない）、ない・失効した場合は 404。"""
+    if session_id is None:
+        return None
+    session = await asyncio.to_thread(get_session_store().get, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id!r} not found or expired")
+    return session
 
 
 class AskRequest(BaseModel):
     query: str
+    filters: Filters | None = None
+    # 検索するコレクション（省略時は default）
+    collection: str | None = None
+    # POST /sessions で作った会話の ID。指定すると追加の質問を直近の会話から単独の質問に書き換えて検索する
+    session_id: str | None = None
+    # true なら段階ごとの所要時間（ミリ秒）を timing に入れて返す
+    timing: bool = False
 
 
 class Source(BaseModel):
@@ -16,15 +110,302 @@ class Source(BaseModel):
 class AskResponse(BaseModel):
     answer: str
     sources: list[Source]
+    # 検索したコレクションと、使ったインデックスのビルドバージョン
+    collection: str
+    index_version: str
+    # 段階ごとの所要時間（ミリ秒。rewrite_ms / embed_ms / cache_ms / search_ms / assemble_ms / llm_ms / total_ms）
+    timing: dict[str, float] | None = None
+    # session_id を指定した場合、その ID と、検索に使った単独の質問
+    session_id: str | None = None
+    standalone_query: str | None = None
 
 
-app = FastAPI(title="docqa-portal API")
+class AskBatchRequest(BaseModel):
+    queries: list[str]
+    # 全ての質問に共通の絞り込み
+    filters: Filters | None = None
+    collection: str | None = None
+    # true ならバッチ全体の段階ごとの所要時間を timing に入れて返す
+    timing: bool = False
+
+
+class AskBatchItem(BaseModel):
+    answer: str | None = None
+    sources: list[Source] = []
+    error: str | None = None
+
+
+class AskBatchResponse(BaseModel):
+    results: list[AskBatchItem]
+    collection: str
+    index_version: str
+    timing: dict[str, float] | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # COLLECTION_PREWARM のコレクションを先に読み込み、それ以外は最初の質問で読み込む
+    await asyncio.to_thread(retrievers.prewarm)
+    # 再ビルドで current ポインタが切り替わったら、再起動せずに新しいスナップショットへ差し替える
+    retrievers.start()
+    # 最初の質問でモデルの読み込みを待たないよう、再ランキングのモデルを先に読み込んでおく
+    reranker = get_reranker()
+    if reranker is not None:
+        reranker.warmup()
+    yield
+    retrievers.stop()
+    # 共有のコネクションプールを閉じる
+    await llm_client.aclose()
+
+
+app = FastAPI(title="docqa-portal API", lifespan=lifespan)
 
 
 @app.post("/ask", response_model=AskResponse)
 async def ask(req: AskRequest) -> AskResponse:
-    ans, docs = answer(req.query)
+    # リクエストの途中でインデックスが差し替わっても、最初に取得したスナップショットで最後まで処理する
+    collection, retriever = await _retriever(req.collection)
+    search_filter = _search_filter(req.filters, retriever)
+    session = await _session(req.session_id)
+    trace = Trace("ask")
+    try:
+        ans, docs = await aanswer(
+            req.query,
+            retriever=retriever,
+            search_filter=search_filter,
+            trace=trace,
+            collection=collection,
+            session=session,
+        )
+    except TimeoutError as e:
+        # LLM・埋め込みの呼び出しが期限（LLM_DEADLINE など）内に終わらなかった
+        trace.finish(error=str(e))
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        trace.finish(error=repr(e))
+        raise
     return AskResponse(
         answer=ans,
         sources=[Source(**d) for d in docs],
-    )
\ No newline at end of file
+        collection=collection,
+        index_version=retriever.version,
+        timing=trace.timing_ms() if req.timing else None,
+        session_id=session.id if session else None,
+        standalone_query=session.turns[-1]["standalone_query"] if session else None,
+    )
+
+
+@app.post("/ask/batch", response_model=AskBatchResponse)
+async def ask_batch(req: AskBatchRequest) -> AskBatchResponse:
+    """複数の質問にまとめて回答する。結果は queries と同じ順序で、失敗した項目は error が入る。"""
+    collection, retriever = await _retriever(req.collection)
+    search_filter = _search_filter(req.filters, retriever)
+    trace = Trace("batch")
+    try:
+        results = await aanswer_many(
+            req.queries, retriever=retriever, search_filter=search_filter, trace=trace, collection=collection
+        )
+    except ValueError as e:
+        trace.finish(error=str(e))
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        trace.finish(error=repr(e))
+        raise
+    return AskBatchResponse(
+        results=[AskBatchItem(**r) for r in results],
+        collection=collection,
+        index_version=retriever.version,
+        timing=trace.timing_ms() if req.timing else None,
+    )
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest) -> StreamingResponse:
+    """回答を Server-Sent Events で返す。
+
+    イベントは sources（参照ドキュメント）→ token（回答の差分、複数回）→ done（usage と所要時間、
+    コレクションとインデックスのバージョン、session_id を指定した場合は検索に使った単独の質問）の順。
+    途中で失敗した場合は error イベントを送って終了する。
+    """
+    collection, retriever = await _retriever(req.collection)
+    search_filter = _search_filter(req.filters, retriever)
+    session = await _session(req.session_id)
+    trace = Trace("stream")
+
+    async def events():
+        try:
+            async for ev in astream_answer(
+                req.query,
+                retriever=retriever,
+                search_filter=search_filter,
+                trace=trace,
+                collection=collection,
+                session=session,
+            ):
+                if ev["type"] == "sources":
+                    yield _sse("sources", [Source(**d).model_dump() for d in ev["sources"]])
+                elif ev["type"] == "token":
+                    yield _sse("token", {"delta": ev["delta"]})
+                else:
+                    yield _sse(
+                        "done",
+                        {
+                            "usage": ev["usage"],
+                            "timing": ev["timing"],
+                            "cached": ev["cached"],
+                            "collection": collection,
+                            "index_version": retriever.version,
+                            "session_id": session.id if session else None,
+                            "standalone_query": session.turns[-1]["standalone_query"] if session else None,
+                        },
+                    )
+        except Exception as e:
+            logger.exception("Streaming answer failed")
+            trace.finish(error=repr(e))
+            yield _sse("error", {"message": str(e)})
+        finally:
+            # クライアントが切断すると CancelledError / GeneratorExit で中断される（except Exception では捕まらない）。
+            # 途中で諦められた遅いストリームもメトリクスとスローログに残す（finish の2回目以降は何もしない）
+            if not trace.finished:
+                trace.finish(error="client disconnected")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # プロキシによるバッファリングを無効化して逐次届くようにする
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/sessions")
+async def create_session() -> dict:
+    """会話を始める。返った session_id を /ask・/ask/stream に渡すと、追加の質問を会話の続きとして扱う。"""
+    session = await asyncio.to_thread(get_session_store().create)
+    return {"session_id": session.id}
+
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str) -> dict:
+    """会話の直近のターン（質問・検索に使った単独の質問・回答）。ない・失効した場合は 404。"""
+    session = await _session(session_id)
+    return {"session_id": session.id, "created": session.created, "updated": session.updated, "turns": session.turns}
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str) -> dict:
+    if not await asyncio.to_thread(get_session_store().delete, session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id!r} not found or expired")
+    return {"deleted": session_id}
+
+
+@app.get("/health")
+async def health() -> dict:
+    """default コレクションの公開中のインデックスのバージョンとホットリロードの状態、常駐中のコレクション。"""
+    stats = retrievers.stats()
+    default = stats["resident"].get(DEFAULT_COLLECTION, {})
+    return {
+        "status": "ok",
+        "index_version": default.get("index_version"),
+        "snapshot": default.get("snapshot"),
+        "chunks": default.get("chunks"),
+        "loaded_at": default.get("loaded_at"),
+        "reloads": default.get("reloads"),
+        "last_reload_error": default.get("last_reload_error"),
+        "collections": list(stats["resident"]),
+    }
+
+
+@app.get("/collections")
+async def collections() -> dict:
+    """インデックスのあるコレクションと、常駐中のコレクションのバージョン・メモリ使用量・LRU の統計。"""
+    available = await asyncio.to_thread(list_collections)
+    return {"available": available, **retrievers.stats()}
+
+
+@app.get("/cache/stats")
+async def cache_stats() -> dict:
+    """コレクションごとの回答キャッシュと、埋め込みキャッシュ・会話セッションのヒット率など。無効化されているものは null。"""
+    def io_stats() -> dict:
+        # 最初の get_cache は SQLite を開き、SQLite のセッションストアは件数を数えるので、イベントループの外で行う
+        embed_cache = get_cache(embed_model_id())
+        return {
+            "embedding": embed_cache.stats() if embed_cache else None,
+            "sessions": get_session_store().stats(),
+        }
+
+    return {
+        "answer": {name: cache.stats() for name, cache in answer_caches().items()} if ANSWER_CACHE_ENABLED else None,
+        **await asyncio.to_thread(io_stats),
+    }
+
+
+@app.get("/llm/stats")
+async def llm_stats() -> dict:
+    """chat / embeddings の上流ごとの呼び出し統計（キュー待ちと上流の所要時間、リトライ・429・合流の件数）。"""
+    return llm_client.stats()
+
+
+@app.get("/rerank/stats")
+async def rerank_stats() -> dict | None:
+    """再ランキングの呼び出し統計（予算切れ・失敗で1段目の順位に戻した件数、キャッシュヒット、所要時間）。無効なら null。"""
+    reranker = get_reranker()
+    return reranker.stats() if reranker else None
+
+
+def _stats_metrics() -> str:
+    """キャッシュ・上流 API・コレクション・会話セッション・再ランキングの既存の統計を Prometheus のカウンタにする。
+
+    埋め込みキャッシュ・SQLite のセッションストアを参照するため、イベントループの外（スレッド）で呼ぶこと。
+    """
+    caches = {(("cache", "answer"), ("collection", name)): cache for name, cache in answer_caches().items()}
+    embed_cache = get_cache(embed_model_id())
+    if embed_cache is not None:
+        caches[(("cache", "embedding"),)] = embed_cache
+    cache_samples = {
+        labels + (("result", result),): cache.stats()[key]
+        for labels, cache in caches.items()
+        for result, key in (("hit", "hits"), ("miss", "misses"))
+    }
+    upstream_samples = {
+        (("upstream", name), ("event", event)): upstream[event]
+        for name, upstream in llm_client.stats().items()
+        for event in ("requests", "coalesced", "retries", "rate_limited", "errors", "deadline_exceeded")
+    }
+    collection_stats = retrievers.stats()
+    collection_samples = {
+        (("event", event),): collection_stats[event] for event in ("loads", "evictions", "hits", "misses")
+    }
+    session_stats = get_session_store().stats()
+    session_samples = {
+        (("event", event),): session_stats[event] for event in ("created", "hits", "misses", "expired", "evicted")
+    }
+    text = tracing.format_counter(
+        "docqa_cache_requests_total", "Answer and embedding cache lookups, by result.", cache_samples
+    ) + tracing.format_counter(
+        "docqa_llm_upstream_events_total", "Calls to the chat and embeddings upstreams, by event.", upstream_samples
+    ) + tracing.format_counter(
+        "docqa_collection_events_total", "Collection lookups and lazy loads/evictions, by event.", collection_samples
+    ) + tracing.format_counter(
+        "docqa_session_events_total", "Conversation session lookups, creations and removals, by event.", session_samples
+    )
+    reranker = get_reranker()
+    if reranker is not None:
+        rerank = reranker.stats()
+        text += tracing.format_counter(
+            "docqa_rerank_total",
+            "Reranking calls, by outcome.",
+            {(("outcome", key),): rerank[key] for key in ("requests", "fallbacks", "errors")},
+        )
+    return text
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """Prometheus 形式のメトリクス（段階ごとの所要時間・トークン数のヒストグラムと、キャッシュ・上流のカウンタ）。"""
+    # スクレイプのたびに SQLite を読むため、処理中のストリームを止めないようスレッドで実行する
+    stats = await asyncio.to_thread(_stats_metrics)
+    return PlainTextResponse(tracing.render() + stats, media_type="text/plain; version=0.0.4; charset=utf-8")
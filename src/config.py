@@ -5,13 +5,186 @@ from dotenv import load_dotenv
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-EMBED_MODEL = "text-embedding-3-small"
+# モックサーバー等に向ける場合に指定（未指定ならOpenAI本番API）
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+# 埋め込みモデル。"local:<sentence-transformers のモデル名またはパス>" でローカル CPU 推論になる
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 LLM_MODEL = "gpt-4.1-mini"
 
+# API サーバーから OpenAI への接続設定（embed / chat で HTTP コネクションプールを共有する）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "512"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "128"))
+# 上流ごとの同時リクエスト数の上限とタイムアウト（秒）
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "128"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "10"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "256"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# 上流ごとのレート制限（1分あたりのリクエスト数・トークン数。0 なら制限しない）
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+EMBED_RPM = float(os.getenv("EMBED_RPM", "0"))
+EMBED_TPM = float(os.getenv("EMBED_TPM", "0"))
+# chat の TPM 予約に使う出力トークン数の見込み（応答の usage で実数に補正する）
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "512"))
+# chat のリトライ回数（429・5xx・タイムアウト）と、キュー待ち・リトライを含めた1回の呼び出しの期限（秒）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "120"))
+# FAISS 検索を実行するスレッド数（検索中は GIL が解放される）
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", "4"))
+# /ask/batch・answer_many: 1回に受け付ける質問数の上限と、1バッチ内で同時に投げる chat リクエスト数
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "1000"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "16"))
+# プロンプトに入れるコンテキストのトークン数の上限（LLM_MODEL のトークナイザで数える）
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+# 既に入れた区間に文字 n-gram がこの割合以上含まれる区間は重複として除く
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.9"))
+# 上限に収まらない区間を途中で切って入れる場合の最小トークン数（これ未満なら入れない）
+CONTEXT_MIN_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MIN_PASSAGE_TOKENS", "64"))
+
+# Embedding バッチ設定
+# 1リクエストに詰めるトークン数・件数の上限（APIの上限は 300k tokens / 2048件）
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "100000"))
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "256"))
+# 同時に投げるリクエスト数
+EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", "4"))
+# レート制限・一時エラー時のリトライ回数
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+# ingestion のバッチリクエスト1回あたりのタイムアウト（秒）
+EMBED_BATCH_TIMEOUT = float(os.getenv("EMBED_BATCH_TIMEOUT", "120"))
+
+# ローカル埋め込み（EMBED_MODEL=local:...）: 推論スレッド数・バッチサイズ・量子化（"" / "int8"）と、
+# クエリを1バッチにまとめるために待つ最大時間（ミリ秒）
+EMBED_LOCAL_THREADS = int(os.getenv("EMBED_LOCAL_THREADS", str(os.cpu_count() or 1)))
+EMBED_LOCAL_BATCH_SIZE = int(os.getenv("EMBED_LOCAL_BATCH_SIZE", "32"))
+EMBED_LOCAL_QUANTIZE = os.getenv("EMBED_LOCAL_QUANTIZE", "")
+EMBED_LOCAL_MAX_WAIT_MS = float(os.getenv("EMBED_LOCAL_MAX_WAIT_MS", "5"))
+
+# ドキュメント読み込み: PDF 抽出のプロセス数と1ファイルあたりのタイムアウト（秒）
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", str(os.cpu_count() or 1)))
+LOAD_TIMEOUT = float(os.getenv("LOAD_TIMEOUT", "120"))
+# ingestion パイプライン: 埋め込みに回すチャンク数の単位と、処理待ちにできるバッチ数
+INGEST_BATCH_CHUNKS = int(os.getenv("INGEST_BATCH_CHUNKS", "2048"))
+INGEST_MAX_PENDING_BATCHES = int(os.getenv("INGEST_MAX_PENDING_BATCHES", "2"))
+# チャンク分割: structured（見出し・文境界に沿ってトークン数でまとめる）/ simple（800文字固定）
+CHUNKER = os.getenv("CHUNKER", "structured")
+# structured のトークン数の上限・前のチャンクとの重なり・見出しで区切る最小サイズ
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "128"))
+# 取り込み時の重複除去: 文字 n-gram の MinHash で推定した Jaccard 類似度がこの値以上のチャンクは1つだけ残す（0 なら無効）
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+# 重複したチャンクのどれを残すか: newest（ファイルの更新時刻が新しいもの）/ oldest
+DEDUP_KEEP = os.getenv("DEDUP_KEEP", "newest")
+# MinHash の関数の数と、シングル（文字 n-gram）の長さ
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))
+DEDUP_SHINGLE = int(os.getenv("DEDUP_SHINGLE", "5"))
+
+# ベクトルインデックスの種類: flat / ivf_flat / ivf_pq / hnsw（いずれも正規化ベクトルの内積）
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+# IVF のクラスタ数（0 なら件数から自動決定）と検索時に見るクラスタ数
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+# IVF-PQ のサブ量子化器数（埋め込み次元を割り切れる値）
+PQ_M = int(os.getenv("PQ_M", "64"))
+# HNSW のグラフ次数・構築時/検索時の探索幅
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# 学習（IVF のクラスタリング）に使うサンプル数の上限
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "100000"))
+# インデックスに格納するベクトルの圧縮: 空（float32）/ fp16 / int8（次元ごとのスカラー量子化。ivf_pq 以外）
+INDEX_QUANTIZE = os.getenv("INDEX_QUANTIZE", "")
+# インデックスに格納する次元数（0 なら埋め込みの全次元）。text-embedding-3 系は先頭の次元で切り詰めても使える（Matryoshka）
+INDEX_DIM = int(os.getenv("INDEX_DIM", "0"))
+# 圧縮・切り詰めたインデックスでは k * RESCORE_OVERSAMPLE 件を候補に取り、
+# スナップショットの vectors.f32（mmap した float32 の全次元ベクトル）との内積で並べ直す
+RESCORE_OVERSAMPLE = int(os.getenv("RESCORE_OVERSAMPLE", "4"))
+# ベクトルインデックスのシャード数。2 以上ならファイル単位でシャードに振り分け、シャードごとのインデックスファイルを作る。
+# 検索は全シャードを並列に引いて上位k件をマージし、差分ビルドでは変更のあったシャードだけを読み書きする
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+# シャードを並列に検索・構築するスレッド数（0 なら CPU コア数。検索中は GIL が解放される）
+SHARD_THREADS = int(os.getenv("SHARD_THREADS", "0"))
+
+# 検索モード: vector（ベクトルのみ）/ lexical（BM25 のみ）/ hybrid（両者を RRF で統合）
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# hybrid で各検索から取り出す候補数と RRF の定数
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# BM25 のトークナイザ（src/rag/lexical_index.py の TOKENIZERS）とパラメータ
+LEXICAL_TOKENIZER = os.getenv("LEXICAL_TOKENIZER", "cjk_bigram")
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# メタデータフィルタ（ソースのパス・ファイル種類・更新時刻・タグ）付きの検索。
+# 絞り込み後の件数が FILTER_EXACT_MAX 以下なら、IVF は全リストを走査し、HNSW は一致したベクトルだけを総当たりする
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "4096"))
+# それより多い場合に、一致する割合に応じて nprobe / efSearch を広げる最大倍率
+FILTER_MAX_EXPANSION = float(os.getenv("FILTER_MAX_EXPANSION", "16"))
+# フィルタごとの一致行（ビットマップ）のキャッシュ件数
+FILTER_CACHE_SIZE = int(os.getenv("FILTER_CACHE_SIZE", "64"))
+
+# cross-encoder による再ランキング。sentence-transformers の CrossEncoder のモデル名かパス（空なら無効）
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+# 1段目の検索で取る候補数と、再ランキング後に LLM に渡す件数
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "3"))
+# 1リクエストの再ランキングに使える時間（ミリ秒）。超えたら1段目の順位をそのまま使う
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "300"))
+# 推論のバッチサイズ・最大トークン長・スレッド数（torch のスレッド数はプロセス共通）・量子化（"" / "int8"）
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", str(os.cpu_count() or 1)))
+RERANK_QUANTIZE = os.getenv("RERANK_QUANTIZE", "")
+# (質問, チャンク) ごとのスコアのキャッシュ件数
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "100000"))
+
+# 全体の所要時間がこの値（ミリ秒）以上のリクエストは、段階ごとの内訳をログに出す（0 なら出さない）
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "5000"))
+
 # Paths
 BASE_DIR = Path(__file__).parent.parent
 DATA_DIR = BASE_DIR / "data"
-RAW_DATA_DIR = DATA_DIR / "raw"
-VECTORSTORE_DIR = DATA_DIR / "vectorstore"
-FAISS_INDEX_PATH = str(VECTORSTORE_DIR / "index.faiss")
-FAISS_META_PATH = str(VECTORSTORE_DIR / "metadata.json")
+RAW_DATA_DIR = Path(os.getenv("RAW_DATA_DIR", DATA_DIR / "raw"))
+VECTORSTORE_DIR = Path(os.getenv("VECTORSTORE_DIR", DATA_DIR / "vectorstore"))
+# 名前付きコレクション（部署ごとのインデックスなど）。<COLLECTIONS_DIR>/<名前>/raw/ に文書を置き、
+# <COLLECTIONS_DIR>/<名前>/vectorstore/ にインデックスを作る。名前なし（default）は RAW_DATA_DIR / VECTORSTORE_DIR
+COLLECTIONS_DIR = Path(os.getenv("COLLECTIONS_DIR", DATA_DIR / "collections"))
+# ベクトルストアの中では、ビルドごとのスナップショットを snapshots/<version>/ に
+# （index.faiss・index_params.json・chunks/・lexical/・filters/・manifest.json）、
+# 公開中のスナップショット名を current に置く（ビルドの最後にアトミックに書き換える）
+# 残しておく古いスナップショットの数（公開中のものは除く）
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))
+# API が current ポインタを確認する間隔（秒）。0 でホットリロードしない
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "5"))
+# API の1ワーカーに常駐させるコレクションのメモリ予算（MB。FAISS インデックスの大きさで数える。
+# チャンクストア・BM25 などは mmap なので含めない）。超えたら最後に使われたのが古いコレクションから解放する
+COLLECTION_MEMORY_MB = float(os.getenv("COLLECTION_MEMORY_MB", "4096"))
+# API の起動時に読み込み、予算を超えても解放しないコレクション（カンマ区切り）
+COLLECTION_PREWARM = [c.strip() for c in os.getenv("COLLECTION_PREWARM", "default").split(",") if c.strip()]
+
+# Embedding キャッシュ（ingestion とクエリで共有する SQLite）
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+EMBED_CACHE_PATH = str(DATA_DIR / "cache" / "embeddings.sqlite3")
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "2048"))
+
+# 回答のセマンティックキャッシュ（クエリ埋め込みのコサイン類似度が閾値以上なら前回の回答を返す）
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# 有効期限（秒）と保持件数の上限（超えたら最終利用の古いものから削除）
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+
+# 会話セッション（/ask の session_id）。追加の質問は直近の会話から単独の質問に書き換えてから検索する。
+# 保存先: memory（ワーカーのプロセス内）/ sqlite（SESSION_DB_PATH。複数ワーカー・再起動後も共有）
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", str(DATA_DIR / "cache" / "sessions.sqlite3"))
+# 最後の質問からの有効期限（秒）と保持するセッション数の上限（超えたら最終利用の古いものから削除）
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+# 書き換えで LLM に渡す直近のターン数と、各ターンの回答の先頭の文字数
+SESSION_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", "4"))
+SESSION_HISTORY_ANSWER_CHARS = int(os.getenv("SESSION_HISTORY_ANSWER_CHARS", "300"))
+# セッションごとに保持するターン・書き換え結果・検索結果の件数
+SESSION_CACHE_ENTRIES = int(os.getenv("SESSION_CACHE_ENTRIES", "16"))
+# 書き換えた質問の埋め込みと、同じセッションの過去の検索の質問のコサイン類似度がこの値以上なら検索結果を再利用する
+SESSION_REUSE_THRESHOLD = float(os.getenv("SESSION_REUSE_THRESHOLD", "0.95"))
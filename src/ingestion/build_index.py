@@ -1,8 +1,10 @@
-import json
-import os
+import argparse
+import shutil
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional, Set, Tuple
 import logging
 
 # プロジェクトルートをパスに追加（VS Codeから直接実行する場合のため）
@@ -11,16 +13,49 @@ if str(project_root) not in sys.path:
     sys.path.insert(0, str(project_root))
 
 import numpy as np
-try:
-    import faiss
-except ImportError:
-    # faiss-cpu の場合
-    from faiss import swigfaiss as faiss
 
-from src.config import VECTORSTORE_DIR, FAISS_INDEX_PATH, FAISS_META_PATH, RAW_DATA_DIR
-from src.ingestion.load_docs import load_all_docs
-from src.ingestion.split_docs import simple_split
-from src.models.embedder import get_embedding
+from src.config import (
+    INDEX_SHARDS,
+    INGEST_BATCH_CHUNKS,
+    INGEST_MAX_PENDING_BATCHES,
+    LEXICAL_TOKENIZER,
+)
+from src.ingestion.dedup import (
+    SIGNATURES_NAME,
+    DedupPlan,
+    MinHasher,
+    SignedFiles,
+    dedup_spec,
+    filter_chunks,
+    open_signatures,
+    plan_dedup,
+    sign_files,
+    write_report,
+)
+from src.ingestion.load_docs import iter_docs, list_doc_files, read_tags
+from src.ingestion.manifest import diff_files, load_manifest, new_manifest, new_version, save_manifest
+from src.ingestion.split_docs import chunker_spec, split_document
+from src.models.embedder import EmbeddingStats, embed_model_id, get_embeddings
+from src.rag.chunk_store import ChunkStore, ChunkStoreWriter
+from src.rag.collections import get_collection
+from src.rag.filters import write_filter_index
+from src.rag.full_vectors import FULL_VECTORS_NAME, FullVectorWriter, open_full_vectors
+from src.rag.index_factory import (
+    create_index,
+    faiss,
+    index_spec,
+    load_params,
+    needs_rescore,
+    needs_training,
+    prepare_vectors,
+    remove_ids,
+    resolve_params,
+    save_params,
+)
+from src.rag.index_io import read_index
+from src.rag.lexical_index import LexicalIndex, LexicalIndexWriter
+from src.rag.shards import n_shards, shard_file, shard_of, shard_pool, write_shards
+from src.rag.snapshots import current_snapshot, prune_snapshots, publish_snapshot, remove_legacy_files, snapshot_dir
 
 # ロギング設定
 logging.basicConfig(
@@ -34,88 +69,484 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("openai").setLevel(logging.WARNING)
 
 
-def build_index() -> None:
-    logger.info("Starting index build process...")
-    
-    # ドキュメント読み込み（エラーハンドリング付き）
+def _load_lexical(base_dir: Path, store: ChunkStore) -> Optional[LexicalIndex]:
+    """前回ビルドの BM25 インデックスを読み込む。ない・合わない場合は None（チャンクストアから作り直す）。"""
     try:
-        logger.info(f"Loading documents from {RAW_DATA_DIR}")
-        docs = load_all_docs(str(RAW_DATA_DIR))
-        logger.info(f"Successfully loaded {len(docs)} documents")
-    except FileNotFoundError:
-        logger.error(f"Directory not found: {RAW_DATA_DIR}")
-        logger.error("Please create data/raw/ directory and add documents")
-        raise
+        lexical = LexicalIndex(base_dir / "lexical")
+    except Exception as e:
+        logger.info(f"No usable lexical index ({e}); it will be rebuilt from the chunk store")
+        return None
+    if len(lexical) != len(store) or lexical.header.get("tokenizer") != LEXICAL_TOKENIZER:
+        logger.info("Lexical index does not match the chunk store or settings; it will be rebuilt")
+        return None
+    return lexical
+
+
+def _load_existing(
+    base_dir: Path, manifest: Dict, touched: Set[int]
+) -> Optional[Tuple[List[Optional[object]], Dict, ChunkStore, Optional[np.ndarray]]]:
+    """前回ビルド（base_dir のスナップショット）のシャードごとのインデックスとチャンクストア、
+    再スコアリング用の全精度ベクトル（圧縮・切り詰めたインデックスの場合のみ。それ以外は None）を読み込む。
+
+    インデックスは touched のシャード（追加・変更・削除されたファイルのあるシャード）だけを読み込み、
+    それ以外は None にする（新しいスナップショットには前回のファイルをそのままリンクする）。
+    マニフェストと件数が一致しない（前回ビルドが途中で失敗した等）場合や、
+    インデックスの種類・パラメータ・シャード数の設定が変わった場合は None を返し、全件再構築させる。
+    """
+    try:
+        params = load_params(base_dir)
+        store = ChunkStore(base_dir / "chunks")
+    except Exception as e:
+        logger.warning(f"Could not load existing index: {e}")
+        return None
+
+    if params.get("spec") != index_spec():
+        logger.info(f"Index configuration changed ({params.get('spec')} -> {index_spec()})")
+        return None
+    count = n_shards(params)
+    expected = [0] * count
+    for key, entry in manifest["files"].items():
+        expected[shard_of(key, count)] += len(entry["chunk_ids"])
+    if len(store) != sum(expected):
+        return None
+    vectors = open_full_vectors(base_dir, params)
+    if params.get("rescore") and (vectors is None or len(vectors) != len(store)):
+        return None
+    try:
+        shards = [read_index(base_dir, shard_file(s, count)) if s in touched else None for s in range(count)]
     except Exception as e:
-        logger.error(f"Failed to load documents: {e}")
+        logger.warning(f"Could not load existing index: {e}")
+        return None
+    for shard, n in zip(shards, expected):
+        if shard is not None and (not hasattr(shard, "id_map") or shard.ntotal != n):
+            return None
+    return shards, params, store, vectors
+
+
+def _reprocess_dedup_losers(manifest: Dict, diff, displaced: Set[str] = frozenset()) -> int:
+    """重複除去で残した側のファイルがなくなった・変わった場合、除かれた側のファイルを変更扱いにして取り込み直す。
+
+    除いたチャンクはインデックスにないため、残した側が削除・変更された場合や、残した側のチャンクが
+    さらに新しい重複に置き換えられる（displaced）場合は、元のファイルから分割し直して判定し直す必要がある。
+    変更扱いにしたファイル数を返す。
+    """
+    removed = set(diff.deleted + diff.changed) | displaced
+    if not removed:
+        return 0
+    losers = [key for key in diff.unchanged if removed & set(manifest["files"][key].get("duplicates", {}))]
+    for key in losers:
+        entry = manifest["files"][key]
+        diff.unchanged.remove(key)
+        diff.changed.append(key)
+        diff.stats.setdefault(key, {k: entry[k] for k in ("sha256", "mtime", "size")})
+    if losers:
+        logger.info(f"Re-ingesting {len(losers)} files whose near-duplicates were kept in changed or deleted files")
+    return len(losers)
+
+
+def _plan_dedup(
+    spec: Dict, manifest: Dict, diff, raw_dir: Path, base_dir: Optional[Path], tmp_dir: Path
+) -> Tuple[Optional[SignedFiles], Optional[DedupPlan]]:
+    """取り込むファイルのシグネチャを計算し、前回ビルドのチャンクと合わせて除くチャンクを決める。
+
+    既存のチャンクが置き換えられると、そのチャンクに重複として除かれていたファイルも取り込み直すので、
+    取り込み直すファイルが増えなくなるまで判定を繰り返す（シグネチャは増えたファイルの分だけ計算する）。
+    前回ビルドのシグネチャがチャンクストアと合わない場合は (None, None) を返し、全件再構築させる。
+    """
+    store, signatures = None, None
+    if manifest["files"] and base_dir is not None:
+        try:
+            store = ChunkStore(base_dir / "chunks")
+        except Exception as e:
+            logger.warning(f"Could not load existing chunk store: {e}")
+            return None, None
+        signatures = open_signatures(base_dir, spec)
+        if signatures is None or len(signatures) != len(store):
+            logger.info("Near-duplicate signatures are missing or do not match the chunk store")
+            return None, None
+    signed = SignedFiles(MinHasher(spec["num_perm"], spec["shingle"]), tmp_dir)
+    _reprocess_dedup_losers(manifest, diff)
+    while True:
+        to_load = diff.added + diff.changed
+        sign_files(signed, {key: raw_dir / key for key in to_load if key not in signed.files})
+        existing = None
+        if store is not None:
+            stale = set(diff.deleted + diff.changed)
+            files = {key: entry["chunk_ids"] for key, entry in manifest["files"].items() if key not in stale}
+            existing = (store, signatures, files)
+        mtimes = {key: diff.stats.get(key, manifest["files"].get(key))["mtime"] for key in diff.unchanged + to_load}
+        plan = plan_dedup(spec, signed, mtimes, existing)
+        if not _reprocess_dedup_losers(manifest, diff, set(plan.displaced)):
+            break
+    if plan.n_dropped or plan.n_displaced:
+        logger.info(
+            f"Near-duplicates: {plan.n_dropped} new chunks skipped, "
+            f"{plan.n_displaced} existing chunks replaced by newer copies"
+        )
+    return signed, plan
+
+
+def _write_filters(out_dir: Path, manifest: Dict, raw_dir: Path) -> None:
+    """マニフェストのファイルごとの属性（パス・更新時刻・タグ）を、チャンクストアの行順で書き出す。"""
+    store = ChunkStore(out_dir / "chunks")
+    files = []
+    for key, entry in manifest["files"].items():
+        if "tags" not in entry:
+            # タグ導入前に取り込んだファイルは、本文を分割し直さず front matter だけ読み直す
+            try:
+                entry["tags"] = read_tags(raw_dir / key)
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"Could not read tags from {key}: {e}")
+                entry["tags"] = []
+        rows = store.rows_of(np.asarray(entry["chunk_ids"], dtype="int64"))
+        files.append((key, rows[rows >= 0], entry["mtime"], entry["tags"]))
+    write_filter_index(out_dir / "filters", len(store), files)
+
+
+class _IndexBuilder:
+    """埋め込みのバッチを受け取り、シャードごとのインデックスに順次追加する。
+
+    学習が必要なインデックス（IVF 系・int8）を新規に作る場合は、全件数から nlist を決めて学習するため、
+    最後のバッチまでベクトルを保持してから作成する（学習は1回だけ行い、全シャードに複製する）。
+    shards の None は、新規ビルドならまだ作っていないシャード、差分ビルドなら変更のないシャード。
+    vectors を渡すと、全次元の正規化済みベクトルをバッチの順（チャンクストアの行順）に書き出す。
+    """
+
+    def __init__(
+        self, shards: List[Optional[object]], params: Optional[Dict], vectors: Optional[FullVectorWriter] = None
+    ) -> None:
+        self.shards = shards
+        self.params = params
+        self.vectors = vectors
+        self._fresh = params is None
+        self._held_ids: List[np.ndarray] = []
+        self._held_shards: List[np.ndarray] = []
+        self._held: List[np.ndarray] = []
+
+    def add(self, ids: List[int], shard_ids: List[int], texts: List[str], stats: EmbeddingStats) -> None:
+        embeddings = get_embeddings(texts, stats=stats)
+        ids = np.asarray(ids, dtype="int64")
+        shard_ids = np.asarray(shard_ids, dtype="int64")
+        if self.vectors is not None:
+            self.vectors.append(prepare_vectors(embeddings, {"normalize": True}))
+        if self.params is None and needs_training(index_spec()):
+            self._held_ids.append(ids)
+            self._held_shards.append(shard_ids)
+            self._held.append(embeddings)
+            return
+        if self.params is None:
+            self.params = resolve_params(index_spec(), len(ids), embeddings.shape[1])
+        self._add(prepare_vectors(embeddings, self.params), ids, shard_ids)
+
+    def _add(self, vectors: np.ndarray, ids: np.ndarray, shard_ids: np.ndarray) -> None:
+        """ベクトルをシャードに振り分けて追加する。シャードへの追加は並列に行う（FAISS は GIL を解放する）。"""
+
+        def add_to(s: int) -> None:
+            if self.shards[s] is None:
+                # 学習の要らない flat / hnsw は、最初のベクトルが来たときに作る
+                self.shards[s] = create_index(self.params, vectors[:0])
+            mask = shard_ids == s
+            self.shards[s].add_with_ids(vectors[mask], ids[mask])
+
+        list(shard_pool().map(add_to, np.unique(shard_ids).tolist()))
+
+    def finish(self) -> Tuple[List[Optional[object]], Optional[Dict]]:
+        if self._held:
+            ids = np.concatenate(self._held_ids)
+            shard_ids = np.concatenate(self._held_shards)
+            embeddings = np.vstack(self._held)
+            self._held_ids, self._held_shards, self._held = [], [], []
+            self.params = resolve_params(index_spec(), len(ids), embeddings.shape[1])
+            vectors = prepare_vectors(embeddings, self.params)
+            del embeddings
+            trained = create_index(self.params, vectors)
+            self.shards = [trained] + [faiss.clone_index(trained) for _ in self.shards[1:]]
+            self._add(vectors, ids, shard_ids)
+        if self._fresh and self.params is not None:
+            # 新規ビルドでファイルが1つも割り当てられなかったシャードも、空のインデックスとして書き出す
+            self.shards = [
+                shard if shard is not None else create_index(self.params, np.empty((0, self.params["dim"]), "float32"))
+                for shard in self.shards
+            ]
+        return self.shards, self.params
+
+
+def build_index(full: bool = False, collection: Optional[str] = None) -> None:
+    """data/raw/ 配下（collection を指定した場合はそのコレクションの raw/ 配下）のドキュメントからインデックスを構築する。
+
+    前回ビルドのマニフェストがあれば、追加・変更されたファイルだけを読み込み・分割・埋め込みし、
+    削除・変更されたファイルのベクトルはインデックスから取り除く。
+    結果は新しいスナップショット（snapshots/<version>/）に書き、全て保存できてから current ポインタを
+    切り替える。公開中のスナップショットは書き換えないので、ビルド中も API は前の版で検索できる。
+
+    Args:
+        full: True の場合はマニフェストを無視して全件再構築する
+        collection: コレクション名（省略時は default）
+    """
+    target = get_collection(collection)
+    raw_dir, store_dir = target.raw_dir, target.store_dir
+    logger.info(f"Starting index build process for collection {target.name}...")
+
+    try:
+        logger.info(f"Scanning documents in {raw_dir}")
+        files = list_doc_files(str(raw_dir))
+    except FileNotFoundError:
+        logger.error(f"Directory not found: {raw_dir}")
+        logger.error(f"Please create {raw_dir} directory and add documents")
         raise
 
-    texts: List[str] = []
-    metadatas: List[Dict] = []
-
-    for doc in docs:
-        chunks = simple_split(doc["text"])
-        for idx, chunk in enumerate(chunks):
-            texts.append(chunk)
-            metadatas.append(
-                {
-                    "source": doc["path"],
-                    "chunk_id": idx,
-                }
-            )
+    # 差分の基準は公開中のスナップショット（旧形式のストアならベクトルストア直下）
+    base_dir = current_snapshot(store_dir)
+    manifest = None if full or base_dir is None else load_manifest(base_dir / "manifest.json")
+    embed_model = embed_model_id()
+    if manifest is not None and manifest.get("embed_model") != embed_model:
+        logger.info(f"Embedding model changed ({manifest.get('embed_model')} -> {embed_model}); rebuilding all")
+        manifest = None
+    chunker = chunker_spec()
+    if manifest is not None and manifest.get("chunker") != chunker:
+        logger.info(f"Chunker changed ({manifest.get('chunker')} -> {chunker}); rebuilding all")
+        manifest = None
+    dedup = dedup_spec()
+    if manifest is not None and manifest.get("dedup") != dedup:
+        logger.info(f"Near-duplicate settings changed ({manifest.get('dedup')} -> {dedup}); rebuilding all")
+        manifest = None
+    # 重複除去の事前パスのシグネチャは一時ファイルに置く（ベクトルストアと同じディスク）
+    store_dir.mkdir(parents=True, exist_ok=True)
+    existing = None
+    signed, plan = None, None
+    if manifest is not None:
+        diff = diff_files(manifest, files, raw_dir)
+        if dedup is not None:
+            signed, plan = _plan_dedup(dedup, manifest, diff, raw_dir, base_dir, store_dir)
+        # インデックスは追加・変更・削除されたファイルと、新しい重複にチャンクを置き換えられるファイルのある
+        # シャードだけを読み込み、書き直す
+        touched_keys = diff.added + diff.changed + diff.deleted + (list(plan.displaced) if plan else [])
+        touched = {shard_of(key, INDEX_SHARDS) for key in touched_keys}
+        if dedup is None or plan is not None:
+            existing = _load_existing(base_dir, manifest, touched)
+        if existing is None:
+            logger.warning("Existing index does not match manifest or settings; rebuilding all")
+            manifest = None
+            if signed is not None:
+                signed.close()
+            signed, plan = None, None
+    if manifest is None:
+        manifest = new_manifest(embed_model, chunker, dedup)
+        diff = diff_files(manifest, files, raw_dir)
+        if dedup is not None:
+            signed, plan = _plan_dedup(dedup, manifest, diff, raw_dir, None, store_dir)
+    logger.info(
+        f"Files: {len(diff.added)} added, {len(diff.changed)} changed, "
+        f"{len(diff.deleted)} deleted, {len(diff.unchanged)} unchanged"
+    )
 
-    logger.info(f"Total chunks created: {len(texts)}")
-    
-    if len(texts) == 0:
-        logger.warning("No documents found. Please add markdown or PDF files to data/raw/")
+    # mtimeだけが変わったファイルは内容が同じなのでマニフェストのみ更新
+    for key in diff.unchanged:
+        if key in diff.stats:
+            manifest["files"][key].update(diff.stats[key])
+
+    # BM25・フィルタ用のインデックスがない（導入前のストア）場合や、旧形式のストアの場合は、
+    # 変更がなくてもスナップショットを作って移行する。mtime だけが変わった場合も、
+    # 更新時刻でのフィルタに反映するため新しいスナップショットを作る（公開中のものは書き換えない）
+    if (
+        existing is not None
+        and not diff.has_changes
+        and not diff.stats
+        and base_dir != store_dir
+        and (base_dir / "filters" / "header.json").exists()
+        and _load_lexical(base_dir, existing[2]) is not None
+    ):
+        logger.info("Index is up to date; nothing to rebuild")
+        if signed is not None:
+            signed.close()
         return
 
-    # Embeddings作成
-    logger.info("Creating embeddings...")
-    embeddings_list = []
-    for i, t in enumerate(texts):
-        if i % 10 == 0:  # 10件ごとに進捗表示
-            logger.info(f"Progress: {i}/{len(texts)} ({i*100//len(texts)}%)")
-        embeddings_list.append(get_embedding(t))
-    
-    embeddings = np.array(embeddings_list, dtype="float32")
-    dim = embeddings.shape[1]
-    logger.info(f"Completed: {len(texts)}/{len(texts)} (100%)")
-
-    # FAISSインデックス作成
-    logger.info("Building FAISS index...")
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
-
-    Path(VECTORSTORE_DIR).mkdir(parents=True, exist_ok=True)
-
-    # FAISSは日本語パスを扱えないため、一時的に作業ディレクトリを変更
-    original_dir = os.getcwd()
+    if existing is not None:
+        shards, params, store, base_vectors = existing
+        keep_rows = np.arange(len(store))
+    else:
+        shards, params, store, base_vectors, keep_rows = [None] * INDEX_SHARDS, None, None, None, None
+
+    # 削除・変更されたファイルのベクトルを、ファイルのあるシャードから取り除く
+    stale_by_shard: Dict[int, List[int]] = {}
+    for key in diff.deleted + diff.changed:
+        stale_by_shard.setdefault(shard_of(key, len(shards)), []).extend(manifest["files"].pop(key)["chunk_ids"])
+    # 新しく取り込むファイルに残す側がある既存のチャンクも取り除き、どのファイルに残したかを記録する
+    if plan is not None:
+        for key, dropped in plan.displaced.items():
+            entry = manifest["files"][key]
+            ids = {chunk_id for chunk_id, _ in dropped}
+            entry["chunk_ids"] = [cid for cid in entry["chunk_ids"] if cid not in ids]
+            duplicates = entry.setdefault("duplicates", {})
+            for _, report in dropped:
+                duplicates[report["kept_file"]] = duplicates.get(report["kept_file"], 0) + 1
+            stale_by_shard.setdefault(shard_of(key, len(shards)), []).extend(ids)
+    stale_ids = [cid for ids in stale_by_shard.values() for cid in ids]
+    if stale_ids:
+        for s, ids in stale_by_shard.items():
+            shards[s] = remove_ids(shards[s], np.asarray(ids, dtype="int64"), params)
+        keep_rows = np.flatnonzero(~np.isin(store.ids, np.asarray(stale_ids, dtype="int64")))
+        logger.info(f"Removed {len(stale_ids)} stale chunks")
+    kept = len(keep_rows) if keep_rows is not None else 0
+
+    # 追加・変更されたファイルだけを読み込み → 分割 → 埋め込み → インデックス追加まで流す。
+    # 本文はチャンクストアの一時ディレクトリへ逐次書き出し、埋め込み待ちのバッチ数も制限するので、
+    # メモリ使用量はコーパス全体ではなくバッチサイズで決まる。
+    to_load = diff.added + diff.changed
+    key_of = {str(raw_dir / key): key for key in to_load}
+    version = new_version()
+    out_dir = snapshot_dir(version, store_dir)
+    writer = ChunkStoreWriter(out_dir / "chunks", base=store, keep_rows=keep_rows)
+    lexical_base = _load_lexical(base_dir, store) if store is not None else None
+    lexical = LexicalIndexWriter(out_dir / "lexical", base=lexical_base, keep_rows=keep_rows)
+    if lexical_base is None and store is not None:
+        lexical.add(store.text(int(row)) for row in keep_rows)
+    # 圧縮・切り詰めたインデックスでは、並べ直し用に全精度のベクトルをチャンクストアと同じ行順で書き出す
+    vectors = None
+    if needs_rescore(index_spec()):
+        vectors = FullVectorWriter(out_dir / FULL_VECTORS_NAME, base=base_vectors, keep_rows=keep_rows)
+    builder = _IndexBuilder(shards, params, vectors)
+    # 重複除去のシグネチャ（次回のビルドで既存のチャンクとの重複を判定するのに使う。行順はチャンクストアと同じ）
+    signatures = None
+    if plan is not None:
+        base_signatures = open_signatures(base_dir, dedup) if store is not None else None
+        signatures = FullVectorWriter(
+            out_dir / "dedup" / SIGNATURES_NAME, base=base_signatures, keep_rows=keep_rows, dtype="<u4"
+        )
+    stats = EmbeddingStats()
+    pending: deque = deque()
+    batch_ids: List[int] = []
+    batch_shards: List[int] = []
+    batch_texts: List[str] = []
+    next_id = manifest["next_id"]
+    n_loaded = 0
+
+    def _submit(pool: ThreadPoolExecutor) -> None:
+        # 埋め込み待ちが上限に達したら、古いバッチの完了を待ってから投入する（背圧）
+        while len(pending) >= INGEST_MAX_PENDING_BATCHES:
+            pending.popleft().result()
+        pending.append(pool.submit(builder.add, list(batch_ids), list(batch_shards), list(batch_texts), stats))
+        batch_ids.clear()
+        batch_shards.clear()
+        batch_texts.clear()
+
+    logger.info(f"Loading {len(to_load)} files and creating embeddings...")
     try:
-        # vectorstoreディレクトリに移動
-        os.chdir(VECTORSTORE_DIR)
-        # 相対パスで保存
-        faiss.write_index(index, "index.faiss")
-        logger.info("FAISS index saved successfully")
-    except Exception as e:
-        logger.error(f"Failed to save FAISS index: {e}")
+        # 埋め込み・インデックス追加は1スレッドで順に処理し、その間に次のファイルを読み込み・分割する
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed") as pool:
+            for doc in iter_docs([raw_dir / key for key in to_load]):
+                key = key_of[doc["path"]]
+                chunks, metadatas = split_document(doc["text"], doc["path"])
+                duplicates: Dict[str, int] = {}
+                if plan is not None:
+                    # 近似重複として除くと決めたチャンクは、埋め込みもインデックスへの追加もしない
+                    chunks, metadatas, duplicates, kept_signatures = filter_chunks(key, chunks, metadatas, plan, signed)
+                    signatures.append(kept_signatures)
+                chunk_ids = list(range(next_id, next_id + len(chunks)))
+                next_id += len(chunks)
+                writer.append(chunk_ids, chunks, metadatas)
+                lexical.add(chunks)
+                batch_ids.extend(chunk_ids)
+                batch_shards.extend([shard_of(key, len(shards))] * len(chunks))
+                batch_texts.extend(chunks)
+                # 読み込みに失敗したファイルはマニフェストに載せず、次回のビルドで再試行する
+                manifest["files"][key] = {**diff.stats[key], "chunk_ids": chunk_ids, "tags": doc.get("tags", [])}
+                if duplicates:
+                    manifest["files"][key]["duplicates"] = duplicates
+                n_loaded += 1
+                if len(batch_texts) >= INGEST_BATCH_CHUNKS:
+                    _submit(pool)
+                    logger.info(
+                        f"Progress: {n_loaded}/{len(to_load)} files loaded, {stats.chunks} chunks embedded"
+                    )
+            if batch_texts:
+                _submit(pool)
+            while pending:
+                pending.popleft().result()
+        shards, params = builder.finish()
+    except BaseException:
+        writer.abort()
+        for extra in (vectors, signatures):
+            if extra is not None:
+                extra.abort()
+        if signed is not None:
+            signed.close()
+        shutil.rmtree(out_dir, ignore_errors=True)
         raise
-    finally:
-        # 元のディレクトリに戻る
-        os.chdir(original_dir)
-    
-    # メタデータ保存
+    if signed is not None:
+        signed.close()
+    manifest["next_id"] = next_id
+
+    new_chunks = len(writer) - kept
+    logger.info(f"Embedded {new_chunks} new chunks from {n_loaded} files (kept {kept} existing chunks)")
+    if stats.chunks:
+        logger.info(
+            f"Embedded {stats.chunks} chunks / {stats.tokens} tokens in {stats.seconds:.1f}s "
+            f"({stats.chunks_per_sec:.1f} chunks/s, {stats.tokens_per_sec:.0f} tokens/s, "
+            f"{stats.requests} requests, {stats.retries} retries, {stats.cache_hits} cache hits)"
+        )
+
+    if params is None:
+        writer.abort()
+        for extra in (vectors, signatures):
+            if extra is not None:
+                extra.abort()
+        shutil.rmtree(out_dir, ignore_errors=True)
+        logger.warning(f"No documents found. Please add markdown or PDF files to {raw_dir}")
+        return
+
+    manifest["version"] = version
+
+    # インデックス（変更のないシャードは前回のファイルをリンク）→ チャンクストア → BM25 インデックス → フィルタ用の属性 → マニフェストを
+    # 新しいスナップショットに保存し、最後に current ポインタを切り替える。
+    # 途中で失敗した場合は作りかけのスナップショットを消し、公開中のスナップショットはそのまま残る。
     try:
-        with open(FAISS_META_PATH, "w", encoding="utf-8") as f:
-            json.dump({"texts": texts, "metadatas": metadatas}, f, ensure_ascii=False, indent=2)
-        logger.info("Metadata saved successfully")
+        write_shards(shards, out_dir, base_dir)
+        save_params(params, out_dir)
+        written = sum(shard is not None for shard in shards)
+        logger.info(f"FAISS index saved successfully ({params['type']}, {written}/{len(shards)} shards written)")
+        if vectors is not None:
+            vectors.commit()
+            logger.info(f"Full-precision vectors saved successfully ({len(vectors)} x {vectors.dim})")
+        writer.commit()
+        logger.info("Chunk store saved successfully")
+        lexical.commit()
+        logger.info("Lexical index saved successfully")
+        _write_filters(out_dir, manifest, raw_dir)
+        logger.info("Filter index saved successfully")
+        if signatures is not None:
+            signatures.commit()
+            report = write_report(plan, out_dir)
+            logger.info(
+                f"Near-duplicate signatures saved successfully ({plan.n_dropped} skipped, "
+                f"{plan.n_displaced} replaced; report: {report})"
+            )
+        save_manifest(manifest, out_dir / "manifest.json")
     except Exception as e:
-        logger.error(f"Failed to save metadata: {e}")
+        writer.abort()
+        for extra in (vectors, signatures):
+            if extra is not None:
+                extra.abort()
+        shutil.rmtree(out_dir, ignore_errors=True)
+        logger.error(f"Failed to save snapshot {version}: {e}")
         raise
 
-    logger.info("Index build completed successfully!")
+    publish_snapshot(version, store_dir)
+    logger.info(
+        f"Index build completed successfully! (collection={target.name}, version={version}, chunks={len(writer)})"
+    )
 
+    # 旧形式のストアから移行した場合は直下のファイルを、それ以外は古いスナップショットを削除する
+    if base_dir == store_dir:
+        remove_legacy_files(store_dir)
+    prune_snapshots(store_dir=store_dir)
 
 
 if __name__ == "__main__":
-    build_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the FAISS index from data/raw/")
+    parser.add_argument("--full", action="store_true", help="マニフェストを無視して全件再構築する")
+    parser.add_argument(
+        "--collection", default=None, help="コレクション名（文書は COLLECTIONS_DIR/<名前>/raw/。省略時は data/raw/）"
+    )
+    args = parser.parse_args()
+    build_index(full=args.full, collection=args.collection)
@@ -0,0 +1,354 @@
+import json
+import logging
+import tempfile
+import unicodedata
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.config import DEDUP_THRESHOLD, DEDUP_KEEP, DEDUP_NUM_PERM, DEDUP_SHINGLE
+from src.ingestion.load_docs import iter_docs
+from src.ingestion.split_docs import split_document
+from src.rag.chunk_store import ChunkStore
+
+logger = logging.getLogger(__name__)
+
+DEDUP_KEEPS = ("newest", "oldest")
+
+# ファイル構成（スナップショット内）
+#   dedup/signatures.u32  uint32 (n, num_perm) リトルエンディアン。行番号はチャンクストアと同じ
+#   dedup/report.jsonl    そのビルドで除いたチャンク（1行1件）
+SIGNATURES_NAME = "signatures.u32"
+REPORT_NAME = "report.jsonl"
+
+# 類似度がしきい値ちょうどのペアを LSH の候補として見つける確率の目標
+_LSH_RECALL = 0.99
+# レポートに載せるチャンク本文の先頭の文字数
+REPORT_PREVIEW_CHARS = 80
+# バンドのハッシュを計算するときの1回あたりの行数
+_BLOCK_ROWS = 65536
+# シングルのハッシュ（多項式ハッシュ）の基数
+_BASE = np.uint64(1099511628211)
+
+
+def dedup_spec() -> Optional[Dict]:
+    """重複除去の設定。無効なら None。変わったら全件を取り込み直す（マニフェストに記録して比較する）。"""
+    if DEDUP_THRESHOLD <= 0:
+        return None
+    if DEDUP_THRESHOLD > 1:
+        raise ValueError(f"DEDUP_THRESHOLD must be between 0 and 1 (got {DEDUP_THRESHOLD})")
+    if DEDUP_KEEP not in DEDUP_KEEPS:
+        raise ValueError(f"Unknown DEDUP_KEEP: {DEDUP_KEEP} (expected one of {DEDUP_KEEPS})")
+    if DEDUP_NUM_PERM < 1 or DEDUP_SHINGLE < 1:
+        raise ValueError("DEDUP_NUM_PERM and DEDUP_SHINGLE must be at least 1")
+    return {"threshold": DEDUP_THRESHOLD, "keep": DEDUP_KEEP, "num_perm": DEDUP_NUM_PERM, "shingle": DEDUP_SHINGLE}
+
+
+def lsh_params(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """LSH のバンド数と1バンドの行数。
+
+    類似度がしきい値のペアが少なくとも1つのバンドで一致する確率が _LSH_RECALL 以上になる中で、
+    行数が最大の（候補が最も少ない）分け方を選ぶ。
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= _LSH_RECALL:
+            best = (bands, rows)
+    return best
+
+
+class MinHasher:
+    """チャンク本文の MinHash シグネチャを作る。
+
+    本文は NFKC 正規化・小文字化して空白を除き、文字 n-gram（日本語は分かち書きしないため単語ではなく文字）を
+    シングルにする。シングルは多項式ハッシュで 64bit にし、num_perm 個の multiply-shift ハッシュの最小値を取る。
+    1チャンクあたり numpy の数回の演算で済むので、件数に比例した時間で動く。
+    """
+
+    def __init__(self, num_perm: int = DEDUP_NUM_PERM, shingle: int = DEDUP_SHINGLE, seed: int = 1) -> None:
+        self.num_perm = num_perm
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        self._a = (rng.integers(0, 2**63, size=(num_perm, 1), dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=(num_perm, 1), dtype=np.uint64)
+
+    def _shingle_hashes(self, text: str) -> np.ndarray:
+        text = "".join(unicodedata.normalize("NFKC", text).lower().split())
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype="<u4").astype(np.uint64)
+        if len(codes) == 0:
+            # 空のチャンクは同じ1つのシングルとして扱う
+            return np.zeros(1, dtype=np.uint64)
+        # シングルより短い本文は全体を1つのシングルにする
+        width = min(self.shingle, len(codes))
+        n = len(codes) - width + 1
+        hashes = np.zeros(n, dtype=np.uint64)
+        for j in range(width):
+            hashes = hashes * _BASE + codes[j:j + n]
+        return hashes
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = self._shingle_hashes(text)
+        return ((self._a * hashes + self._b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """チャンクごとのシグネチャ（len(texts), num_perm）。"""
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        return np.stack([self.signature(text) for text in texts])
+
+
+def open_signatures(directory: str | Path, spec: Dict) -> Optional[np.ndarray]:
+    """スナップショットのシグネチャを mmap で開く。ない・壊れている場合は None。"""
+    path = Path(directory) / "dedup" / SIGNATURES_NAME
+    if not path.exists():
+        return None
+    size = path.stat().st_size
+    if size % (4 * spec["num_perm"]):
+        return None
+    if size == 0:
+        return np.empty((0, spec["num_perm"]), dtype="<u4")
+    return np.memmap(path, dtype="<u4", mode="r").reshape(-1, spec["num_perm"])
+
+
+class SignedFiles:
+    """取り込むファイルのチャンクのシグネチャ（事前パスで計算したもの）。
+
+    シグネチャは一時ファイルに書き出して mmap で開くので、コーパスが大きくてもメモリに載せない。
+    """
+
+    def __init__(self, hasher: MinHasher, tmp_dir: Optional[Path] = None) -> None:
+        self.hasher = hasher
+        # ファイルのキー -> (一時ファイル内の開始行, チャンク数)
+        self.files: Dict[str, Tuple[int, int]] = {}
+        self._f = tempfile.TemporaryFile(dir=tmp_dir)
+        self._rows = 0
+        self.signatures = np.empty((0, hasher.num_perm), dtype="<u4")
+
+    def add(self, key: str, chunks: List[str]) -> None:
+        if chunks:
+            self._f.write(self.hasher.signatures(chunks).astype("<u4").tobytes())
+        self.files[key] = (self._rows, len(chunks))
+        self._rows += len(chunks)
+
+    def finish(self) -> None:
+        """書き出したシグネチャを開き直す（add の後、plan_dedup の前に呼ぶ）。"""
+        self._f.flush()
+        if self._rows:
+            self.signatures = np.memmap(self._f, dtype="<u4", mode="r").reshape(-1, self.hasher.num_perm)
+
+    def of(self, key: str, count: int, positions: List[int]) -> Optional[np.ndarray]:
+        """ファイルのチャンクのうち positions のシグネチャ。事前パスとチャンク数が違えば None。"""
+        start, n = self.files.get(key, (0, -1))
+        if n != count:
+            return None
+        return np.asarray(self.signatures[start:start + n][positions])
+
+    def close(self) -> None:
+        self.signatures = None
+        self._f.close()
+
+
+def sign_files(signed: SignedFiles, paths: Dict[str, Path]) -> None:
+    """ファイルを読み込んで分割し、チャンクごとのシグネチャを signed に加える（埋め込みより前の事前パス）。
+
+    本文は保持しない。本処理ではファイルを読み直して同じように分割する。
+    """
+    key_of = {str(path): key for key, path in paths.items()}
+    for doc in iter_docs(list(paths.values())):
+        chunks, _ = split_document(doc["text"], doc["path"])
+        signed.add(key_of[doc["path"]], chunks)
+    signed.finish()
+
+
+@dataclass
+class DedupPlan:
+    """重複除去の判定結果。
+
+    drop は取り込むファイルの除くチャンク（チャンクの位置 -> レポートの1行）、
+    displaced は既存のファイルから除くチャンク（新しく取り込むファイルに残す方がある）。
+    """
+
+    drop: Dict[str, Dict[int, Dict]] = field(default_factory=dict)
+    displaced: Dict[str, List[Tuple[int, Dict]]] = field(default_factory=dict)
+
+    @property
+    def n_dropped(self) -> int:
+        return sum(len(d) for d in self.drop.values())
+
+    @property
+    def n_displaced(self) -> int:
+        return sum(len(d) for d in self.displaced.values())
+
+    def entries(self) -> List[Dict]:
+        rows = [entry for d in self.drop.values() for entry in d.values()]
+        return rows + [entry for d in self.displaced.values() for _, entry in d]
+
+
+def plan_dedup(
+    spec: Dict,
+    signed: SignedFiles,
+    mtimes: Dict[str, float],
+    existing: Optional[Tuple[ChunkStore, np.ndarray, Dict[str, List[int]]]] = None,
+) -> DedupPlan:
+    """取り込むチャンクと既存のチャンクの中から近似重複を見つけ、残すものを決める。
+
+    LSH でバンドが一致したチャンクだけを候補にし、シグネチャの一致率（Jaccard 類似度の推定値）が
+    しきい値以上なら重複とみなす。候補になったチャンクを DEDUP_KEEP の順（ファイルの更新時刻、
+    同じならパス、同じファイル内では先のチャンク）に見ていき、先に残したチャンクと重複するものを除く。
+    候補の探索はソートだけで行い、Python で回すのは重複の候補になったチャンクだけなので、
+    全体としてチャンク数にほぼ比例した時間で動く。
+
+    Args:
+        spec: dedup_spec() の戻り値
+        signed: 取り込むファイルのシグネチャ
+        mtimes: ファイルのキー -> 更新時刻（取り込むファイルと existing のファイル）
+        existing: 前回ビルドのチャンクストア・シグネチャと、残すファイル -> チャンクIDのリスト
+
+    Returns:
+        DedupPlan
+    """
+    threshold = spec["threshold"]
+    num_perm = spec["num_perm"]
+    bands, rows_per_band = lsh_params(num_perm, threshold)
+
+    # 候補の番号: 既存のチャンク（0 〜 n_old-1）→ 取り込むチャンク（一時ファイルの行順なので u - n_old 行目）
+    keys: List[str] = []
+    file_of, pos_of, old_rows = [], [], []
+    if existing is not None:
+        store, _, files = existing
+        for key, chunk_ids in files.items():
+            rows = store.rows_of(np.asarray(chunk_ids, dtype="int64"))
+            file_of.append(np.full(len(rows), len(keys)))
+            pos_of.append(np.arange(len(rows)))
+            old_rows.append(rows)
+            keys.append(key)
+    n_old = sum(len(r) for r in old_rows)
+    for key, (_, count) in signed.files.items():
+        file_of.append(np.full(count, len(keys)))
+        pos_of.append(np.arange(count))
+        keys.append(key)
+    file_of = np.concatenate(file_of) if file_of else np.zeros(0, "int64")
+    pos_of = np.concatenate(pos_of) if pos_of else np.zeros(0, "int64")
+    old_rows = np.concatenate(old_rows) if old_rows else np.zeros(0, "int64")
+    n = len(file_of)
+
+    def signatures(start: int, stop: int) -> np.ndarray:
+        parts = []
+        if start < n_old:
+            parts.append(existing[1][old_rows[start:min(stop, n_old)]])
+        if stop > n_old:
+            parts.append(signed.signatures[max(start, n_old) - n_old:stop - n_old])
+        return np.concatenate(parts) if len(parts) > 1 else np.asarray(parts[0])
+
+    plan = DedupPlan()
+    if n - n_old == 0:
+        return plan
+
+    # バンドごとのハッシュ（ブロックごとに計算し、シグネチャ全体は読み込まない）
+    rng = np.random.default_rng(2)
+    coef = (rng.integers(0, 2**63, size=rows_per_band, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+    band_keys = np.empty((n, bands), dtype=np.uint64)
+    for start in range(0, n, _BLOCK_ROWS):
+        stop = min(n, start + _BLOCK_ROWS)
+        x = signatures(start, stop).astype(np.uint64).reshape(stop - start, bands, rows_per_band)
+        band_keys[start:stop] = (x * coef).sum(axis=2)
+
+    # 同じバンドのハッシュを持つチャンクの組（取り込むチャンクを含むものだけ）
+    runs_of: Dict[int, List[int]] = defaultdict(list)
+    n_runs = 0
+    is_new = np.arange(n) >= n_old
+    for b in range(bands):
+        order = np.argsort(band_keys[:, b], kind="stable")
+        sorted_keys = band_keys[order, b]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, n])
+        has_new = np.add.reduceat(is_new[order].astype(np.int64), starts) > 0
+        for s, size in zip(starts[(sizes >= 2) & has_new], sizes[(sizes >= 2) & has_new]):
+            for u in order[s:s + size].tolist():
+                runs_of[u].append(n_runs)
+            n_runs += 1
+    del band_keys
+
+    # 残す順（DEDUP_KEEP）に並べて、先に残したチャンクと重複するものを除く
+    sign = -1 if spec["keep"] == "newest" else 1
+    file_rank = np.empty(len(keys), dtype="int64")
+    file_rank[sorted(range(len(keys)), key=lambda i: (sign * mtimes[keys[i]], keys[i]))] = np.arange(len(keys))
+    candidates = np.fromiter(runs_of.keys(), dtype="int64", count=len(runs_of))
+    candidates = candidates[np.lexsort((pos_of[candidates], file_rank[file_of[candidates]]))]
+    kept_in_run: Dict[int, List[int]] = defaultdict(list)
+    for u in candidates.tolist():
+        sig = signatures(u, u + 1)[0]
+        winner = None
+        for run in runs_of[u]:
+            for w in kept_in_run[run]:
+                similarity = np.count_nonzero(signatures(w, w + 1)[0] == sig) / num_perm
+                if similarity >= threshold:
+                    winner = (w, similarity)
+                    break
+            if winner is not None:
+                break
+        if winner is None:
+            for run in runs_of[u]:
+                kept_in_run[run].append(u)
+            continue
+        w, similarity = winner
+        entry = {
+            "file": keys[file_of[u]],
+            "chunk": _chunk_position(u, n_old, old_rows, pos_of, existing),
+            "kept_file": keys[file_of[w]],
+            "kept_chunk": _chunk_position(w, n_old, old_rows, pos_of, existing),
+            "similarity": round(similarity, 3),
+        }
+        if u < n_old:
+            chunk_id = int(existing[0].ids[old_rows[u]])
+            entry["text"] = existing[0].text(int(old_rows[u]))[:REPORT_PREVIEW_CHARS]
+            plan.displaced.setdefault(entry["file"], []).append((chunk_id, entry))
+        else:
+            plan.drop.setdefault(entry["file"], {})[int(pos_of[u])] = entry
+    return plan
+
+
+def _chunk_position(u: int, n_old: int, old_rows: np.ndarray, pos_of: np.ndarray, existing) -> int:
+    """レポートに載せるチャンクの位置（ファイル内で何番目のチャンクか）。"""
+    if u < n_old:
+        return int(existing[0].metadata(int(old_rows[u])).get("chunk_id", pos_of[u]))
+    return int(pos_of[u])
+
+
+def filter_chunks(
+    key: str, chunks: List[str], metadatas: List[Dict], plan: DedupPlan, signed: SignedFiles
+) -> Tuple[List[str], List[Dict], Dict[str, int], np.ndarray]:
+    """本処理で分割したファイルのチャンクから、plan で除くと決めたものを取り除く。
+
+    Returns:
+        (残すチャンク, そのメタデータ, 残した側のファイル -> 除いたチャンク数, 残すチャンクのシグネチャ)
+    """
+    drop = plan.drop.get(key, {})
+    keep = [i for i in range(len(chunks)) if i not in drop]
+    signatures = signed.of(key, len(chunks), keep)
+    if signatures is None:
+        # 事前パスと分割結果が違う（読み込みの間にファイルが変わった等）場合は、このファイルは除かずに取り込む
+        logger.warning(f"{key} changed while checking for near-duplicates; ingesting all of its chunks")
+        plan.drop.pop(key, None)
+        return chunks, metadatas, {}, signed.hasher.signatures(chunks)
+    duplicates: Dict[str, int] = {}
+    for pos, entry in drop.items():
+        entry["text"] = chunks[pos][:REPORT_PREVIEW_CHARS]
+        duplicates[entry["kept_file"]] = duplicates.get(entry["kept_file"], 0) + 1
+    return [chunks[i] for i in keep], [metadatas[i] for i in keep], duplicates, signatures
+
+
+def write_report(plan: DedupPlan, directory: str | Path) -> Path:
+    """除いたチャンクを1行1件の JSON で書き出す。"""
+    path = Path(directory) / "dedup" / REPORT_NAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in plan.entries():
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return path
@@ -1,10 +1,244 @@
 import logging
+import multiprocessing
+import re
+import time
+from collections import deque
+from multiprocessing.connection import wait
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict, Optional
 from pypdf import PdfReader
 
+from src.config import LOAD_WORKERS, LOAD_TIMEOUT
+
 logger = logging.getLogger(__name__)
 
+SUPPORTED_SUFFIXES = (".md", ".pdf")
+
+
+def list_doc_files(root: str) -> List[Path]:
+    """
+    指定されたディレクトリ配下の対象ファイル（Markdown / PDF）を1回の走査で列挙する。
+
+    Args:
+        root: ドキュメントのルートディレクトリパス
+
+    Returns:
+        ファイルパスのリスト（パス順）
+    """
+    root_path = Path(root)
+    if not root_path.exists():
+        raise FileNotFoundError(root)
+    return sorted(
+        p for p in root_path.rglob("*") if p.suffix.lower() in SUPPORTED_SUFFIXES and p.is_file()
+    )
+
+
+def read_markdown(path: Path) -> str:
+    return path.read_text(encoding="utf-8")
+
+
+_FRONT_MATTER_RE = re.compile(r"\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)", re.DOTALL)
+
+
+def parse_tags(text: str) -> List[str]:
+    """Markdown 先頭の front matter から tags を取り出す。
+
+    `tags: [人事, 規程]`・`tags: 人事, 規程`・次の行からの `- 人事` の形式に対応する
+    （YAML の他の構文は解釈しない）。front matter がなければ空のリスト。
+    """
+    m = _FRONT_MATTER_RE.match(text)
+    if not m:
+        return []
+    lines = m.group(1).splitlines()
+    for i, line in enumerate(lines):
+        key, sep, value = line.partition(":")
+        if not sep or key.strip() != "tags":
+            continue
+        value = value.strip()
+        if value:
+            items = value.strip("[]").split(",")
+        else:
+            items = []
+            for item in lines[i + 1:]:
+                if not item.lstrip().startswith("-"):
+                    break
+                items.append(item.lstrip()[1:])
+        tags = [t.strip().strip("'\"") for t in items]
+        return list(dict.fromkeys(t for t in tags if t))
+    return []
+
+
+def read_tags(path: Path) -> List[str]:
+    """ファイルのタグ。PDF はタグを持たない。"""
+    if path.suffix.lower() == ".pdf":
+        return []
+    return parse_tags(read_markdown(path))
+
+
+def read_pdf(path: Path) -> str:
+    reader = PdfReader(str(path))
+    text_parts = []
+    for page in reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            text_parts.append(page_text)
+    return "\n".join(text_parts)
+
+
+def load_doc(path: Path) -> Optional[Dict[str, str]]:
+    """
+    1ファイルを拡張子に応じて読み込む。
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        {"path": ファイルパス, "text": テキスト内容, "tags": タグ}。読み込みに失敗した場合は None
+    """
+    try:
+        if path.suffix.lower() == ".pdf":
+            text = read_pdf(path)
+            tags = []
+        else:
+            text = read_markdown(path)
+            tags = parse_tags(text)
+    except Exception as e:
+        logger.error(f"Failed to read file {path}: {e}")
+        return None
+    logger.debug(f"Loaded: {path.name}")
+    return {"path": str(path), "text": text, "tags": tags}
+
+
+def _pdf_worker(conn) -> None:
+    """PDF 抽出プロセスの本体。親から受け取ったパスを読み込んで (text, error) を返す。None で終了。"""
+    while True:
+        try:
+            path = conn.recv()
+        except EOFError:
+            return
+        if path is None:
+            return
+        try:
+            conn.send((read_pdf(Path(path)), None))
+        except Exception as e:
+            conn.send((None, f"{type(e).__name__}: {e}"))
+
+
+class _PdfWorker:
+    """1ファイルずつ処理させるワーカープロセス。タイムアウトしたら kill して作り直す。"""
+
+    def __init__(self, ctx) -> None:
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_pdf_worker, args=(child,), daemon=True)
+        self.proc.start()
+        child.close()
+        self.path: Optional[Path] = None
+        self.deadline = 0.0
+
+    def submit(self, path: Path, timeout: float) -> None:
+        self.path = path
+        self.deadline = time.monotonic() + timeout
+        self.conn.send(str(path))
+
+    def kill(self) -> None:
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+    def close(self) -> None:
+        if self.path is not None:
+            self.kill()
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.proc.join(timeout=5)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+
+def iter_docs(
+    paths: Iterable[Path],
+    workers: int = LOAD_WORKERS,
+    timeout: float = LOAD_TIMEOUT,
+) -> Iterator[Dict[str, str]]:
+    """
+    ファイルを読み込み、読めたものから順にドキュメントを yield する。
+
+    PDF は workers 個のプロセスで並列に抽出し、1ファイルが timeout 秒を超えたら
+    そのプロセスを止めてスキップする。Markdown は抽出を待つ間に親プロセスで読む。
+    同時に保持するのは処理中のファイル分だけなので、メモリはコーパスの大きさに依存しない。
+
+    Args:
+        paths: ファイルパス（list_doc_files の戻り値など）
+        workers: PDF 抽出のプロセス数（0 なら親プロセスで順に読む）
+        timeout: PDF 1ファイルあたりのタイムアウト（秒）
+
+    Returns:
+        {"path": ファイルパス, "text": テキスト内容, "tags": タグ} のイテレータ（完了順）。
+        読み込みに失敗したファイルは含まれない
+    """
+    pdfs = deque()
+    others = deque()
+    for path in paths:
+        (pdfs if path.suffix.lower() == ".pdf" and workers > 0 else others).append(path)
+
+    # spawn で起動し、親プロセスのスレッドや FAISS の状態を引き継がない
+    ctx = multiprocessing.get_context("spawn")
+    pool = [_PdfWorker(ctx) for _ in range(min(workers, len(pdfs)))]
+    try:
+        for w in pool:
+            w.submit(pdfs.popleft(), timeout)
+
+        while True:
+            busy = [w for w in pool if w.path is not None]
+            if not busy and not others:
+                break
+            # Markdown が残っている間は待たずに確認だけする
+            if others or not busy:
+                wait_for = 0.0
+            else:
+                wait_for = max(0.0, min(w.deadline for w in busy) - time.monotonic())
+            ready = wait([w.conn for w in busy], timeout=wait_for) if busy else []
+
+            done: List[Dict[str, str]] = []
+            for i, w in enumerate(pool):
+                if w.path is None:
+                    continue
+                if w.conn in ready:
+                    try:
+                        text, error = w.conn.recv()
+                    except EOFError:
+                        text, error = None, "worker process exited unexpectedly"
+                    if error is None:
+                        logger.debug(f"Loaded: {w.path.name}")
+                        done.append({"path": str(w.path), "text": text, "tags": []})
+                    else:
+                        logger.error(f"Failed to read file {w.path}: {error}")
+                    if not w.proc.is_alive():
+                        w.path = None
+                        w.close()
+                        pool[i] = w = _PdfWorker(ctx)
+                    w.path = None
+                elif time.monotonic() >= w.deadline:
+                    logger.error(f"Timed out after {timeout:.0f}s reading {w.path}; skipping")
+                    w.kill()
+                    pool[i] = w = _PdfWorker(ctx)
+                if w.path is None and pdfs:
+                    w.submit(pdfs.popleft(), timeout)
+            yield from done
+
+            if others:
+                doc = load_doc(others.popleft())
+                if doc is not None:
+                    yield doc
+    finally:
+        for w in pool:
+            w.close()
+
 
 def load_markdown_docs(root: str) -> List[Dict[str, str]]:
     """
@@ -21,7 +255,7 @@ def load_markdown_docs(root: str) -> List[Dict[str, str]]:
     
     for path in root_path.rglob("*.md"):
         try:
-            text = path.read_text(encoding="utf-8")
+            text = read_markdown(path)
             docs.append({"path": str(path), "text": text})
             logger.debug(f"Loaded markdown: {path.name}")
         except Exception as e:
@@ -46,17 +280,9 @@ def load_pdf_docs(root: str) -> List[Dict[str, str]]:
     
     for path in root_path.rglob("*.pdf"):
         try:
-            reader = PdfReader(str(path))
-            text_parts = []
-            
-            for page_num, page in enumerate(reader.pages, start=1):
-                page_text = page.extract_text()
-                if page_text:
-                    text_parts.append(page_text)
-                    
-            text = "\n".join(text_parts)
+            text = read_pdf(path)
             docs.append({"path": str(path), "text": text})
-            logger.debug(f"Loaded PDF: {path.name} ({len(reader.pages)} pages)")
+            logger.debug(f"Loaded PDF: {path.name}")
             
         except Exception as e:
             logger.error(f"Failed to read PDF file {path}: {e}")
@@ -77,10 +303,7 @@ def load_all_docs(root: str) -> List[Dict[str, str]]:
     """
     logger.info(f"Loading documents from {root}")
     
-    markdown_docs = load_markdown_docs(root)
-    pdf_docs = load_pdf_docs(root)
-    
-    all_docs = markdown_docs + pdf_docs
+    all_docs = list(iter_docs(list_doc_files(root)))
     logger.info(f"Total documents loaded: {len(all_docs)}")
     
     return all_docs
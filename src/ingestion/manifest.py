@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FORMAT = 1
+
+
+@dataclass
+class FileDiff:
+    """前回ビルド時のマニフェストと現在のファイル群との差分。"""
+
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    # 相対パス -> 最新の {"sha256", "mtime", "size"}（追加・変更・mtimeのみ変化したファイル）
+    stats: Dict[str, Dict] = field(default_factory=dict)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.deleted)
+
+
+def new_manifest(embed_model: str, chunker: Optional[Dict] = None, dedup: Optional[Dict] = None) -> Dict:
+    return {
+        "format": MANIFEST_FORMAT,
+        "version": None,
+        "embed_model": embed_model,
+        "chunker": chunker,
+        "dedup": dedup,
+        "next_id": 0,
+        "files": {},
+    }
+
+
+def load_manifest(path: str | Path) -> Optional[Dict]:
+    """マニフェストを読み込む。存在しない・形式が古い場合は None。"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Failed to read manifest {path}: {e}")
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        logger.warning(f"Unsupported manifest format in {path}; ignoring")
+        return None
+    return manifest
+
+
+def save_manifest(manifest: Dict, path: str | Path) -> None:
+    """一時ファイル経由で書き込み、途中で落ちても壊れたマニフェストを残さない。"""
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def new_version() -> str:
+    """ビルドごとに一意なバージョン文字列。"""
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 1_000_000:06d}"
+
+
+def file_sha256(path: str | Path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def relative_key(path: Path, root: Path) -> str:
+    """マニフェストのキー（ルートからの相対パス、OSに依存しない区切り）。"""
+    return path.relative_to(root).as_posix()
+
+
+def diff_files(manifest: Dict, paths: List[Path], root: Path) -> FileDiff:
+    """ファイル群をマニフェストと比較する。
+
+    サイズとmtimeが一致するファイルはハッシュ計算を省略して未変更とみなす。
+    mtimeだけが変わったファイルはハッシュを比較し、内容が同じなら未変更として扱う。
+    """
+    diff = FileDiff()
+    known = manifest["files"]
+    seen = set()
+
+    for path in paths:
+        key = relative_key(path, root)
+        seen.add(key)
+        st = path.stat()
+        entry = known.get(key)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            diff.unchanged.append(key)
+            continue
+
+        digest = file_sha256(path)
+        diff.stats[key] = {"sha256": digest, "mtime": st.st_mtime, "size": st.st_size}
+        if entry is None:
+            diff.added.append(key)
+        elif entry["sha256"] != digest:
+            diff.changed.append(key)
+        else:
+            diff.unchanged.append(key)
+
+    diff.deleted = [key for key in known if key not in seen]
+    return diff
@@ -1,4 +1,12 @@
-from typing import List
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.config import CHUNKER, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_MIN_TOKENS
+from src.models.embedder import get_encoding
 
 
 def simple_split(text: str, max_chars: int = 800, overlap: int = 100) -> List[str]:
@@ -18,4 +26,211 @@ def simple_split(text: str, max_chars: int = 800, overlap: int = 100) -> List[st
             break
         start = end - overlap
 
-    return chunks
\ No newline at end of file
+    return chunks
+
+
+_HEADING_RE = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t#]*$", re.MULTILINE)
+# コードブロックと表は途中で切らない
+_FENCE_RE = re.compile(r"^```.*?^```[^\n]*$", re.MULTILINE | re.DOTALL)
+_TABLE_RE = re.compile(r"(?:^\|[^\n]*(?:\n|$))+", re.MULTILINE)
+
+# 文末記号（この直後で区切る）と、文末記号の後ろに続けてよい閉じ括弧
+_TERMINATORS = np.array([ord(c) for c in "。！？!?\n"], dtype="uint32")
+_CLOSERS = np.array([ord(c) for c in "」』）)】〉》\"'"], dtype="uint32")
+
+
+@lru_cache(maxsize=1)
+def _token_byte_lengths() -> np.ndarray:
+    """トークンID -> UTF-8 バイト長の表。トークン列から文字位置を求めるのに使う。"""
+    enc = get_encoding()
+    lengths = np.zeros(enc.n_vocab, dtype="int64")
+    for i in range(enc.n_vocab):
+        try:
+            lengths[i] = len(enc.decode_single_token_bytes(i))
+        except KeyError:
+            pass
+    return lengths
+
+
+def _char_byte_offsets(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(コードポイント配列, 各文字の先頭の UTF-8 バイト位置 (n+1,)) を返す。"""
+    cp = np.frombuffer(text.encode("utf-32-le"), dtype="uint32")
+    widths = 1 + (cp >= 0x80).astype("int64") + (cp >= 0x800) + (cp >= 0x10000)
+    offsets = np.zeros(len(cp) + 1, dtype="int64")
+    np.cumsum(widths, out=offsets[1:])
+    return cp, offsets
+
+
+def _protected_spans(text: str, fences: List[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    spans = sorted(fences + [m.span() for m in _TABLE_RE.finditer(text)])
+    starts = np.array([s for s, _ in spans], dtype="int64")
+    ends = np.array([e for _, e in spans], dtype="int64")
+    return starts, ends
+
+
+def _sentence_boundaries(cp: np.ndarray, spans: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """文末（。！？ や改行の直後）の文字位置を返す。閉じ括弧は直前の文に含め、表・コード内では区切らない。"""
+    n = len(cp)
+    is_term = np.isin(cp, _TERMINATORS)
+    # 文末記号・閉じ括弧が連続する場合は、その並びの最後で区切る
+    tail = is_term | np.isin(cp, _CLOSERS)
+    nxt_tail = np.zeros(n, dtype=bool)
+    nxt_tail[:-1] = tail[1:]
+    # 閉じ括弧で終わる並びは、並びの中に文末記号がある場合だけ区切りにする
+    run_id = np.cumsum(~tail)
+    has_term = np.zeros(n + 1, dtype=bool)
+    has_term[run_id[is_term]] = True
+    pos = np.flatnonzero(tail & ~nxt_tail & has_term[run_id]) + 1
+
+    starts, ends = spans
+    if len(starts):
+        # 保護区間 (start, end) の内側にある区切りを除く
+        i = np.searchsorted(starts, pos, side="left") - 1
+        inside = (i >= 0) & (pos > starts[np.maximum(i, 0)]) & (pos < ends[np.maximum(i, 0)])
+        pos = pos[~inside]
+    return pos[pos < n]
+
+
+def _headings(text: str, fences: List[Tuple[int, int]]) -> Tuple[np.ndarray, List[List[str]]]:
+    """見出し行の開始位置と、その位置での見出しパス（上位の見出しを含む）を返す。"""
+    fence_starts = [s for s, _ in fences]
+    positions: List[int] = []
+    paths: List[List[str]] = []
+    stack: List[Tuple[int, str]] = []
+    for m in _HEADING_RE.finditer(text):
+        # コードブロック内の "# ..." は見出しではない
+        i = bisect_right(fence_starts, m.start()) - 1
+        if i >= 0 and m.start() < fences[i][1]:
+            continue
+        level = len(m.group(1))
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        stack.append((level, m.group(2).strip()))
+        positions.append(m.start())
+        paths.append([title for _, title in stack])
+    return np.array(positions, dtype="int64"), paths
+
+
+def structured_split(
+    text: str,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+    min_tokens: int = CHUNK_MIN_TOKENS,
+) -> List[Dict]:
+    """Markdown の見出しと文境界に沿って、トークン数の上限までまとめてチャンクにする。
+
+    文書全体を1回だけ tiktoken でエンコードし、文字位置ごとの累積トークン数を numpy で求めて
+    区切り位置を二分探索で選ぶ。見出しの位置では（チャンクが min_tokens 以上あれば）必ず区切り、
+    表・コードブロックは途中で切らない。1文が上限を超える場合だけトークン単位で切る。
+    トークン数は文書全体のエンコード結果から求めるため、チャンク単体でエンコードした値とは僅かにずれうる。
+
+    Args:
+        text: 文書のテキスト
+        max_tokens: 1チャンクの最大トークン数
+        overlap_tokens: 前のチャンクと重ねる最大トークン数（文単位）
+        min_tokens: これ未満のチャンクは次の見出しをまたいで続ける
+
+    Returns:
+        {"text", "heading_path", "start", "end", "tokens"} のリスト。start/end は text 内の文字位置
+    """
+    if not text.strip():
+        return []
+    cp, char_bytes = _char_byte_offsets(text)
+    n = len(cp)
+    tokens = np.asarray(get_encoding().encode_ordinary(text), dtype="int64")
+    token_ends = np.cumsum(_token_byte_lengths()[tokens])
+
+    fences = [m.span() for m in _FENCE_RE.finditer(text)]
+    heading_pos, heading_paths = _headings(text, fences)
+    bounds = np.union1d(_sentence_boundaries(cp, _protected_spans(text, fences)), heading_pos)
+    bounds = np.union1d(bounds, [0, n])
+    # 文字位置 -> その位置より前で終わるトークンの数
+    char_tokens = np.searchsorted(token_ends, char_bytes, side="right")
+    bound_tokens = char_tokens[bounds]
+
+    def tokens_at(pos: int) -> int:
+        return int(char_tokens[pos])
+
+    chunks: List[Dict] = []
+    start = 0
+    while start < n:
+        t0 = tokens_at(start)
+        # 上限に収まる最も遠い区切り
+        j = int(np.searchsorted(bound_tokens, t0 + max_tokens, side="right")) - 1
+        end = int(bounds[j]) if j >= 0 else start
+        if end <= start or (end < n and tokens_at(end) - t0 < min_tokens):
+            # 次の文が上限を超えて入らない場合は、上限のトークン位置で切る
+            limit = token_ends[min(len(token_ends), t0 + max_tokens) - 1] if len(token_ends) else char_bytes[n]
+            end = max(start + 1, int(np.searchsorted(char_bytes, limit, side="right")) - 1)
+            end = min(end, n)
+        # 見出しの位置で区切る（小さすぎるチャンクは次の節と合わせる）
+        h = np.searchsorted(heading_pos, start, side="right")
+        at_heading = False
+        while h < len(heading_pos) and heading_pos[h] < end:
+            if tokens_at(int(heading_pos[h])) - t0 >= min_tokens:
+                end = int(heading_pos[h])
+                at_heading = True
+                break
+            h += 1
+
+        piece = text[start:end]
+        stripped = piece.strip()
+        if stripped:
+            lead = len(piece) - len(piece.lstrip())
+            s, e = start + lead, start + lead + len(stripped)
+            k = int(np.searchsorted(heading_pos, s, side="right")) - 1
+            chunks.append(
+                {
+                    "text": stripped,
+                    "heading_path": heading_paths[k] if k >= 0 else [],
+                    "start": s,
+                    "end": e,
+                    "tokens": tokens_at(e) - tokens_at(s),
+                }
+            )
+        if end >= n:
+            break
+
+        # 次のチャンクは overlap_tokens 以内に収まる文から始める（見出しで区切った場合は重ねない）
+        next_start = end
+        if overlap_tokens > 0 and not at_heading:
+            t_end = tokens_at(end)
+            i = int(np.searchsorted(bound_tokens, t_end - overlap_tokens, side="left"))
+            if i < len(bounds) and start < bounds[i] < end:
+                next_start = int(bounds[i])
+        start = next_start
+    return chunks
+
+
+def chunker_spec() -> Dict:
+    """チャンク分割の設定。変わったら全件を分割し直す。"""
+    if CHUNKER == "simple":
+        return {"name": "simple", "max_chars": 800, "overlap": 100}
+    if CHUNKER == "structured":
+        return {
+            "name": "structured",
+            "max_tokens": CHUNK_MAX_TOKENS,
+            "overlap_tokens": CHUNK_OVERLAP_TOKENS,
+            "min_tokens": CHUNK_MIN_TOKENS,
+        }
+    raise ValueError(f"Unknown CHUNKER: {CHUNKER} (expected 'structured' or 'simple')")
+
+
+def split_document(text: str, source: str) -> Tuple[List[str], List[Dict]]:
+    """CHUNKER の設定で文書を分割し、(チャンク本文, メタデータ) を返す。"""
+    if chunker_spec()["name"] == "simple":
+        texts = simple_split(text)
+        return texts, [{"source": source, "chunk_id": idx} for idx in range(len(texts))]
+    chunks = structured_split(text)
+    metadatas = [
+        {
+            "source": source,
+            "chunk_id": idx,
+            "heading_path": c["heading_path"],
+            "start": c["start"],
+            "end": c["end"],
+            "tokens": c["tokens"],
+        }
+        for idx, c in enumerate(chunks)
+    ]
+    return [c["text"] for c in chunks], metadatas
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.config import EMBED_CACHE_ENABLED, EMBED_CACHE_PATH, EMBED_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+# SQLite のプレースホルダ数上限に収まるよう IN 句を分割する件数
+_SQL_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    text_hash BLOB NOT NULL,
+    vec BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (model, text_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used);
+"""
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """(モデル名, sha256(テキスト)) をキーに float32 ベクトルを保存する SQLite キャッシュ。
+
+    ingestion とクエリの両方から共有される。合計サイズが上限を超えたら
+    最終利用時刻の古いものから削除する。WAL モードなので複数プロセスから同時に使える。
+    """
+
+    def __init__(self, path: str | Path, model: str, max_bytes: int) -> None:
+        self.path = Path(path)
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0), COUNT(*) FROM embeddings").fetchone()
+        self._bytes, self._entries = int(row[0]), int(row[1])
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """texts と同じ順序でベクトル（未登録なら None）を返す。"""
+        keys = [text_key(t) for t in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), _SQL_CHUNK):
+                part = list(set(keys[i:i + _SQL_CHUNK]))
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vec FROM embeddings WHERE model = ? AND text_hash IN ({marks})",
+                    [self.model, *part],
+                ).fetchall()
+                for h, vec in rows:
+                    found[bytes(h)] = np.frombuffer(vec, dtype="float32")
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model, h) for h in found],
+                )
+                self._conn.commit()
+
+            results = [found.get(k) for k in keys]
+            hits = sum(1 for r in results if r is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        now = time.time()
+        rows = [(self.model, text_key(t), vectors[i].tobytes(), now) for i, t in enumerate(texts)]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vec, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            inserted = self._conn.total_changes - before
+            if inserted:
+                self._entries += inserted
+                self._bytes += inserted * vectors.shape[1] * 4
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """上限の 90% まで、最終利用時刻の古いエントリから削除する。"""
+        avg = self._bytes / max(1, self._entries)
+        n = int((self._bytes - self.max_bytes * 0.9) / max(1.0, avg)) + 1
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (n,),
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0), COUNT(*) FROM embeddings").fetchone()
+        self._bytes, self._entries = int(row[0]), int(row[1])
+        logger.info(f"Embedding cache evicted {n} entries ({self._bytes / 2**20:.1f} MB remaining)")
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._entries,
+            "bytes": self._bytes,
+        }
+
+
+# モデル名 -> キャッシュ。同じ DB ファイルを共有し、行はモデル名で区別する
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(model: str) -> Optional[EmbeddingCache]:
+    """プロセス内で共有する、モデルのキャッシュを返す。無効化されている場合は None。"""
+    if not EMBED_CACHE_ENABLED:
+        return None
+    cache = _caches.get(model)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(model)
+            if cache is None:
+                cache = _caches[model] = EmbeddingCache(EMBED_CACHE_PATH, model, EMBED_CACHE_MAX_MB * 2**20)
+    return cache
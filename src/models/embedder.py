@@ -1,14 +1,77 @@
-from openai import OpenAI
-from src.config import OPENAI_API_KEY, EMBED_MODEL
+import asyncio
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
 
-_client = None
+import numpy as np
+import tiktoken
 
+from src.config import (
+    EMBED_MODEL,
+    EMBED_BATCH_MAX_TOKENS,
+    EMBED_BATCH_MAX_ITEMS,
+    EMBED_MAX_WORKERS,
+    EMBED_MAX_RETRIES,
+    EMBED_BATCH_TIMEOUT,
+    EMBED_LOCAL_THREADS,
+    EMBED_LOCAL_BATCH_SIZE,
+    EMBED_LOCAL_QUANTIZE,
+    EMBED_LOCAL_MAX_WAIT_MS,
+)
+from src.models.embed_cache import get_cache
+from src.models import llm_client
 
-def get_client() -> OpenAI:
-    global _client
-    if _client is None:
-        _client = OpenAI(api_key=OPENAI_API_KEY)
-    return _client
+logger = logging.getLogger(__name__)
+
+# text-embedding-3-* が1入力あたり受け付ける最大トークン数
+EMBED_INPUT_MAX_TOKENS = 8191
+
+# クエリ経路（API）でのリトライ回数。対話用途なので ingestion より少なくする
+QUERY_MAX_RETRIES = 2
+
+# ローカル推論を選ぶ EMBED_MODEL の接頭辞
+LOCAL_MODEL_PREFIX = "local:"
+
+_backend_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_encoding() -> tiktoken.Encoding:
+    """EMBED_MODEL に対応する tiktoken エンコーディングを返す。"""
+    try:
+        return tiktoken.encoding_for_model(EMBED_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode_ordinary(text))
+
+
+@dataclass
+class EmbeddingStats:
+    """get_embeddings の実行統計。スループット表示に使う。"""
+
+    chunks: int = 0
+    cache_hits: int = 0
+    tokens: int = 0
+    requests: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.chunks / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
 
 
 def get_embedding(text: str) -> list[float]:
@@ -16,9 +79,341 @@ def get_embedding(text: str) -> list[float]:
 
     長文の場合は適宜前処理で分割してから渡すことを想定。
     """
-    client = get_client()
-    resp = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=text,
+    backend = get_backend()
+    cache = get_cache(backend.model_id)
+    if cache is not None:
+        cached = cache.get_many([text])[0]
+        if cached is not None:
+            return cached.tolist()
+
+    embedding = backend.embed_one(text)
+    if cache is not None:
+        cache.put_many([text], embedding.reshape(1, -1))
+    return embedding.tolist()
+
+
+async def aget_embedding(text: str) -> list[float]:
+    """get_embedding の非同期版。API サーバーのイベントループをブロックしない。
+
+    OpenAI の場合、同時リクエスト数は EMBED_MAX_CONCURRENCY、1リクエストのタイムアウトは EMBED_TIMEOUT。
+    """
+    backend = get_backend()
+    cache = get_cache(backend.model_id)
+    if cache is not None:
+        cached = (await asyncio.to_thread(cache.get_many, [text]))[0]
+        if cached is not None:
+            return cached.tolist()
+
+    embedding = await backend.aembed_one(text)
+    if cache is not None:
+        await asyncio.to_thread(cache.put_many, [text], embedding.reshape(1, -1))
+    return embedding.tolist()
+
+
+def _truncate(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """各テキストのトークン数を数え、上限を超えるものは切り詰める。"""
+    enc = get_encoding()
+    out: List[str] = []
+    counts: List[int] = []
+    for i, t in enumerate(texts):
+        # 空文字列は API がエラーを返すため空白1文字に置き換える
+        if not t:
+            t = " "
+        tokens = enc.encode_ordinary(t)
+        if len(tokens) > EMBED_INPUT_MAX_TOKENS:
+            logger.warning(f"Text #{i} has {len(tokens)} tokens; truncating to {EMBED_INPUT_MAX_TOKENS}")
+            tokens = tokens[:EMBED_INPUT_MAX_TOKENS]
+            t = enc.decode(tokens)
+        out.append(t)
+        counts.append(len(tokens))
+    return out, counts
+
+
+def _make_batches(token_counts: List[int], max_tokens: int, max_items: int) -> List[Tuple[int, int]]:
+    """入力順を保ったまま、トークン数・件数の上限内に収まる連続区間 [start, end) に分割する。"""
+    batches: List[Tuple[int, int]] = []
+    start = 0
+    tokens = 0
+    for i, n in enumerate(token_counts):
+        if i > start and (tokens + n > max_tokens or i - start >= max_items):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += n
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def _embed_batch(texts: List[str], tokens: int, stats: EmbeddingStats, lock: threading.Lock) -> np.ndarray:
+    def on_retry() -> None:
+        with lock:
+            stats.retries += 1
+
+    # レート制限・リトライは llm_client 側で行う
+    resp = llm_client.create_embeddings(
+        texts, EMBED_MODEL, tokens, EMBED_MAX_RETRIES, timeout=EMBED_BATCH_TIMEOUT, on_retry=on_retry
     )
-    return resp.data[0].embedding
\ No newline at end of file
+    with lock:
+        stats.requests += 1
+    # レスポンスの並びは index フィールドで保証されるため、それに従って並べ直す
+    data = sorted(resp.data, key=lambda d: d.index)
+    return np.asarray([d.embedding for d in data], dtype="float32")
+
+
+def get_embeddings(
+    texts: List[str],
+    max_workers: int = EMBED_MAX_WORKERS,
+    max_batch_tokens: int = EMBED_BATCH_MAX_TOKENS,
+    max_batch_items: int = EMBED_BATCH_MAX_ITEMS,
+    stats: Optional[EmbeddingStats] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> np.ndarray:
+    """複数テキストの埋め込みをまとめて取得する。
+
+    キャッシュ済みのテキストと、同一内容の重複テキストはバックエンドに渡さない。
+    OpenAI では残りをトークン数上限でバッチに詰めてから並列にリクエストし、
+    レート制限時はバックオフしてリトライする。戻り値の行の順序は texts と一致する。
+
+    Args:
+        texts: 埋め込み対象のテキスト
+        max_workers: 同時リクエスト数（OpenAI のみ）
+        max_batch_tokens: 1リクエストあたりの最大トークン数（OpenAI のみ）
+        max_batch_items: 1リクエストあたりの最大件数（OpenAI のみ）
+        stats: 指定すると件数・トークン数・経過時間などを書き込む
+        progress: (完了件数, 全件数) を受け取るコールバック
+
+    Returns:
+        shape (len(texts), dim) の float32 配列
+    """
+    stats = stats if stats is not None else EmbeddingStats()
+    if not texts:
+        return np.zeros((0, 0), dtype="float32")
+
+    started = time.perf_counter()
+    backend = get_backend()
+    cache = get_cache(backend.model_id)
+    cached = cache.get_many(texts) if cache is not None else [None] * len(texts)
+
+    # 未キャッシュのテキストを重複排除してバックエンドに渡す
+    pending: Dict[str, int] = {}
+    for t, vec in zip(texts, cached):
+        if vec is None and t not in pending:
+            pending[t] = len(pending)
+    unique = list(pending)
+
+    fetched = np.zeros((0, 0), dtype="float32")
+    if unique:
+        fetched = backend.embed(unique, stats, max_workers, max_batch_tokens, max_batch_items, progress)
+        if cache is not None:
+            cache.put_many(unique, fetched)
+    elif progress is not None:
+        progress(len(texts), len(texts))
+
+    dim = fetched.shape[1] if unique else next(v for v in cached if v is not None).shape[0]
+    out = np.empty((len(texts), dim), dtype="float32")
+    for i, (t, vec) in enumerate(zip(texts, cached)):
+        out[i] = vec if vec is not None else fetched[pending[t]]
+
+    stats.chunks += len(texts)
+    stats.cache_hits += sum(1 for v in cached if v is not None)
+    stats.seconds += time.perf_counter() - started
+    return out
+
+
+class EmbeddingBackend(ABC):
+    """埋め込みバックエンドの共通インターフェース。
+
+    キャッシュ・重複排除は get_embeddings 等の側で行い、バックエンドは渡されたテキストをそのまま埋め込む。
+    """
+
+    # キャッシュのキーとマニフェストに記録するモデル識別子
+    model_id: str
+
+    @abstractmethod
+    def embed(
+        self,
+        texts: List[str],
+        stats: EmbeddingStats,
+        max_workers: int,
+        max_batch_tokens: int,
+        max_batch_items: int,
+        progress: Optional[Callable[[int, int], None]],
+    ) -> np.ndarray:
+        """texts を埋め込み、(len(texts), 次元) の配列を返す。"""
+
+    @abstractmethod
+    def embed_one(self, text: str) -> np.ndarray:
+        """1件のテキスト（検索クエリ）を埋め込む。"""
+
+    @abstractmethod
+    async def aembed_one(self, text: str) -> np.ndarray:
+        """embed_one の非同期版。"""
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """OpenAI（互換）API の embeddings エンドポイントで埋め込む。"""
+
+    def __init__(self, model: str) -> None:
+        self.model_id = model
+
+    def embed(self, texts, stats, max_workers, max_batch_tokens, max_batch_items, progress) -> np.ndarray:
+        inputs, token_counts = _truncate(texts)
+        batches = _make_batches(token_counts, max_batch_tokens, max_batch_items)
+        logger.debug(f"Embedding {len(texts)} texts in {len(batches)} requests")
+
+        results: List[Optional[np.ndarray]] = [None] * len(batches)
+        lock = threading.Lock()
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {
+                pool.submit(_embed_batch, inputs[start:end], sum(token_counts[start:end]), stats, lock): b
+                for b, (start, end) in enumerate(batches)
+            }
+            for fut in as_completed(futures):
+                b = futures[fut]
+                results[b] = fut.result()
+                start, end = batches[b]
+                done += end - start
+                if progress is not None:
+                    progress(done, len(texts))
+        stats.tokens += sum(token_counts)
+        return np.vstack(results)
+
+    def embed_one(self, text: str) -> np.ndarray:
+        resp = llm_client.create_embeddings(text, self.model_id, count_tokens(text), EMBED_MAX_RETRIES)
+        return np.asarray(resp.data[0].embedding, dtype="float32")
+
+    async def aembed_one(self, text: str) -> np.ndarray:
+        resp = await llm_client.acreate_embeddings(text, self.model_id, count_tokens(text), QUERY_MAX_RETRIES)
+        return np.asarray(resp.data[0].embedding, dtype="float32")
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """sentence-transformers のモデルを CPU で推論して埋め込む。
+
+    推論は1度に1バッチだけ実行し、バッチ内の並列化は torch のスレッド（threads）に任せる。
+    クエリ経路の単発リクエストは専用スレッドのキューに積み、最大 max_wait_ms 待って
+    batch_size 件までまとめて推論する（動的バッチング）。
+    quantize="int8" の場合は Linear 層を動的量子化する。
+    """
+
+    def __init__(self, model_name: str, threads: int, batch_size: int, quantize: str, max_wait_ms: float) -> None:
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "Local embeddings require sentence-transformers: pip install sentence-transformers"
+            ) from e
+        if quantize not in ("", "int8"):
+            raise ValueError(f"Unknown EMBED_LOCAL_QUANTIZE: {quantize} (expected '' or 'int8')")
+
+        torch.set_num_threads(max(1, threads))
+        model = SentenceTransformer(model_name, device="cpu")
+        model.eval()
+        if quantize == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.model_id = LOCAL_MODEL_PREFIX + model_name + (f"+{quantize}" if quantize else "")
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        logger.info(
+            f"Loaded local embedding model {model_name} (threads={threads}, quantize={quantize or 'none'}, "
+            f"dim={model.get_sentence_embedding_dimension()})"
+        )
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        with self._lock:
+            vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+        return np.asarray(vectors, dtype="float32")
+
+    def embed(self, texts, stats, max_workers, max_batch_tokens, max_batch_items, progress) -> np.ndarray:
+        # 長さの近いテキストを同じバッチにしてパディングを減らし、元の順序に戻す
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        out = np.empty((len(texts), 0), dtype="float32")
+        step = self.batch_size * 8
+        for start in range(0, len(texts), step):
+            rows = order[start:start + step]
+            vectors = self._encode([texts[i] for i in rows])
+            if out.shape[1] == 0:
+                out = np.empty((len(texts), vectors.shape[1]), dtype="float32")
+            out[rows] = vectors
+            stats.requests += 1
+            if progress is not None:
+                progress(min(start + step, len(texts)), len(texts))
+        enc = get_encoding()
+        stats.tokens += sum(len(ids) for ids in enc.encode_ordinary_batch(texts))
+        return out
+
+    def _submit(self, text: str) -> Future:
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._batch_loop, name="embed-batcher", daemon=True)
+                    self._worker.start()
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def _batch_loop(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                vectors = self._encode([t for t, _ in items])
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), vec in zip(items, vectors):
+                fut.set_result(vec)
+
+    def embed_one(self, text: str) -> np.ndarray:
+        return self._submit(text).result()
+
+    async def aembed_one(self, text: str) -> np.ndarray:
+        return await asyncio.wrap_future(self._submit(text))
+
+
+_backend: Optional[EmbeddingBackend] = None
+
+
+def get_backend() -> EmbeddingBackend:
+    """EMBED_MODEL に応じたバックエンドを返す（プロセス内で共有）。"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if EMBED_MODEL.startswith(LOCAL_MODEL_PREFIX):
+                    _backend = LocalEmbeddingBackend(
+                        EMBED_MODEL[len(LOCAL_MODEL_PREFIX):],
+                        EMBED_LOCAL_THREADS,
+                        EMBED_LOCAL_BATCH_SIZE,
+                        EMBED_LOCAL_QUANTIZE,
+                        EMBED_LOCAL_MAX_WAIT_MS,
+                    )
+                else:
+                    _backend = OpenAIEmbeddingBackend(EMBED_MODEL)
+    return _backend
+
+
+def embed_model_id() -> str:
+    """インデックスを作った埋め込みモデルの識別子（マニフェストに記録する値）。
+
+    ローカルモデルを読み込まずに求められるよう、get_backend().model_id と同じ規則で組み立てる。
+    """
+    if EMBED_MODEL.startswith(LOCAL_MODEL_PREFIX) and EMBED_LOCAL_QUANTIZE:
+        return f"{EMBED_MODEL}+{EMBED_LOCAL_QUANTIZE}"
+    return EMBED_MODEL
@@ -0,0 +1,575 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+import tiktoken
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+
+from src.config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE,
+    LLM_MODEL,
+    LLM_MAX_CONCURRENCY,
+    LLM_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_DEADLINE,
+    LLM_RPM,
+    LLM_TPM,
+    LLM_EXPECTED_COMPLETION_TOKENS,
+    EMBED_MAX_CONCURRENCY,
+    EMBED_TIMEOUT,
+    EMBED_RPM,
+    EMBED_TPM,
+)
+
+logger = logging.getLogger(__name__)
+
+# リトライ対象の例外（レート制限・タイムアウト・一時的なサーバーエラー）
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+# 待ち時間・上流の所要時間の分位点を計算するために保持する直近のサンプル数
+_METRIC_SAMPLES = 2048
+
+_async_client: Optional[AsyncOpenAI] = None
+_sync_client: Optional[OpenAI] = None
+_client_lock = threading.Lock()
+
+
+def get_async_client() -> AsyncOpenAI:
+    """プロセス内で共有する AsyncOpenAI クライアントを返す。
+
+    embeddings と chat completions で同じ HTTP コネクションプールを使い、
+    同時接続数の上限は HTTP_MAX_CONNECTIONS で制御する。
+    タイムアウトとリトライはこのモジュールの呼び出し関数で上流ごとに制御する。
+    """
+    global _async_client
+    if _async_client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+        _async_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            http_client=http_client,
+            max_retries=0,
+        )
+    return _async_client
+
+
+def get_sync_client() -> OpenAI:
+    """スレッドから使う同期クライアント（ingestion・answer_many・評価スクリプト用）。"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    ),
+                )
+                _sync_client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    base_url=OPENAI_BASE_URL,
+                    http_client=http_client,
+                    max_retries=0,
+                )
+    return _sync_client
+
+
+async def aclose() -> None:
+    """API サーバー終了時にコネクションプールを閉じる。"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+@lru_cache(maxsize=1)
+def get_llm_encoding() -> tiktoken.Encoding:
+    """LLM_MODEL に対応する tiktoken エンコーディングを返す。"""
+    try:
+        return tiktoken.encoding_for_model(LLM_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """chat のプロンプトトークン数の概算（メッセージごとの区切りを含む）。"""
+    enc = get_llm_encoding()
+    return sum(len(enc.encode_ordinary(m.get("content") or "")) + 4 for m in messages) + 2
+
+
+class TokenBucket:
+    """1分あたり per_minute 単位が補充されるトークンバケット。
+
+    reserve は残量が足りなくても即座に差し引いて（負の残量を許して）待つべき秒数を返すので、
+    同期・非同期のどちらの呼び出し側も、その秒数だけ眠れば順番どおりに流れる。
+    per_minute が 0 以下なら制限しない。
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, delta: float) -> None:
+        """予約した量と実際の消費量の差を反映する（delta > 0 で追加消費）。"""
+        if self.rate <= 0 or delta == 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= delta
+
+
+class UpstreamMetrics:
+    """上流ごとの呼び出し統計。キュー待ち（レート制限・同時実行数の待ち）と上流の所要時間を分けて記録する。"""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.deadline_exceeded = 0
+        self.queue_wait: deque = deque(maxlen=_METRIC_SAMPLES)
+        self.upstream: deque = deque(maxlen=_METRIC_SAMPLES)
+        self._lock = threading.Lock()
+
+    def observe(self, queue_wait: float, upstream: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.queue_wait.append(queue_wait)
+            self.upstream.append(upstream)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    @staticmethod
+    def _summary(samples: List[float]) -> Dict:
+        if not samples:
+            return {"avg_ms": 0.0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        arr = np.asarray(samples, dtype="float64") * 1000
+        return {
+            "avg_ms": float(arr.mean()),
+            "p50_ms": float(np.percentile(arr, 50)),
+            "p99_ms": float(np.percentile(arr, 99)),
+            "max_ms": float(arr.max()),
+        }
+
+    def stats(self) -> Dict:
+        with self._lock:
+            queue_wait, upstream = list(self.queue_wait), list(self.upstream)
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "deadline_exceeded": self.deadline_exceeded,
+            "queue_wait": self._summary(queue_wait),
+            "upstream": self._summary(upstream),
+        }
+
+
+class Upstream:
+    """1つの上流 API（chat / embeddings）のレート制限・同時実行数・タイムアウト・統計。"""
+
+    def __init__(self, name: str, rpm: float, tpm: float, max_concurrency: int, timeout: float) -> None:
+        self.name = name
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.metrics = UpstreamMetrics()
+        self.sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+
+    def async_semaphore(self) -> asyncio.Semaphore:
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._async_semaphore
+
+    def reserve(self, tokens: int) -> float:
+        return max(self.rpm.reserve(1), self.tpm.reserve(tokens))
+
+
+chat_upstream = Upstream("chat", LLM_RPM, LLM_TPM, LLM_MAX_CONCURRENCY, LLM_TIMEOUT)
+embeddings_upstream = Upstream("embeddings", EMBED_RPM, EMBED_TPM, EMBED_MAX_CONCURRENCY, EMBED_TIMEOUT)
+
+
+def retry_delay(attempt: int, err: Exception) -> float:
+    """Retry-After ヘッダがあればそれに従い、なければ指数バックオフ（full jitter）。"""
+    response = getattr(err, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after) * (1.0 + 0.2 * random.random())
+            except ValueError:
+                pass
+    return random.uniform(0, min(30.0, 0.5 * (2 ** attempt)))
+
+
+class _Call:
+    """1回の論理呼び出し（リトライを含む）の期限と統計の記録を受け持つ。"""
+
+    def __init__(
+        self,
+        upstream: Upstream,
+        tokens: int,
+        deadline: Optional[float],
+        retries: int,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.upstream = upstream
+        self.tokens = tokens
+        self.retries = retries
+        self.timeout = timeout or upstream.timeout
+        self.started = time.monotonic()
+        self.expires = self.started + deadline if deadline else None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def check_wait(self, wait: float) -> None:
+        """wait 秒待つと期限を過ぎるなら、待たずに TimeoutError にする。"""
+        remaining = self.remaining()
+        if remaining is not None and wait >= remaining:
+            self.upstream.metrics.count("deadline_exceeded")
+            raise TimeoutError(f"{self.upstream.name} call would exceed its deadline (wait {wait:.1f}s)")
+
+    def attempt_timeout(self) -> float:
+        remaining = self.remaining()
+        return self.timeout if remaining is None else max(0.01, min(self.timeout, remaining))
+
+    def on_error(self, attempt: int, err: Exception) -> float:
+        """リトライするなら待つ秒数を返し、しないなら例外を送出し直す。"""
+        metrics = self.upstream.metrics
+        if isinstance(err, RateLimitError):
+            metrics.count("rate_limited")
+        if not isinstance(err, RETRYABLE_ERRORS) or attempt >= self.retries:
+            metrics.count("errors")
+            raise err
+        delay = retry_delay(attempt, err)
+        self.check_wait(delay)
+        metrics.count("retries")
+        logger.warning(f"{self.upstream.name} request failed ({type(err).__name__}); retrying in {delay:.1f}s")
+        return delay
+
+    def reconcile(self, resp) -> None:
+        # 予約したトークン数（概算）と usage の実数の差を TPM バケットに反映する
+        usage = getattr(resp, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total is not None:
+            self.upstream.tpm.adjust(total - self.tokens)
+
+
+def _call_sync(
+    upstream: Upstream,
+    fn: Callable[[float], object],
+    tokens: int,
+    deadline: Optional[float],
+    retries: int,
+    timeout: Optional[float] = None,
+    on_retry: Optional[Callable[[], None]] = None,
+):
+    call = _Call(upstream, tokens, deadline, retries, timeout)
+    attempt = 0
+    while True:
+        queued = time.monotonic()
+        wait = upstream.reserve(tokens)
+        call.check_wait(wait)
+        time.sleep(wait)
+        remaining = call.remaining()
+        if not upstream.sync_semaphore.acquire(timeout=remaining):
+            call.check_wait(float("inf"))
+        try:
+            sent = time.monotonic()
+            resp = fn(call.attempt_timeout())
+            upstream.metrics.observe(sent - queued, time.monotonic() - sent)
+            call.reconcile(resp)
+            return resp
+        except Exception as e:
+            delay = call.on_error(attempt, e)
+        finally:
+            upstream.sync_semaphore.release()
+        if on_retry is not None:
+            on_retry()
+        time.sleep(delay)
+        attempt += 1
+
+
+async def _call_async(
+    upstream: Upstream,
+    fn: Callable[[float], Awaitable[object]],
+    tokens: int,
+    deadline: Optional[float],
+    retries: int,
+):
+    call = _Call(upstream, tokens, deadline, retries)
+    attempt = 0
+    while True:
+        queued = time.monotonic()
+        wait = upstream.reserve(tokens)
+        call.check_wait(wait)
+        await asyncio.sleep(wait)
+        try:
+            await asyncio.wait_for(upstream.async_semaphore().acquire(), call.remaining())
+        except asyncio.TimeoutError:
+            call.check_wait(float("inf"))
+        try:
+            sent = time.monotonic()
+            resp = await fn(call.attempt_timeout())
+            upstream.metrics.observe(sent - queued, time.monotonic() - sent)
+            call.reconcile(resp)
+            return resp
+        except Exception as e:
+            delay = call.on_error(attempt, e)
+        finally:
+            upstream.async_semaphore().release()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def _flight_key(kind: str, model: str, payload) -> str:
+    raw = json.dumps([kind, model, payload], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# 実行中の同一リクエスト（single-flight）。同期はスレッド間、非同期はイベントループごとに共有する
+_sync_flights: Dict[str, Future] = {}
+_sync_flights_lock = threading.Lock()
+_async_flights: Dict[Tuple[int, str], asyncio.Task] = {}
+
+
+def _single_flight_sync(upstream: Upstream, key: str, run: Callable[[], object]):
+    with _sync_flights_lock:
+        fut = _sync_flights.get(key)
+        leader = fut is None
+        if leader:
+            fut = _sync_flights[key] = Future()
+    if not leader:
+        upstream.metrics.count("coalesced")
+        return fut.result()
+    try:
+        result = run()
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _sync_flights_lock:
+            _sync_flights.pop(key, None)
+
+
+async def _single_flight_async(upstream: Upstream, key: str, run: Callable[[], Awaitable[object]]):
+    flight = (id(asyncio.get_running_loop()), key)
+    task = _async_flights.get(flight)
+    if task is None:
+        task = asyncio.ensure_future(run())
+        _async_flights[flight] = task
+
+        def _done(t: asyncio.Task) -> None:
+            if _async_flights.get(flight) is t:
+                del _async_flights[flight]
+            # 待っている呼び出し元がすべてキャンセルされた場合の未回収例外の警告を抑える
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+    else:
+        upstream.metrics.count("coalesced")
+    # 呼び出し元がキャンセルされても、同じリクエストを待つ他の呼び出し元のために実行を続ける
+    return await asyncio.shield(task)
+
+
+def chat(messages: List[Dict], model: str = LLM_MODEL, deadline: Optional[float] = LLM_DEADLINE):
+    """chat completions を呼ぶ（同期）。実行中の同一リクエストとは1回の呼び出しを共有する。
+
+    Args:
+        messages: chat のメッセージ
+        model: モデル名
+        deadline: キュー待ち・リトライを含めた全体の期限（秒）。None なら無制限
+
+    Returns:
+        ChatCompletion
+    """
+    tokens = count_message_tokens(messages) + LLM_EXPECTED_COMPLETION_TOKENS
+    client = get_sync_client()
+
+    def run():
+        return _call_sync(
+            chat_upstream,
+            lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+                model=model, messages=messages
+            ),
+            tokens,
+            deadline,
+            LLM_MAX_RETRIES,
+        )
+
+    return _single_flight_sync(chat_upstream, _flight_key("chat", model, messages), run)
+
+
+async def achat(messages: List[Dict], model: str = LLM_MODEL, deadline: Optional[float] = LLM_DEADLINE):
+    """chat の非同期版。"""
+    tokens = count_message_tokens(messages) + LLM_EXPECTED_COMPLETION_TOKENS
+    client = get_async_client()
+
+    def run():
+        return _call_async(
+            chat_upstream,
+            lambda timeout: client.with_options(timeout=timeout).chat.completions.create(
+                model=model, messages=messages
+            ),
+            tokens,
+            deadline,
+            LLM_MAX_RETRIES,
+        )
+
+    return await _single_flight_async(chat_upstream, _flight_key("chat", model, messages), run)
+
+
+async def astream_chat(
+    messages: List[Dict], model: str = LLM_MODEL, deadline: Optional[float] = LLM_DEADLINE
+) -> AsyncIterator:
+    """chat completions をストリーミングで呼び、チャンクを順に yield する。
+
+    リトライはストリームの開始まで。同時実行数の枠はストリームを読み終えるまで保持する。
+    ストリームは呼び出し元ごとに独立なので single-flight の対象外。
+    """
+    upstream = chat_upstream
+    call = _Call(upstream, count_message_tokens(messages) + LLM_EXPECTED_COMPLETION_TOKENS, deadline,
+                 LLM_MAX_RETRIES)
+    client = get_async_client()
+    attempt = 0
+    while True:
+        queued = time.monotonic()
+        wait = upstream.reserve(call.tokens)
+        call.check_wait(wait)
+        await asyncio.sleep(wait)
+        try:
+            await asyncio.wait_for(upstream.async_semaphore().acquire(), call.remaining())
+        except asyncio.TimeoutError:
+            call.check_wait(float("inf"))
+        try:
+            sent = time.monotonic()
+            try:
+                stream = await client.with_options(timeout=call.attempt_timeout()).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            except Exception as e:
+                delay = call.on_error(attempt, e)
+            else:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        call.reconcile(chunk)
+                    yield chunk
+                upstream.metrics.observe(sent - queued, time.monotonic() - sent)
+                return
+        finally:
+            upstream.async_semaphore().release()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def create_embeddings(
+    inputs,
+    model: str,
+    tokens: int,
+    retries: int,
+    timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    on_retry: Optional[Callable[[], None]] = None,
+):
+    """embeddings を呼ぶ（同期）。実行中の同一リクエストとは1回の呼び出しを共有する。
+
+    Args:
+        inputs: テキストまたはテキストのリスト
+        model: モデル名
+        tokens: 入力のトークン数（TPM の制限に使う）
+        retries: 最大リトライ回数
+        timeout: 1回のリクエストのタイムアウト（None なら EMBED_TIMEOUT）
+        deadline: リトライを含めた全体の期限（秒）
+        on_retry: リトライのたびに呼ばれる
+    """
+    client = get_sync_client()
+
+    def run():
+        return _call_sync(
+            embeddings_upstream,
+            lambda t: client.with_options(timeout=t).embeddings.create(model=model, input=inputs),
+            tokens,
+            deadline,
+            retries,
+            timeout,
+            on_retry,
+        )
+
+    return _single_flight_sync(embeddings_upstream, _flight_key("embeddings", model, inputs), run)
+
+
+async def acreate_embeddings(inputs, model: str, tokens: int, retries: int, deadline: Optional[float] = None):
+    """create_embeddings の非同期版。"""
+    client = get_async_client()
+
+    def run():
+        return _call_async(
+            embeddings_upstream,
+            lambda timeout: client.with_options(timeout=timeout).embeddings.create(model=model, input=inputs),
+            tokens,
+            deadline,
+            retries,
+        )
+
+    return await _single_flight_async(embeddings_upstream, _flight_key("embeddings", model, inputs), run)
+
+
+def stats() -> Dict:
+    """上流ごとの呼び出し統計（キュー待ちと上流の所要時間を分けた分位点を含む）。"""
+    return {"chat": chat_upstream.metrics.stats(), "embeddings": embeddings_upstream.metrics.stats()}
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+import numpy as np
+try:
+    import faiss
+except ImportError:
+    # faiss-cpu の場合
+    from faiss import swigfaiss as faiss
+
+from src.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_MAX_ENTRIES,
+)
+from src.rag.collections import DEFAULT_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    answer: str
+    docs: List[Dict]
+    created: float
+    # 類似度（lookup で返すときに設定）
+    similarity: float = 0.0
+
+
+class SemanticAnswerCache:
+    """クエリ埋め込みの近さで回答を再利用するインメモリキャッシュ。
+
+    埋め込みは専用の小さな FAISS インデックス（正規化ベクトルの内積）に保持し、
+    最も近い過去の質問とのコサイン類似度が threshold 以上なら、その回答と参照ドキュメントを返す。
+    エントリは TTL で失効し、件数が上限を超えたら最終利用の古いものから削除する。
+    ベクトルストアのバージョンが変わったら全エントリを破棄する。
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidations = 0
+        self._index = None
+        # ID -> エントリ（先頭ほど最終利用が古い）
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, version: Optional[str]) -> None:
+        if version != self.version:
+            if self._entries:
+                logger.info(f"Vector store version changed ({self.version} -> {version}); clearing answer cache")
+                self.invalidations += 1
+            self._clear()
+            self.version = version
+
+    def _clear(self) -> None:
+        if self._index is not None:
+            self._index.reset()
+        self._entries.clear()
+
+    def _remove(self, ids: List[int]) -> None:
+        for i in ids:
+            del self._entries[i]
+        self._index.remove_ids(np.asarray(ids, dtype="int64"))
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vec = np.array(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def lookup(self, embedding, version: Optional[str]) -> Optional[CachedAnswer]:
+        """類似度が閾値以上の有効なエントリを返す。なければ None。"""
+        vec = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            if not self._entries:
+                self.misses += 1
+                return None
+            sims, ids = self._index.search(vec, 1)
+            sim, entry_id = float(sims[0][0]), int(ids[0][0])
+            if entry_id < 0 or sim < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[entry_id]
+            if now - entry.created > self.ttl:
+                self._remove([entry_id])
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return replace(entry, similarity=sim)
+
+    def store(self, embedding, query: str, answer: str, docs: List[Dict], version: Optional[str]) -> None:
+        vec = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_version(version)
+            if self._index is None or self._index.d != vec.shape[1]:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+                self._entries.clear()
+            self._purge_expired(now)
+            if len(self._entries) >= self.max_entries:
+                n = len(self._entries) - self.max_entries + 1
+                self._remove([i for i, _ in zip(self._entries, range(n))])
+                self.evicted += n
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vec, np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = CachedAnswer(query=query, answer=answer, docs=docs, created=now)
+
+    def _purge_expired(self, now: float) -> None:
+        stale = [i for i, e in self._entries.items() if now - e.created > self.ttl]
+        if stale:
+            self._remove(stale)
+            self.expired += len(stale)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "invalidations": self.invalidations,
+            "version": self.version,
+        }
+
+
+# コレクション名 -> キャッシュ。別のコレクションの回答を返さないよう、コレクションごとに分ける
+_caches: Dict[str, SemanticAnswerCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_answer_cache(collection: str = DEFAULT_COLLECTION) -> Optional[SemanticAnswerCache]:
+    """プロセス内で共有する、コレクションのキャッシュを返す。無効化されている場合は None。"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    cache = _caches.get(collection)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(collection)
+            if cache is None:
+                cache = _caches[collection] = SemanticAnswerCache(
+                    ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES
+                )
+    return cache
+
+
+def answer_caches() -> Dict[str, SemanticAnswerCache]:
+    """作成済みのキャッシュ（コレクション名 -> キャッシュ）。"""
+    with _caches_lock:
+        return dict(sorted(_caches.items()))
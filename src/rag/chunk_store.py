@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import shutil
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+CHUNK_STORE_FORMAT = 1
+
+
+# ファイル構成
+#   header.json       件数・フォーマット
+#   ids.npy           int64 チャンクID（昇順）
+#   text_offsets.bin  int64 (n+1,) text.bin 内のバイトオフセット（リトルエンディアン）
+#   text.bin          UTF-8 テキストを連結したもの
+#   meta_offsets.bin  int64 (n+1,) meta.bin 内のバイトオフセット（リトルエンディアン）
+#   meta.bin          1行ごとのメタデータ（区切りなしの compact JSON）を連結したもの
+
+
+class ChunkStore:
+    """チャンク本文とメタデータを保持する読み取り専用ストア。
+
+    すべて mmap で開くため、起動時に本文を読み込まず、複数ワーカー間では
+    OS のページキャッシュが共有される。取り出した行だけが文字列に変換される。
+    """
+
+    def __init__(self, directory: str | Path) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "header.json", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != CHUNK_STORE_FORMAT:
+            raise ValueError(f"Unsupported chunk store format in {self.directory}")
+
+        self.ids: np.ndarray = np.load(self.directory / "ids.npy", mmap_mode="r")
+        # オフセットは memoryview 経由で参照し、1行ごとの取り出しで numpy のオーバーヘッドを避ける
+        self._text_offsets = _open_offsets(self.directory / "text_offsets.bin")
+        self._meta_offsets = _open_offsets(self.directory / "meta_offsets.bin")
+        self._text = _open_blob(self.directory / "text.bin")
+        self._meta = _open_blob(self.directory / "meta.bin")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rows_of(self, ids: np.ndarray) -> np.ndarray:
+        """チャンクIDを行番号に変換する。存在しないIDは -1。"""
+        ids = np.asarray(ids, dtype="int64")
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype="int64")
+        rows = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[rows] == ids, rows, -1)
+
+    def text_bytes(self, row: int) -> bytes:
+        return self._text[self._text_offsets[row]:self._text_offsets[row + 1]]
+
+    def meta_bytes(self, row: int) -> bytes:
+        return self._meta[self._meta_offsets[row]:self._meta_offsets[row + 1]]
+
+    def text(self, row: int) -> str:
+        return self.text_bytes(row).decode("utf-8")
+
+    def metadata(self, row: int) -> Dict:
+        return json.loads(self.meta_bytes(row))
+
+    def get(self, row: int) -> Dict:
+        return {"text": self.text(row), "metadata": self.metadata(row)}
+
+    def iter_rows(self) -> Iterable[Dict]:
+        for row in range(len(self)):
+            yield self.get(row)
+
+
+def _open_blob(path: Path):
+    """読み取り専用で mmap する。スライスは bytes を返すので np.memmap より取り出しが速い。"""
+    # 空ファイルは mmap できないため空の bytes で代用する
+    if path.stat().st_size == 0:
+        return b""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # 検索結果はランダムアクセスになるため、先読みで不要なページを載せないようにする
+    if hasattr(mmap, "MADV_RANDOM"):
+        mm.madvise(mmap.MADV_RANDOM)
+    return mm
+
+
+def _open_offsets(path: Path) -> memoryview:
+    return memoryview(_open_blob(path)).cast("q")
+
+
+class ChunkStoreWriter:
+    """チャンクストアを一時ディレクトリに追記しながら書き出し、commit で置き換える。
+
+    本文・メタデータは append のたびにファイルへ書き出すため、メモリに残るのはIDとオフセットだけ。
+    base が指定された場合は keep_rows の行をバイト列のままコピーし（デコードしない）、
+    その後ろに新しいチャンクを追加する。IDは昇順である必要がある。
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        base: Optional[ChunkStore] = None,
+        keep_rows: Optional[np.ndarray] = None,
+    ) -> None:
+        self.directory = Path(directory)
+        self._tmp_dir = self.directory.with_name(self.directory.name + ".tmp")
+        if self._tmp_dir.exists():
+            shutil.rmtree(self._tmp_dir)
+        self._tmp_dir.mkdir(parents=True)
+
+        self._ids = array("q")
+        self._text_offsets = array("q", [0])
+        self._meta_offsets = array("q", [0])
+        self._ft = open(self._tmp_dir / "text.bin", "wb")
+        self._fm = open(self._tmp_dir / "meta.bin", "wb")
+
+        if base is not None:
+            if keep_rows is None:
+                keep_rows = np.arange(len(base))
+            for old_row in keep_rows:
+                self._write(int(base.ids[old_row]), base.text_bytes(old_row), base.meta_bytes(old_row))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _write(self, chunk_id: int, tb: bytes, mb: bytes) -> None:
+        if self._ids and chunk_id <= self._ids[-1]:
+            raise ValueError("chunk ids must be strictly increasing")
+        self._ft.write(tb)
+        self._fm.write(mb)
+        self._ids.append(chunk_id)
+        self._text_offsets.append(self._text_offsets[-1] + len(tb))
+        self._meta_offsets.append(self._meta_offsets[-1] + len(mb))
+
+    def append(self, ids: List[int], texts: List[str], metadatas: List[Dict]) -> None:
+        for chunk_id, text, meta in zip(ids, texts, metadatas):
+            self._write(
+                chunk_id,
+                text.encode("utf-8"),
+                json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+            )
+
+    def commit(self) -> None:
+        self._ft.close()
+        self._fm.close()
+        tmp_dir = self._tmp_dir
+        np.save(tmp_dir / "ids.npy", np.frombuffer(self._ids, dtype="int64") if self._ids else np.zeros(0, "int64"))
+        np.frombuffer(self._text_offsets, dtype="int64").astype("<i8").tofile(tmp_dir / "text_offsets.bin")
+        np.frombuffer(self._meta_offsets, dtype="int64").astype("<i8").tofile(tmp_dir / "meta_offsets.bin")
+        with open(tmp_dir / "header.json", "w", encoding="utf-8") as f:
+            json.dump({"format": CHUNK_STORE_FORMAT, "count": len(self._ids)}, f)
+
+        replace_directory(tmp_dir, self.directory)
+
+    def abort(self) -> None:
+        self._ft.close()
+        self._fm.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def replace_directory(tmp_dir: Path, directory: Path) -> None:
+    """書き込み済みの一時ディレクトリで directory を置き換える。
+
+    旧ディレクトリを退避してから差し替える（POSIX では mmap 中の旧ファイルはそのまま読める）。
+    """
+    old_dir = directory.with_name(directory.name + ".old")
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+    if directory.exists():
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def write_chunk_store(
+    directory: str | Path,
+    new_ids: List[int],
+    new_texts: List[str],
+    new_metadatas: List[Dict],
+    base: Optional[ChunkStore] = None,
+    keep_rows: Optional[np.ndarray] = None,
+) -> None:
+    """チャンクストアを一度に書き出す（ChunkStoreWriter の簡易版）。"""
+    writer = ChunkStoreWriter(directory, base=base, keep_rows=keep_rows)
+    try:
+        writer.append(new_ids, new_texts, new_metadatas)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
@@ -0,0 +1,208 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from src.config import (
+    RAW_DATA_DIR,
+    VECTORSTORE_DIR,
+    COLLECTIONS_DIR,
+    COLLECTION_MEMORY_MB,
+    COLLECTION_PREWARM,
+    INDEX_RELOAD_INTERVAL,
+)
+from src.rag.retriever import Retriever, RetrieverHolder
+from src.rag.snapshots import current_snapshot
+
+logger = logging.getLogger(__name__)
+
+# 名前を省略したときのコレクション（RAW_DATA_DIR / VECTORSTORE_DIR）
+DEFAULT_COLLECTION = "default"
+# パスの一部になるため、英数字・"_"・"-" のみ（先頭は英数字）
+_NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_-]{0,63}")
+
+
+@dataclass(frozen=True)
+class Collection:
+    """名前付きのコレクション。文書の置き場所（raw_dir）とベクトルストア（store_dir）の組。"""
+
+    name: str
+    raw_dir: Path
+    store_dir: Path
+
+
+def get_collection(name: Optional[str] = None) -> Collection:
+    """コレクション名からディレクトリを決める。名前が不正なら ValueError。
+
+    None と "default" は RAW_DATA_DIR / VECTORSTORE_DIR、
+    それ以外は COLLECTIONS_DIR/<名前>/raw と COLLECTIONS_DIR/<名前>/vectorstore。
+    """
+    if name is None or name == DEFAULT_COLLECTION:
+        return Collection(DEFAULT_COLLECTION, RAW_DATA_DIR, VECTORSTORE_DIR)
+    if not _NAME_PATTERN.fullmatch(name):
+        raise ValueError(
+            f"Invalid collection name: {name!r} "
+            "(up to 64 letters, digits, '_' or '-', starting with a letter or digit)"
+        )
+    return Collection(name, COLLECTIONS_DIR / name / "raw", COLLECTIONS_DIR / name / "vectorstore")
+
+
+def list_collections() -> List[str]:
+    """インデックスが公開済みのコレクション名（default を先頭に、あとは名前順）。"""
+    names = [DEFAULT_COLLECTION] if current_snapshot(VECTORSTORE_DIR) is not None else []
+    if COLLECTIONS_DIR.is_dir():
+        for path in sorted(COLLECTIONS_DIR.iterdir()):
+            if _NAME_PATTERN.fullmatch(path.name) and current_snapshot(path / "vectorstore") is not None:
+                names.append(path.name)
+    return names
+
+
+class CollectionManager:
+    """コレクションごとの RetrieverHolder を、メモリ予算の範囲で必要になったときに読み込んで保持する。
+
+    最初に質問されたときに読み込み、常駐している FAISS インデックスの合計が budget_bytes を超えたら、
+    最後に使われたのが古いコレクションから解放する（LRU）。pinned のコレクションは解放しない。
+    解放しても、処理中のリクエストは取得済みの Retriever を最後まで使える。
+    常駐中のコレクションは1本のスレッドでまとめて current ポインタを確認し、変わっていれば差し替える。
+    """
+
+    def __init__(
+        self,
+        budget_bytes: float = COLLECTION_MEMORY_MB * 2**20,
+        pinned: Sequence[str] = COLLECTION_PREWARM,
+        interval: float = INDEX_RELOAD_INTERVAL,
+    ) -> None:
+        self.budget_bytes = budget_bytes
+        self.pinned = {get_collection(name).name for name in pinned}
+        self.interval = interval
+        # 名前 -> RetrieverHolder（末尾ほど最近使われた）
+        self._holders: "OrderedDict[str, RetrieverHolder]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 同じコレクションを同時に2回読み込まないための名前ごとのロック
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_resident(self, name: Optional[str] = None) -> Optional[Retriever]:
+        """常駐していればその Retriever を返し、いなければ None（読み込みはしない）。"""
+        name = get_collection(name).name
+        with self._lock:
+            holder = self._holders.get(name)
+            if holder is None:
+                return None
+            self._holders.move_to_end(name)
+            self.hits += 1
+        return holder.get()
+
+    def holder(self, name: Optional[str] = None) -> RetrieverHolder:
+        """コレクションの RetrieverHolder。常駐していなければ読み込む（インデックスがなければ FileNotFoundError）。"""
+        collection = get_collection(name)
+        with self._lock:
+            holder = self._holders.get(collection.name)
+            if holder is not None:
+                self._holders.move_to_end(collection.name)
+                self.hits += 1
+                return holder
+            load_lock = self._load_locks.setdefault(collection.name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                holder = self._holders.get(collection.name)
+                if holder is not None:
+                    self.hits += 1
+                    return holder
+                self.misses += 1
+            started = time.perf_counter()
+            holder = RetrieverHolder(collection.store_dir, interval=0)
+            with self._lock:
+                self._holders[collection.name] = holder
+                self.loads += 1
+                self._evict(keep=collection.name)
+            logger.info(
+                f"Loaded collection {collection.name} ({holder.get().version}, {len(holder.get().store)} chunks, "
+                f"{holder.memory_bytes / 2**20:.1f}MB) in {time.perf_counter() - started:.2f}s"
+            )
+        return holder
+
+    def get(self, name: Optional[str] = None) -> Retriever:
+        """コレクションの Retriever。1つのリクエストの中では最初に取得したものを使い続けること。"""
+        return self.holder(name).get()
+
+    def _evict(self, keep: str) -> None:
+        """予算を超えていれば、古いものから解放する。self._lock を持って呼ぶ。"""
+        used = sum(h.memory_bytes for h in self._holders.values())
+        for name in list(self._holders):
+            if used <= self.budget_bytes:
+                return
+            if name == keep or name in self.pinned:
+                continue
+            holder = self._holders.pop(name)
+            used -= holder.memory_bytes
+            self.evictions += 1
+            logger.info(f"Evicted collection {name} ({holder.memory_bytes / 2**20:.1f}MB) to stay within budget")
+        if used > self.budget_bytes:
+            logger.warning(
+                f"Resident collections use {used / 2**20:.1f}MB, over COLLECTION_MEMORY_MB "
+                f"({self.budget_bytes / 2**20:.0f}MB); only pinned or in-use collections remain"
+            )
+
+    def prewarm(self) -> None:
+        """pinned のコレクションを読み込んでおく。インデックスがないものは警告して飛ばす。"""
+        for name in sorted(self.pinned, key=lambda n: n != DEFAULT_COLLECTION):
+            try:
+                self.holder(name)
+            except FileNotFoundError as e:
+                logger.warning(f"Cannot prewarm collection {name}: {e}")
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                holders = list(self._holders.values())
+            for holder in holders:
+                holder.check()
+
+    def start(self) -> None:
+        """常駐中のコレクションの current ポインタの監視を始める。interval が 0 以下なら何もしない。"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="index-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            holders = list(self._holders.items())
+            counters = {"loads": self.loads, "evictions": self.evictions, "hits": self.hits, "misses": self.misses}
+        resident = {}
+        for name, holder in holders:
+            retriever = holder.get()
+            resident[name] = {
+                "index_version": retriever.version,
+                "snapshot": retriever.index_dir.name,
+                "chunks": len(retriever.store),
+                "memory_mb": round(holder.memory_bytes / 2**20, 1),
+                "pinned": name in self.pinned,
+                "loaded_at": holder.loaded_at,
+                "reloads": holder.reloads,
+                "last_reload_error": holder.last_error,
+            }
+        return {
+            "resident": resident,
+            "budget_mb": round(self.budget_bytes / 2**20, 1),
+            "used_mb": round(sum(h.memory_bytes for _, h in holders) / 2**20, 1),
+            **counters,
+        }
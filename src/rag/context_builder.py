@@ -0,0 +1,171 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from src.config import CONTEXT_MAX_TOKENS, CONTEXT_DEDUP_THRESHOLD, CONTEXT_MIN_PASSAGE_TOKENS
+from src.models.llm_client import get_llm_encoding
+
+logger = logging.getLogger(__name__)
+
+# 重複判定に使う文字 n-gram の長さ
+_SHINGLE = 5
+
+
+@dataclass
+class Passage:
+    """コンテキストに入れる1区間。同じファイルの隣接・重複チャンクをまとめたもの。"""
+
+    source: str
+    text: str
+    # 検索順位の最小値（小さいほどスコアが高い）
+    rank: int
+    chunk_ids: List[int] = field(default_factory=list)
+    # ファイル内の文字位置（structured チャンクのみ）
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+
+@dataclass
+class ContextStats:
+    chunks: int = 0
+    passages: int = 0
+    merged: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    truncated: int = 0
+    # 検索結果をそのまま並べた場合と、実際に入れたコンテキストのトークン数
+    raw_tokens: int = 0
+    tokens: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.raw_tokens - self.tokens
+
+
+def _text_overlap(left: str, right: str) -> int:
+    """left の末尾と right の先頭が重なる文字数（重なりがなければ 0）。"""
+    probe = right[:64]
+    if not probe:
+        return 0
+    pos = left.find(probe)
+    while pos >= 0:
+        n = len(left) - pos
+        if right.startswith(left[pos:]) or left[pos:].startswith(right):
+            return min(n, len(right))
+        pos = left.find(probe, pos + 1)
+    return 0
+
+
+def _merge(a: Passage, b: Passage) -> Optional[Passage]:
+    """ファイル内で a の直後に続く b を a に連結する。連結できなければ None。"""
+    if a.start is not None and b.start is not None:
+        if b.start > a.end:
+            # 連続するチャンクの間は空白だけなので改行で繋ぐ
+            if b.chunk_ids[0] != a.chunk_ids[-1] + 1:
+                return None
+            text = a.text + "\n" + b.text
+        else:
+            text = a.text + b.text[a.end - b.start:] if b.end > a.end else a.text
+        return Passage(a.source, text, min(a.rank, b.rank), a.chunk_ids + b.chunk_ids, a.start, max(a.end, b.end))
+    # オフセットのない（simple_split の）チャンクは、隣り合う場合に本文の重なりで連結する
+    if b.chunk_ids[0] != a.chunk_ids[-1] + 1:
+        return None
+    overlap = _text_overlap(a.text, b.text)
+    if overlap == 0:
+        return None
+    return Passage(a.source, a.text + b.text[overlap:], min(a.rank, b.rank), a.chunk_ids + b.chunk_ids)
+
+
+def merge_passages(docs: List[Dict]) -> List[Passage]:
+    """同じファイルの重なる・隣接するチャンクを連結し、最良の検索順位の順に返す。"""
+    by_source: Dict[str, List[Passage]] = {}
+    for rank, d in enumerate(docs):
+        meta = d["metadata"]
+        by_source.setdefault(meta["source"], []).append(
+            Passage(meta["source"], d["text"], rank, [meta["chunk_id"]], meta.get("start"), meta.get("end"))
+        )
+    passages: List[Passage] = []
+    for items in by_source.values():
+        items.sort(key=lambda p: (p.start if p.start is not None else -1, p.chunk_ids[0]))
+        current = items[0]
+        for p in items[1:]:
+            if p.chunk_ids[0] == current.chunk_ids[-1]:
+                # 同じチャンクが重複して返された
+                current.rank = min(current.rank, p.rank)
+                continue
+            merged = _merge(current, p)
+            if merged is None:
+                passages.append(current)
+                current = p
+            else:
+                current = merged
+        passages.append(current)
+    passages.sort(key=lambda p: p.rank)
+    return passages
+
+
+def _shingles(text: str) -> Set[int]:
+    text = "".join(text.split())
+    return {hash(text[i:i + _SHINGLE]) for i in range(max(1, len(text) - _SHINGLE + 1))}
+
+
+def _format(i: int, p: Passage) -> str:
+    return f"[doc{i}] source={p.source}\n{p.text}"
+
+
+def build_context(
+    docs: List[Dict],
+    max_tokens: int = CONTEXT_MAX_TOKENS,
+    dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+) -> Tuple[str, ContextStats]:
+    """検索結果からプロンプトに入れるコンテキストを組み立てる。
+
+    同じファイルの隣接・重複チャンクを1区間にまとめ、既に入れた区間とほぼ同じ内容の区間
+    （文字 n-gram の包含率が dedup_threshold 以上）を除き、検索順位の高い順に max_tokens まで詰める。
+    入りきらない区間は CONTEXT_MIN_PASSAGE_TOKENS 以上残っていれば途中で切り、それ以外は飛ばす。
+
+    Returns:
+        (コンテキスト文字列, 統計)
+    """
+    enc = get_llm_encoding()
+    stats = ContextStats(chunks=len(docs))
+    stats.raw_tokens = sum(
+        len(enc.encode_ordinary(f"[doc{i}] source={d['metadata']['source']}\n{d['text']}")) + 1
+        for i, d in enumerate(docs)
+    )
+    passages = merge_passages(docs)
+    stats.merged = len(docs) - len(passages)
+
+    parts: List[str] = []
+    kept_shingles: List[Set[int]] = []
+    used = 0
+    for p in passages:
+        shingles = _shingles(p.text)
+        if any(len(shingles & k) >= dedup_threshold * len(shingles) for k in kept_shingles):
+            stats.duplicates += 1
+            continue
+        part = _format(len(parts), p)
+        n = len(enc.encode_ordinary(part)) + 1
+        if used + n > max_tokens:
+            remaining = max_tokens - used - 1
+            if remaining < CONTEXT_MIN_PASSAGE_TOKENS:
+                stats.dropped += 1
+                continue
+            part = enc.decode(enc.encode_ordinary(part)[:remaining], errors="ignore")
+            n = remaining + 1
+            stats.truncated += 1
+        parts.append(part)
+        kept_shingles.append(shingles)
+        used += n
+    stats.passages = len(parts)
+    stats.tokens = used
+    return "\n\n".join(parts), stats
+
+
+def log_context_stats(stats: ContextStats) -> None:
+    logger.info(
+        f"Context: {stats.chunks} chunks -> {stats.passages} passages "
+        f"({stats.merged} merged, {stats.duplicates} duplicates, {stats.dropped} dropped, "
+        f"{stats.truncated} truncated), {stats.raw_tokens} -> {stats.tokens} tokens "
+        f"(saved {stats.saved_tokens})"
+    )
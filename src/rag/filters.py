@@ -0,0 +1,199 @@
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+from src.config import FILTER_CACHE_SIZE
+
+FILTER_INDEX_FORMAT = 1
+
+
+# ファイル構成（行番号はチャンクストアと同じ）
+#   header.json   件数・フォーマット・sources / doc_types / tags の値の一覧
+#   source.npy    int32 (n,) 行 -> sources のインデックス（sources はパス順なので前方一致は連続区間になる）
+#   doc_type.npy  int16 (n,) 行 -> doc_types のインデックス
+#   mtime.npy     float64 (n,) 元ファイルの更新時刻（UNIX 秒）
+#   tags.npy      uint8 (タグ数, ceil(n/8)) タグごとの行のビットマップ（リトルエンディアンのビット順）
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """検索対象を絞り込む条件。属性内の複数の値は OR、属性同士は AND で組み合わせる。
+
+    source_prefix は RAW_DATA_DIR からの相対パス（"/" 区切り）の前方一致、doc_types は拡張子（"md", "pdf"）、
+    modified_after / modified_before は元ファイルの更新時刻（UNIX 秒、両端を含む）、
+    tags は Markdown の front matter に書かれたタグ。
+    """
+
+    source_prefix: Tuple[str, ...] = ()
+    doc_types: Tuple[str, ...] = ()
+    modified_after: Optional[float] = None
+    modified_before: Optional[float] = None
+    tags: Tuple[str, ...] = ()
+
+    @property
+    def is_empty(self) -> bool:
+        return not (
+            self.source_prefix
+            or self.doc_types
+            or self.tags
+            or self.modified_after is not None
+            or self.modified_before is not None
+        )
+
+
+@dataclass
+class Selection:
+    """フィルタに一致した行。FAISS の IDSelectorBitmap に渡すチャンクIDのビットマップも持つ。"""
+
+    # 一致した行番号（昇順）
+    rows: np.ndarray
+    # 行 -> 一致するか (n,)
+    mask: np.ndarray
+    # チャンクID -> 一致するか のビットマップ（リトルエンディアンのビット順）
+    id_bitmap: np.ndarray
+
+    @property
+    def count(self) -> int:
+        return len(self.rows)
+
+
+class FilterIndex:
+    """行ごとの属性（ファイル・種類・更新時刻・タグ）から、フィルタに一致する行を求める。
+
+    属性は列ごとの numpy 配列（タグは行のビットマップ）なので、一致判定は件数に比例するベクトル演算1回で済む。
+    同じフィルタは繰り返し使われることが多いため、結果を FILTER_CACHE_SIZE 件までキャッシュする。
+    """
+
+    def __init__(self, directory: str | Path, ids: np.ndarray, cache_size: int = FILTER_CACHE_SIZE) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "header.json", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != FILTER_INDEX_FORMAT:
+            raise ValueError(f"Unsupported filter index format in {self.directory}")
+        self.n_rows = header["n_rows"]
+        if self.n_rows != len(ids):
+            raise ValueError(f"Filter index in {self.directory} does not match the chunk store")
+        self.sources = header["sources"]
+        self.doc_types = {t: i for i, t in enumerate(header["doc_types"])}
+        self.tags = {t: i for i, t in enumerate(header["tags"])}
+        self.ids = ids
+
+        def load(name: str) -> np.ndarray:
+            return np.load(self.directory / name, mmap_mode="r")
+
+        self.source = load("source.npy")
+        self.doc_type = load("doc_type.npy")
+        self.mtime = load("mtime.npy")
+        self.tag_bitmaps = load("tags.npy")
+        self._cache: "OrderedDict[SearchFilter, Selection]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def select(self, search_filter: SearchFilter) -> Selection:
+        with self._lock:
+            selection = self._cache.get(search_filter)
+            if selection is not None:
+                self._cache.move_to_end(search_filter)
+                return selection
+        selection = self._select(search_filter)
+        with self._lock:
+            self._cache[search_filter] = selection
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return selection
+
+    def _select(self, f: SearchFilter) -> Selection:
+        mask = np.ones(self.n_rows, dtype=bool)
+        if f.source_prefix:
+            # パス順に並んだ sources では、前方一致するファイルは連続した区間になる
+            hit = np.zeros(self.n_rows, dtype=bool)
+            for prefix in f.source_prefix:
+                lo = bisect_left(self.sources, prefix)
+                hi = bisect_left(self.sources, prefix + "\U0010ffff")
+                if hi > lo:
+                    hit |= (self.source >= lo) & (self.source < hi)
+            mask &= hit
+        if f.doc_types:
+            type_ids = [self.doc_types[t.lower().lstrip(".")] for t in f.doc_types
+                        if t.lower().lstrip(".") in self.doc_types]
+            mask &= np.isin(self.doc_type, type_ids)
+        if f.modified_after is not None:
+            mask &= self.mtime >= f.modified_after
+        if f.modified_before is not None:
+            mask &= self.mtime <= f.modified_before
+        if f.tags:
+            tag_ids = [self.tags[t] for t in f.tags if t in self.tags]
+            if tag_ids:
+                bits = np.bitwise_or.reduce(self.tag_bitmaps[tag_ids], axis=0)
+                mask &= np.unpackbits(bits, count=self.n_rows, bitorder="little").astype(bool)
+            else:
+                mask[:] = False
+
+        rows = np.flatnonzero(mask)
+        id_bits = np.zeros(int(self.ids[-1]) + 1 if self.n_rows else 0, dtype=bool)
+        id_bits[self.ids[rows]] = True
+        return Selection(rows=rows, mask=mask, id_bitmap=np.packbits(id_bits, bitorder="little"))
+
+
+def write_filter_index(
+    directory: str | Path,
+    n_rows: int,
+    files: Iterable[Tuple[str, np.ndarray, float, Iterable[str]]],
+) -> None:
+    """フィルタ用の属性を書き出す。
+
+    Args:
+        directory: 出力先（スナップショット内の filters/）
+        n_rows: チャンクストアの行数
+        files: (RAW_DATA_DIR からの相対パス, そのファイルのチャンクの行番号, 更新時刻, タグ) の並び
+    """
+    files = sorted(files, key=lambda f: f[0])
+    sources = [key for key, _, _, _ in files]
+    doc_types = sorted({Path(key).suffix.lower().lstrip(".") for key in sources})
+    tags = sorted({t for _, _, _, file_tags in files for t in file_tags})
+    type_of = {t: i for i, t in enumerate(doc_types)}
+    tag_of = {t: i for i, t in enumerate(tags)}
+
+    source = np.full(n_rows, -1, dtype="int32")
+    doc_type = np.full(n_rows, -1, dtype="int16")
+    mtime = np.zeros(n_rows, dtype="float64")
+    tag_rows = [[] for _ in tags]
+    for i, (key, rows, file_mtime, file_tags) in enumerate(files):
+        source[rows] = i
+        doc_type[rows] = type_of[Path(key).suffix.lower().lstrip(".")]
+        mtime[rows] = file_mtime
+        for t in set(file_tags):
+            tag_rows[tag_of[t]].append(rows)
+    tag_bitmaps = np.zeros((len(tags), (n_rows + 7) // 8), dtype="uint8")
+    for i, parts in enumerate(tag_rows):
+        bits = np.zeros(n_rows, dtype=bool)
+        bits[np.concatenate(parts)] = True
+        tag_bitmaps[i] = np.packbits(bits, bitorder="little")
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    np.save(directory / "source.npy", source)
+    np.save(directory / "doc_type.npy", doc_type)
+    np.save(directory / "mtime.npy", mtime)
+    np.save(directory / "tags.npy", tag_bitmaps)
+    with open(directory / "header.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": FILTER_INDEX_FORMAT,
+                "n_rows": n_rows,
+                "sources": sources,
+                "doc_types": doc_types,
+                "tags": tags,
+            },
+            f,
+            ensure_ascii=False,
+        )
@@ -0,0 +1,112 @@
+import logging
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ファイル構成（スナップショット内）
+#   vectors.f32  float32 (n, embed_dim) リトルエンディアン。行番号はチャンクストアと同じ
+# 圧縮（INDEX_QUANTIZE）・次元の切り詰め（INDEX_DIM）をしたインデックスの候補を、全次元・全精度で並べ直すのに使う。
+# L2 正規化済みなので内積がコサイン類似度になる
+FULL_VECTORS_NAME = "vectors.f32"
+
+# ベースのスナップショットからコピーするときの1回あたりの行数
+_COPY_ROWS = 8192
+
+
+def open_full_vectors(directory: str | Path, params: Dict) -> Optional[np.ndarray]:
+    """スナップショットの全精度ベクトルを mmap で開く。
+
+    再スコアリングしないインデックス（params に rescore がない）や、ファイルがない場合は None。
+    プロセスのヒープには読み込まず、再スコアリングで参照した行だけがページキャッシュに載る。
+    """
+    if not params.get("rescore"):
+        return None
+    path = Path(directory) / FULL_VECTORS_NAME
+    if not path.exists():
+        logger.warning(f"Full-precision vectors not found at {path}; results keep the compressed index scores")
+        return None
+    dim = params["embed_dim"]
+    if path.stat().st_size == 0:
+        return np.empty((0, dim), dtype="<f4")
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # 候補の行だけをランダムに読むため、先読みで不要なページを載せないようにする
+    if hasattr(mmap, "MADV_RANDOM"):
+        mm.madvise(mmap.MADV_RANDOM)
+    return np.frombuffer(mm, dtype="<f4").reshape(-1, dim)
+
+
+class FullVectorWriter:
+    """全精度ベクトルのファイルを一時ファイルに追記しながら書き出し、commit で置き換える。
+
+    base が指定された場合は keep_rows の行をコピーし、その後ろに新しいベクトルを追加する
+    （ChunkStoreWriter と同じ行順になるよう、チャンクと同じ順序で append すること）。
+    dtype を変えれば、チャンクストアと行をそろえた他の行列（重複除去の MinHash シグネチャ）にも使える。
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        base: Optional[np.ndarray] = None,
+        keep_rows: Optional[np.ndarray] = None,
+        dtype: str = "<f4",
+    ) -> None:
+        self.path = Path(path)
+        self.dtype = dtype
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self._f = open(self._tmp_path, "wb")
+        self._rows = 0
+        self.dim: Optional[int] = None
+        if base is not None:
+            if keep_rows is None:
+                keep_rows = np.arange(len(base))
+            self.dim = base.shape[1]
+            for start in range(0, len(keep_rows), _COPY_ROWS):
+                block = base[keep_rows[start:start + _COPY_ROWS]]
+                self._f.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+            self._rows = len(keep_rows)
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def append(self, vectors: np.ndarray) -> None:
+        """L2 正規化済みの全次元ベクトル（dtype を指定した場合はその行列）を追加する。"""
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Vector dimension {vectors.shape[1]} does not match {self.dim}")
+        self._f.write(np.ascontiguousarray(vectors).tobytes())
+        self._rows += len(vectors)
+
+    def commit(self) -> None:
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._f.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+
+def rescore(vectors: np.ndarray, queries: np.ndarray, rows_list: List[np.ndarray], k: int) -> List[np.ndarray]:
+    """候補の行を全精度ベクトルとの内積で並べ直し、クエリごとに上位k件の行番号を返す。
+
+    queries は L2 正規化済みの全次元ベクトル。内積が同じ候補は元の順位を保つ。
+    """
+    results = []
+    for query, rows in zip(queries, rows_list):
+        if len(rows) == 0:
+            results.append(rows)
+            continue
+        # mmap から読む行はソートしておくとページの参照がまとまる
+        order = np.argsort(rows, kind="stable")
+        scores = np.empty(len(rows), dtype="float32")
+        scores[order] = vectors[rows[order]] @ query
+        results.append(rows[np.argsort(-scores, kind="stable")[:k]])
+    return results
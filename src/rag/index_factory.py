@@ -0,0 +1,240 @@
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+try:
+    import faiss
+except ImportError:
+    # faiss-cpu の場合
+    from faiss import swigfaiss as faiss
+
+from src.config import (
+    INDEX_TYPE,
+    IVF_NLIST,
+    IVF_NPROBE,
+    PQ_M,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    INDEX_TRAIN_SAMPLE,
+    INDEX_SHARDS,
+    INDEX_QUANTIZE,
+    INDEX_DIM,
+)
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# INDEX_QUANTIZE -> faiss の index_factory でのベクトルの格納形式
+QUANTIZERS = {"": "Flat", "fp16": "SQfp16", "int8": "SQ8"}
+
+# PQ の各サブ量子化器は 2^8 = 256 個のコードをクラスタリングで学習するため、それ以上の学習データが要る
+PQ_MIN_TRAIN = 256
+INDEX_PARAMS_NAME = "index_params.json"
+
+# パラメータファイル導入以前に作られた IndexFlatL2
+LEGACY_PARAMS = {"type": "flat_l2", "metric": "l2", "normalize": False}
+
+
+def index_spec(
+    index_type: str = INDEX_TYPE,
+    shards: int = INDEX_SHARDS,
+    quantize: str = INDEX_QUANTIZE,
+    truncate_dim: int = INDEX_DIM,
+) -> Dict:
+    """設定値から決まるインデックス構成。前回ビルドとの比較に使う。"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown INDEX_TYPE: {index_type} (expected one of {INDEX_TYPES})")
+    if shards < 1:
+        raise ValueError(f"INDEX_SHARDS must be at least 1 (got {shards})")
+    if quantize not in QUANTIZERS:
+        raise ValueError(f"Unknown INDEX_QUANTIZE: {quantize} (expected one of {tuple(QUANTIZERS)})")
+    if quantize and index_type == "ivf_pq":
+        raise ValueError("INDEX_QUANTIZE does not apply to ivf_pq, which already compresses the vectors")
+    if truncate_dim < 0:
+        raise ValueError(f"INDEX_DIM must be 0 or positive (got {truncate_dim})")
+    spec: Dict = {"type": index_type}
+    # シャード数 1・圧縮なし・全次元のストアは導入前と同じ構成として扱い、作り直さない
+    if shards > 1:
+        spec["shards"] = shards
+    if quantize:
+        spec["quantize"] = quantize
+    if truncate_dim:
+        spec["truncate_dim"] = truncate_dim
+    if index_type.startswith("ivf"):
+        spec["nlist"] = IVF_NLIST
+    if index_type == "ivf_pq":
+        spec["pq_m"] = PQ_M
+    if index_type == "hnsw":
+        spec["hnsw_m"] = HNSW_M
+        spec["ef_construction"] = HNSW_EF_CONSTRUCTION
+    return spec
+
+
+def resolve_params(spec: Dict, n_vectors: int, dim: int) -> Dict:
+    """spec に件数・次元から決まる値（nlist の自動設定など）と検索時の既定値を加える。
+
+    シャードに分ける場合、n_vectors は全体の件数で、nlist は1シャードあたりの件数から決める
+    （全シャードで同じ学習済みのクラスタを使う）。dim は埋め込みの次元で、切り詰める場合は
+    params["dim"] がインデックスの次元、params["embed_dim"] が再スコアリング用の全次元になる。
+    """
+    params = {"spec": spec, "type": spec["type"], "metric": "ip", "normalize": True, "dim": dim}
+    if spec.get("truncate_dim"):
+        if spec["truncate_dim"] > dim:
+            raise ValueError(f"INDEX_DIM={spec['truncate_dim']} exceeds the embedding dimension {dim}")
+        params["dim"] = params["truncate"] = spec["truncate_dim"]
+    if spec.get("quantize"):
+        params["quantize"] = spec["quantize"]
+    if needs_rescore(spec):
+        params["rescore"] = True
+        params["embed_dim"] = dim
+    dim = params["dim"]
+    if spec.get("shards", 1) > 1:
+        params["shards"] = spec["shards"]
+        n_vectors = math.ceil(n_vectors / spec["shards"])
+    if spec["type"] == "ivf_pq" and n_vectors < PQ_MIN_TRAIN:
+        # spec は ivf_pq のまま残す（件数が増えてから --full で作り直せば PQ になる）
+        logger.warning(
+            f"ivf_pq needs at least {PQ_MIN_TRAIN} vectors per shard to train the PQ codebooks "
+            f"(got {n_vectors}); building ivf_flat instead"
+        )
+        params["type"] = "ivf_flat"
+    if spec["type"].startswith("ivf"):
+        nlist = spec["nlist"] or int(4 * math.sqrt(n_vectors))
+        # k-means はセントロイドあたり 39 点以上の学習データを推奨している
+        nlist = max(1, min(nlist, n_vectors // 39))
+        params["nlist"] = nlist
+        params["nprobe"] = min(IVF_NPROBE, nlist)
+    if params["type"] == "ivf_pq":
+        if dim % spec["pq_m"] != 0:
+            raise ValueError(f"PQ_M={spec['pq_m']} must divide the embedding dimension {dim}")
+        params["pq_m"] = spec["pq_m"]
+    if spec["type"] == "hnsw":
+        params["hnsw_m"] = spec["hnsw_m"]
+        params["ef_construction"] = spec["ef_construction"]
+        params["ef_search"] = HNSW_EF_SEARCH
+    return params
+
+
+def needs_training(spec: Dict) -> bool:
+    """作成後に学習が必要か（IVF のクラスタリング、int8 の値域）。"""
+    return spec["type"].startswith("ivf") or spec.get("quantize") == "int8"
+
+
+def needs_rescore(spec: Dict) -> bool:
+    """インデックスのスコアが近似になるため、全次元の float32 ベクトルで並べ直すか。"""
+    return bool(spec.get("quantize") or spec.get("truncate_dim"))
+
+
+def factory_string(params: Dict) -> str:
+    t = params["type"]
+    code = QUANTIZERS[params.get("quantize", "")]
+    if t == "flat":
+        inner = code
+    elif t == "ivf_flat":
+        inner = f"IVF{params['nlist']},{code}"
+    elif t == "ivf_pq":
+        inner = f"IVF{params['nlist']},PQ{params['pq_m']}"
+    elif t == "hnsw":
+        inner = f"HNSW{params['hnsw_m']},{code}"
+    else:
+        raise ValueError(f"Unknown index type: {t}")
+    # チャンクIDで追加・削除できるよう IDMap2 で包む
+    return f"IDMap2,{inner}"
+
+
+def prepare_vectors(x: np.ndarray, params: Dict) -> np.ndarray:
+    """インデックスに渡す形にしたコピーを返す。
+
+    次元を切り詰める場合は先頭の params["truncate"] 次元だけを残し、内積検索でコサイン類似度になるよう
+    必要に応じて L2 正規化する（切り詰めた後に正規化し直す）。
+    """
+    x = np.array(x, dtype="float32", copy=True, ndmin=2)
+    if params.get("truncate"):
+        x = np.ascontiguousarray(x[:, :params["truncate"]])
+    if params.get("normalize"):
+        faiss.normalize_L2(x)
+    return x
+
+
+def create_index(params: Dict, train_vectors: np.ndarray):
+    """空のインデックスを作り、必要なら学習データのサンプルで学習する。
+
+    train_vectors は prepare_vectors 済みであること。
+    """
+    metric = faiss.METRIC_INNER_PRODUCT if params["metric"] == "ip" else faiss.METRIC_L2
+    index = faiss.index_factory(params["dim"], factory_string(params), metric)
+    if params["type"] == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efConstruction = params["ef_construction"]
+    if not index.is_trained:
+        sample = train_vectors
+        if len(sample) > INDEX_TRAIN_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = sample[rng.choice(len(sample), INDEX_TRAIN_SAMPLE, replace=False)]
+        logger.info(f"Training {params['type']} index on {len(sample)} vectors...")
+        index.train(sample)
+    return index
+
+
+def search_parameters(
+    params: Dict,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    sel=None,
+    expansion: float = 1.0,
+):
+    """検索時のパラメータ（nprobe / efSearch）。インデックスを書き換えないのでスレッド安全。
+
+    sel（faiss.IDSelector）を渡すと、選択されたチャンクIDだけを検索の中で候補にする。
+    一致する割合が小さいと探索範囲内の候補が減るため、nprobe / efSearch を expansion 倍に広げる。
+    """
+    if params["type"].startswith("ivf"):
+        nprobe = min(params["nlist"], math.ceil((nprobe or params["nprobe"]) * expansion))
+        return faiss.SearchParametersIVF(nprobe=nprobe, sel=sel)
+    if params["type"] == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=math.ceil((ef_search or params["ef_search"]) * expansion), sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def remove_ids(index, ids: np.ndarray, params: Dict):
+    """チャンクIDのベクトルを削除する。
+
+    HNSW は削除に対応していないため、残りのベクトルを取り出して作り直す。
+    戻り値のインデックスを以降は使うこと。
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if params["type"] != "hnsw":
+        index.remove_ids(ids)
+        return index
+
+    all_ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(all_ids, ids)
+    vectors = index.index.reconstruct_n(0, index.ntotal)
+    # int8 の値域は削除前の全ベクトルで学習し直す（全件削除でも学習データが空にならない）
+    rebuilt = create_index(params, vectors)
+    if keep.any():
+        rebuilt.add_with_ids(vectors[keep], all_ids[keep])
+    logger.info(f"Rebuilt HNSW graph without {int((~keep).sum())} vectors")
+    return rebuilt
+
+
+def load_params(directory: str | Path) -> Dict:
+    path = Path(directory) / INDEX_PARAMS_NAME
+    if not path.exists():
+        return dict(LEGACY_PARAMS)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_params(params: Dict, directory: str | Path) -> None:
+    path = Path(directory) / INDEX_PARAMS_NAME
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(params, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,34 @@
+import os
+from pathlib import Path
+
+try:
+    import faiss
+except ImportError:
+    # faiss-cpu の場合
+    from faiss import swigfaiss as faiss
+
+# FAISS にファイルを渡すときの1回あたりの読み込みサイズ
+_READ_BLOCK = 1 << 20
+
+
+def read_index(directory: str | Path, name: str = "index.faiss"):
+    """FAISSインデックスを読み込む。
+
+    FAISSは日本語パスを扱えないため、Python でファイルを開き、コールバック経由で FAISS に読ませる。
+    作業ディレクトリを変えないので、複数のスレッド（ホットリロード・コレクションの読み込み）から同時に呼べる。
+    """
+    with open(Path(directory) / name, "rb") as f:
+        return faiss.read_index(faiss.PyCallbackIOReader(f.read, _READ_BLOCK))
+
+
+def write_index(index, directory: str | Path, name: str = "index.faiss") -> None:
+    """FAISSインデックスを書き込む。
+
+    書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える。
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / f"{name}.tmp"
+    with open(tmp_path, "wb") as f:
+        faiss.write_index(index, faiss.PyCallbackIOWriter(f.write))
+    os.replace(tmp_path, directory / name)
@@ -0,0 +1,426 @@
+import hashlib
+import json
+import logging
+import re
+import shutil
+import unicodedata
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.config import LEXICAL_TOKENIZER, BM25_K1, BM25_B
+from src.rag.chunk_store import replace_directory
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_FORMAT = 1
+# 1ブロックあたりのポスティング数。ブロック単位でスコア上限を持ち、不要なブロックは展開しない
+BLOCK_SIZE = 128
+
+
+# ファイル構成（行番号はチャンクストアの行と一致する）
+#   header.json       件数・平均文書長・BM25 パラメータ・トークナイザ名
+#   terms.npy         uint64 語のハッシュ（昇順）
+#   term_df.npy       uint32 語ごとの文書頻度
+#   term_blocks.npy   int64 (n_terms+1,) 語ごとのブロック範囲
+#   block_last.npy    uint32 ブロック内の最後の行番号
+#   block_starts.npy  int64 (n_blocks+1,) ブロック先頭のポスティング番号
+#   block_offsets.npy int64 (n_blocks+1,) postings.bin 内のバイトオフセット
+#   block_max.npy     float32 ブロック内の BM25 tf 部分の最大値（idf を掛ける前）
+#   postings.bin      行番号の差分を可変長バイト（LEB128）で符号化したもの
+#   tfs.bin           uint8 出現回数（255 で打ち切り）
+#   doc_len.npy       uint32 行ごとのトークン数
+
+
+_TOKEN_RE = re.compile(r"[0-9a-z]+(?:[-_.][0-9a-z]+)*|[^\W0-9a-z_]+")
+_CODE_SEP_RE = re.compile(r"[-_.]")
+
+
+def cjk_bigram(text: str) -> List[str]:
+    """日本語向けのトークナイザ。
+
+    NFKC 正規化・小文字化したうえで、英数字の並び（製品コード・エラー番号など）は1語として、
+    それ以外（漢字・かな等）は文字バイグラムに分解する。
+    "E-1024" のような区切りを含む語は、全体と各部分の両方を出力する。
+    """
+    tokens: List[str] = []
+    for m in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = m.group()
+        if run[0].isascii():
+            tokens.append(run)
+            parts = _CODE_SEP_RE.split(run)
+            if len(parts) > 1:
+                tokens.extend(parts)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    "cjk_bigram": cjk_bigram,
+}
+
+
+def get_tokenizer(name: str) -> Callable[[str], List[str]]:
+    if name not in TOKENIZERS:
+        raise ValueError(f"Unknown LEXICAL_TOKENIZER: {name} (expected one of {tuple(TOKENIZERS)})")
+    return TOKENIZERS[name]
+
+
+def hash_terms(terms: Iterable[str]) -> np.ndarray:
+    """語を 64bit ハッシュに変換する。語彙を文字列で持たずに済む。"""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "little") for t in terms),
+        dtype="uint64",
+    )
+
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """非負整数列を LEB128 で符号化する。(バイト列, 各値の先頭バイト位置) を返す。"""
+    values = np.asarray(values, dtype="uint64")
+    nbytes = np.ones(len(values), dtype="int64")
+    for shift in (7, 14, 21, 28, 35):
+        nbytes += values >= (1 << shift)
+    starts = np.cumsum(nbytes) - nbytes
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    pos = np.arange(int(nbytes.sum())) - starts[owner]
+    out = ((values[owner] >> (7 * pos).astype("uint64")) & 0x7F).astype("uint8")
+    out[pos < nbytes[owner] - 1] |= 0x80
+    return out, starts
+
+
+def decode_varints(buf: np.ndarray) -> np.ndarray:
+    """LEB128 のバイト列を uint64 の配列に戻す。"""
+    buf = np.asarray(buf, dtype="uint8")
+    if len(buf) == 0:
+        return np.zeros(0, dtype="uint64")
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    pos = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    payload = (buf & 0x7F).astype("uint64") << (7 * pos).astype("uint64")
+    return np.add.reduceat(payload, starts)
+
+
+def _gather(data: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """data の複数区間 [starts[i], ends[i]) を連結して取り出す。"""
+    lens = ends - starts
+    if len(lens) == 1:
+        return np.asarray(data[starts[0]:ends[0]])
+    idx = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(int(lens.sum()))
+    return np.asarray(data[idx])
+
+
+def _tf_part(tfs: np.ndarray, doc_len: np.ndarray, avgdl: float, k1: float, b: float) -> np.ndarray:
+    tfs = tfs.astype("float32")
+    return tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_len.astype("float32") / avgdl))
+
+
+def _idf(n_docs: int, df: np.ndarray) -> np.ndarray:
+    df = df.astype("float64")
+    return np.log(1 + (n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+
+
+class LexicalIndex:
+    """BM25 の転置インデックス（読み取り専用）。
+
+    ポスティングはブロックごとに差分 + 可変長バイトで圧縮して mmap で開く。
+    検索は MaxScore で、スコア上限の小さい語（よく出るバイグラムなど）は候補文書を含むブロックだけを展開する。
+    """
+
+    def __init__(self, directory: str | Path) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "header.json", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != LEXICAL_FORMAT:
+            raise ValueError(f"Unsupported lexical index format in {self.directory}")
+        self.header = header
+        self.n_docs: int = header["n_docs"]
+        self.avgdl: float = header["avgdl"]
+        self.k1: float = header["k1"]
+        self.b: float = header["b"]
+        self.tokenize = get_tokenizer(header["tokenizer"])
+
+        def load(name: str) -> np.ndarray:
+            return np.load(self.directory / name, mmap_mode="r")
+
+        self.terms = load("terms.npy")
+        self.term_df = load("term_df.npy")
+        self.term_blocks = load("term_blocks.npy")
+        self.block_last = load("block_last.npy")
+        self.block_starts = load("block_starts.npy")
+        self.block_offsets = load("block_offsets.npy")
+        self.block_max = load("block_max.npy")
+        self.doc_len = load("doc_len.npy")
+        self.postings = _open_bytes(self.directory / "postings.bin")
+        self.tfs = _open_bytes(self.directory / "tfs.bin")
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def term_ids(self, terms: Iterable[str]) -> np.ndarray:
+        hashes = np.unique(hash_terms(terms))
+        if len(self.terms) == 0 or len(hashes) == 0:
+            return np.zeros(0, dtype="int64")
+        pos = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        return pos[self.terms[pos] == hashes]
+
+    def _decode_blocks(self, term_id: int, blocks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """語のブロック（昇順のブロック番号）を展開し、(行番号, 出現回数) を返す。"""
+        first = int(self.term_blocks[term_id])
+        if len(blocks) > 1 and blocks[-1] - blocks[0] == len(blocks) - 1:
+            # 連続したブロックは1区間として読む
+            byte_lo, byte_hi = self.block_offsets[[blocks[0], blocks[-1] + 1]]
+            buf = np.asarray(self.postings[byte_lo:byte_hi])
+            post_lo, post_hi = self.block_starts[[blocks[0], blocks[-1] + 1]]
+            tfs = np.asarray(self.tfs[post_lo:post_hi])
+        else:
+            buf = _gather(self.postings, self.block_offsets[blocks], self.block_offsets[blocks + 1])
+            tfs = _gather(self.tfs, self.block_starts[blocks], self.block_starts[blocks + 1])
+        deltas = decode_varints(buf).astype("int64")
+
+        # 各ブロックの先頭は直前ブロックの最後の行番号（語の先頭ブロックは 0）からの差分
+        counts = (self.block_starts[blocks + 1] - self.block_starts[blocks]).astype("int64")
+        heads = np.cumsum(counts) - counts
+        bases = np.where(blocks > first, self.block_last[np.maximum(blocks - 1, 0)], 0).astype("int64")
+        deltas[heads] += bases
+        rows = np.cumsum(deltas)
+        rows -= np.repeat(rows[heads] - deltas[heads], counts)
+        return rows, tfs
+
+    def search(self, query: str, k: int = 10, row_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 で上位k件の (行番号, スコア) をスコア降順で返す。
+
+        row_mask（行ごとの bool）を渡すと True の行だけを候補にする。候補に入らない行はスコアの加算前に除くので、
+        絞り込んだ中での上位k件が返り、候補が少ないほど必須でない語で展開するブロックも減る。
+        """
+        term_ids = self.term_ids(self.tokenize(query))
+        if len(term_ids) == 0 or self.n_docs == 0:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+
+        idf = _idf(self.n_docs, self.term_df[term_ids])
+        b0 = self.term_blocks[term_ids]
+        b1 = self.term_blocks[term_ids + 1]
+        upper = idf * np.array([self.block_max[lo:hi].max() for lo, hi in zip(b0, b1)], dtype="float32")
+        # スコア上限の大きい語から処理する。suffix[j] は j 番目以降の語だけで取りうる最大スコア
+        order = np.argsort(-upper)
+        suffix = np.cumsum(upper[order][::-1])[::-1]
+        suffix = np.append(suffix, 0.0)
+
+        acc = np.zeros(self.n_docs, dtype="float32")
+        seen = np.zeros(self.n_docs, dtype=bool)
+        cand = np.zeros(0, dtype="int64")
+        theta = 0.0
+        for j, i in enumerate(order):
+            blocks = np.arange(b0[i], b1[i])
+            if len(cand) < k or suffix[j] >= theta:
+                # 必須の語: 未出現の文書でも上位k件に入りうるため全ブロックを展開する
+                rows, tfs = self._decode_blocks(term_ids[i], blocks)
+                if row_mask is not None:
+                    keep = row_mask[rows]
+                    rows, tfs = rows[keep], tfs[keep]
+                acc[rows] += idf[i] * _tf_part(tfs, self.doc_len[rows], self.avgdl, self.k1, self.b)
+                fresh = rows[~seen[rows]]
+                seen[fresh] = True
+                cand = np.concatenate([cand, fresh])
+            else:
+                # 非必須の語: 残りの語をすべて足しても theta に届かない候補は捨て、
+                # 残った候補を含むブロックだけを展開してスコアを加算する
+                cand = cand[acc[cand] + suffix[j] >= theta]
+                last = self.block_last[b0[i]:b1[i]]
+                pos = np.searchsorted(last, cand)
+                inside = pos < len(last)
+                hit_cand, hit_blk = cand[inside], pos[inside]
+                # このブロックの上限を足しても届かない候補は展開しない
+                reach = acc[hit_cand] + idf[i] * self.block_max[b0[i] + hit_blk] + suffix[j + 1] >= theta
+                hit_cand, hit_blk = hit_cand[reach], hit_blk[reach]
+                if len(hit_cand) == 0:
+                    continue
+                rows, tfs = self._decode_blocks(term_ids[i], blocks[np.unique(hit_blk)])
+                pos = np.minimum(np.searchsorted(rows, hit_cand), len(rows) - 1)
+                match = rows[pos] == hit_cand
+                docs, tfs = hit_cand[match], tfs[pos[match]]
+                acc[docs] += idf[i] * _tf_part(tfs, self.doc_len[docs], self.avgdl, self.k1, self.b)
+            if len(cand) >= k:
+                theta = float(np.partition(acc[cand], len(cand) - k)[len(cand) - k])
+
+        scores = acc[cand]
+        top = np.argsort(-scores)[:k] if len(cand) <= k else np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return cand[top], scores[top]
+
+    def iter_postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """全ポスティングを (語のハッシュ, 行番号, 出現回数) として展開する。差分ビルド用。"""
+        n_blocks = len(self.block_last)
+        if n_blocks == 0:
+            return np.zeros(0, "uint64"), np.zeros(0, "int64"), np.zeros(0, "uint8")
+        deltas = decode_varints(np.asarray(self.postings[:])).astype("int64")
+        counts = np.diff(self.block_starts).astype("int64")
+        heads = self.block_starts[:-1].astype("int64")
+        is_first = np.zeros(n_blocks, dtype=bool)
+        is_first[self.term_blocks[:-1][np.diff(self.term_blocks) > 0]] = True
+        bases = np.where(is_first, 0, np.r_[0, self.block_last[:-1]]).astype("int64")
+        deltas[heads] += bases
+        rows = np.cumsum(deltas)
+        rows -= np.repeat(rows[heads] - deltas[heads], counts)
+        hashes = np.repeat(np.asarray(self.terms), np.asarray(self.term_df, dtype="int64"))
+        return hashes, rows, np.asarray(self.tfs[:])
+
+
+class LexicalIndexWriter:
+    """チャンクストアと同じ行順で BM25 インデックスを書き出す。
+
+    base が指定された場合は keep_rows の行のポスティングを引き継ぎ、その後ろに add した文書を追加する。
+    新しい文書は語彙ID・行番号・出現回数の配列だけで保持し、commit でまとめて圧縮する。
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        tokenizer: str = LEXICAL_TOKENIZER,
+        base: Optional[LexicalIndex] = None,
+        keep_rows: Optional[np.ndarray] = None,
+    ) -> None:
+        self.directory = Path(directory)
+        self.tokenizer = tokenizer
+        self.tokenize = get_tokenizer(tokenizer)
+        self.base = base
+        if base is not None and keep_rows is None:
+            keep_rows = np.arange(len(base))
+        self.keep_rows = keep_rows if base is not None else None
+        self._row = len(keep_rows) if base is not None else 0
+        self._vocab: Dict[str, int] = {}
+        self._terms = array("I")
+        self._rows = array("I")
+        self._tfs = array("B")
+        self._doc_len = array("I")
+
+    def __len__(self) -> int:
+        return self._row
+
+    def add(self, texts: Iterable[str]) -> None:
+        vocab = self._vocab
+        for text in texts:
+            tokens = self.tokenize(text)
+            counts = Counter(tokens)
+            self._terms.extend(vocab.setdefault(t, len(vocab)) for t in counts)
+            self._tfs.extend(min(c, 255) for c in counts.values())
+            self._rows.extend([self._row] * len(counts))
+            self._doc_len.append(len(tokens))
+            self._row += 1
+
+    def commit(self, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        new_hashes = hash_terms(self._vocab)[np.frombuffer(self._terms, dtype="uint32")] if self._vocab else \
+            np.zeros(0, dtype="uint64")
+        hashes = [new_hashes]
+        rows = [np.frombuffer(self._rows, dtype="uint32").astype("int64")]
+        tfs = [np.frombuffer(self._tfs, dtype="uint8")]
+        doc_len = [np.frombuffer(self._doc_len, dtype="uint32")]
+        if self.base is not None:
+            # 残す行のポスティングを新しい行番号に付け替える（keep_rows の順に詰める）
+            old_hashes, old_rows, old_tfs = self.base.iter_postings()
+            remap = np.full(len(self.base), -1, dtype="int64")
+            remap[self.keep_rows] = np.arange(len(self.keep_rows))
+            new_rows = remap[old_rows]
+            keep = new_rows >= 0
+            hashes.insert(0, old_hashes[keep])
+            rows.insert(0, new_rows[keep])
+            tfs.insert(0, old_tfs[keep])
+            doc_len.insert(0, np.asarray(self.base.doc_len)[self.keep_rows])
+            del old_hashes, old_rows, old_tfs, new_rows, keep
+        hashes = np.concatenate(hashes)
+        rows = np.concatenate(rows)
+        tfs = np.concatenate(tfs)
+        doc_len = np.concatenate(doc_len).astype("uint32")
+        self._terms, self._rows, self._tfs, self._vocab = array("I"), array("I"), array("B"), {}
+
+        order = np.lexsort((rows, hashes))
+        hashes, rows, tfs = hashes[order], rows[order], tfs[order]
+        del order
+        n_docs = len(doc_len)
+        avgdl = float(doc_len.mean()) if n_docs else 0.0
+
+        terms, term_start, term_df = np.unique(hashes, return_index=True, return_counts=True)
+        del hashes
+        # 語ごとに BLOCK_SIZE 件ずつのブロックに分ける
+        n_blocks_per_term = (term_df + BLOCK_SIZE - 1) // BLOCK_SIZE
+        term_blocks = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(n_blocks_per_term, out=term_blocks[1:])
+        n_blocks = int(term_blocks[-1])
+        block_term = np.repeat(np.arange(len(terms)), n_blocks_per_term)
+        block_starts = np.empty(n_blocks + 1, dtype="int64")
+        block_starts[:-1] = term_start[block_term] + (np.arange(n_blocks) - term_blocks[block_term]) * BLOCK_SIZE
+        block_starts[-1] = len(rows)
+        block_last = rows[block_starts[1:] - 1].astype("uint32")
+
+        # 行番号の差分。各ブロックの先頭は直前ブロックの最後（語の先頭ブロックは 0）からの差分
+        deltas = np.empty(len(rows), dtype="int64")
+        if len(rows):
+            deltas[0] = rows[0]
+            deltas[1:] = rows[1:] - rows[:-1]
+            is_first = np.zeros(n_blocks, dtype=bool)
+            is_first[term_blocks[:-1]] = True
+            heads = block_starts[:-1]
+            deltas[heads] = np.where(is_first, rows[heads], rows[heads] - rows[np.maximum(heads - 1, 0)])
+        encoded, byte_starts = encode_varints(deltas)
+        block_offsets = np.append(byte_starts[block_starts[:-1]], len(encoded)).astype("int64")
+
+        tf_part = _tf_part(tfs, doc_len[rows], avgdl, k1, b) if n_docs else np.zeros(0, "float32")
+        block_max = np.maximum.reduceat(tf_part, block_starts[:-1]) if n_blocks else np.zeros(0, "float32")
+
+        tmp_dir = self.directory.with_name(self.directory.name + ".tmp")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+        np.save(tmp_dir / "terms.npy", terms.astype("uint64"))
+        np.save(tmp_dir / "term_df.npy", term_df.astype("uint32"))
+        np.save(tmp_dir / "term_blocks.npy", term_blocks)
+        np.save(tmp_dir / "block_last.npy", block_last)
+        np.save(tmp_dir / "block_starts.npy", block_starts)
+        np.save(tmp_dir / "block_offsets.npy", block_offsets)
+        np.save(tmp_dir / "block_max.npy", block_max.astype("float32"))
+        np.save(tmp_dir / "doc_len.npy", doc_len)
+        encoded.tofile(tmp_dir / "postings.bin")
+        tfs.astype("uint8").tofile(tmp_dir / "tfs.bin")
+        with open(tmp_dir / "header.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "format": LEXICAL_FORMAT,
+                    "tokenizer": self.tokenizer,
+                    "n_docs": n_docs,
+                    "n_terms": len(terms),
+                    "n_postings": len(rows),
+                    "avgdl": avgdl,
+                    "k1": k1,
+                    "b": b,
+                    "block_size": BLOCK_SIZE,
+                },
+                f,
+            )
+        replace_directory(tmp_dir, self.directory)
+        logger.info(
+            f"Lexical index: {n_docs} docs, {len(terms)} terms, {len(rows)} postings "
+            f"({len(encoded) / max(1, len(rows)):.2f} bytes/posting)"
+        )
+
+
+def _open_bytes(path: Path) -> np.ndarray:
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype="uint8")
+    return np.memmap(path, dtype="uint8", mode="r")
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int, rrf_k: int = 60) -> List[int]:
+    """複数の順位リストを RRF（score = Σ 1 / (rrf_k + 順位)）で統合し、上位k件を返す。"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda key: -scores[key])[:k]
+
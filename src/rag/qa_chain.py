@@ -1,13 +1,38 @@
-from typing import Tuple, List, Dict
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import AsyncIterator, Tuple, List, Dict, Optional
 
-from openai import OpenAI
+import numpy as np
 
-from src.config import OPENAI_API_KEY, LLM_MODEL
-from src.models.embedder import get_embedding
+from src.config import (
+    SEARCH_THREADS,
+    BATCH_MAX_QUERIES,
+    BATCH_LLM_CONCURRENCY,
+    RERANK_TOP_K,
+    SESSION_HISTORY_ANSWER_CHARS,
+)
+from src.models.embedder import aget_embedding, get_embedding, get_embeddings
+from src.models import llm_client
+from src.rag.answer_cache import CachedAnswer, get_answer_cache
+from src.rag.collections import DEFAULT_COLLECTION, CollectionManager, get_collection
+from src.rag.context_builder import build_context, log_context_stats
+from src.rag.filters import SearchFilter
+from src.rag.reranker import get_reranker
 from src.rag.retriever import Retriever
+from src.rag.sessions import Session, get_session_store
+from src.rag.tracing import Trace
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-retriever = Retriever()
+logger = logging.getLogger(__name__)
+
+# コレクションごとの公開中のスナップショットの Retriever。最初に使われたときに読み込み、
+# COLLECTION_MEMORY_MB を超えたら古いものから解放する。API では current ポインタを監視して差し替える
+retrievers = CollectionManager()
+
+# FAISS 検索はこのスレッドプールで実行し、イベントループを止めない
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="faiss-search")
 
 SYSTEM_PROMPT = """あなたは社内ドキュメントに基づいて回答するアシスタントです。
 与えられたコンテキストの範囲内で回答し、分からない場合は「分かりません」と答えてください。
@@ -15,19 +40,18 @@ SYSTEM_PROMPT = """あなたは社内ドキュメントに基づいて回答す
 """
 
 
-def answer(query: str) -> Tuple[str, List[Dict]]:
-    # 1. クエリ埋め込み
-    q_emb = get_embedding(query)
-
-    # 2. 類似チャンク検索
-    docs = retriever.query(q_emb, k=5)
+CONDENSE_PROMPT = """あなたは社内ドキュメント検索の質問を整えるアシスタントです。
+会話の履歴と追加の質問から、履歴を読まなくても意味が通じる単独の質問を1つ作ってください。
+指示語や省略された主語・対象は履歴の内容で補い、質問と同じ言語で、質問文だけを出力してください。
+追加の質問がそれだけで意味が通じる場合は、そのまま出力してください。
+"""
 
-    # 3. コンテキスト組み立て
-    context = "\n\n".join(
-        f"[doc{i}] source={d['metadata']['source']}\n{d['text']}" for i, d in enumerate(docs)
-    )
 
-    messages = [
+def build_messages(query: str, docs: List[Dict]) -> List[Dict]:
+    # 同じファイルの隣接・重複チャンクをまとめ、CONTEXT_MAX_TOKENS までスコア順に詰める
+    context, stats = build_context(docs)
+    log_context_stats(stats)
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {
             "role": "user",
@@ -35,9 +59,503 @@ def answer(query: str) -> Tuple[str, List[Dict]]:
         },
     ]
 
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        messages=messages,
-    )
+
+def build_condense_messages(query: str, history: List[Dict]) -> List[Dict]:
+    # 回答は先頭だけを渡す（話題が分かれば十分で、長い回答でトークンを使わない）
+    lines = []
+    for turn in history:
+        lines.append(f"ユーザー: {turn['query']}")
+        lines.append(f"アシスタント: {turn['answer'][:SESSION_HISTORY_ANSWER_CHARS]}")
+    return [
+        {"role": "system", "content": CONDENSE_PROMPT},
+        {"role": "user", "content": "会話の履歴:\n" + "\n".join(lines) + f"\n\n追加の質問: {query}"},
+    ]
+
+
+def top_k() -> int:
+    """LLM に渡すチャンク数。再ランキングで上位の精度が上がる分、RERANK_TOP_K 件に減らしてトークンを節約する。"""
+    return RERANK_TOP_K if get_reranker() is not None else 5
+
+
+def get_retriever(collection: Optional[str] = None) -> Retriever:
+    """コレクション（省略時は default）の公開中のスナップショットの Retriever。
+
+    常駐していなければ読み込む（インデックスがなければ FileNotFoundError、名前が不正なら ValueError）。
+    1つのリクエストの中では最初に取得したものを使い続けること（途中で差し替わっても版が混ざらない）。
+    """
+    return retrievers.get(collection)
+
+
+def answer(
+    query: str,
+    search_filter: Optional[SearchFilter] = None,
+    trace: Optional[Trace] = None,
+    collection: Optional[str] = None,
+) -> Tuple[str, List[Dict]]:
+    trace = trace or Trace("answer")
+    # 1. クエリ埋め込み
+    with trace.span("embed"):
+        q_emb = get_embedding(query)
+
+    # 2. 類似チャンク検索（search_filter があれば一致するチャンクの中から）
+    with trace.span("search"):
+        docs = get_retriever(collection).query(q_emb, k=top_k(), query_text=query, search_filter=search_filter)
+
+    # 3. コンテキスト組み立て
+    with trace.span("assemble"):
+        messages = build_messages(query, docs)
+
+    with trace.span("llm"):
+        resp = llm_client.chat(messages)
+    trace.add_usage(resp.usage)
+    trace.finish()
     content = resp.choices[0].message.content
-    return content, docs
\ No newline at end of file
+    return content, docs
+
+
+async def search(
+    q_emb: list[float],
+    k: int = 5,
+    query: Optional[str] = None,
+    retriever: Optional[Retriever] = None,
+    search_filter: Optional[SearchFilter] = None,
+) -> List[Dict]:
+    """検索（FAISS・BM25）をスレッドプールで実行する。retriever 省略時は default の公開中のスナップショット。"""
+    retriever = retriever or get_retriever()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _search_pool, partial(retriever.query, q_emb, k, query_text=query, search_filter=search_filter)
+    )
+
+
+async def _acomplete(messages: List[Dict], trace: Optional[Trace] = None) -> str:
+    resp = await llm_client.achat(messages)
+    if trace is not None:
+        trace.add_usage(resp.usage)
+    return resp.choices[0].message.content
+
+
+async def condense_query(query: str, session: Optional[Session], trace: Trace) -> str:
+    """session の直近の会話を踏まえて、query を単独で意味が通じる質問に書き換える。
+
+    会話の最初の質問はそのまま返す。同じ直近の会話に対する同じ質問の書き換えはセッション内のキャッシュから返し、
+    LLM を呼ばない。書き換えに失敗した場合は元の質問で検索する。
+    """
+    if session is None or not session.turns:
+        return query
+    key = session.rewrite_key(query)
+    standalone = session.find_rewrite(key)
+    if standalone is not None:
+        trace.attrs["rewrite"] = "cached"
+        return standalone
+    with trace.span("rewrite"):
+        try:
+            standalone = (await _acomplete(build_condense_messages(query, session.history()), trace)).strip()
+        except Exception as e:
+            logger.warning(f"Query rewrite failed; searching with the original question: {e}")
+            return query
+    standalone = standalone or query
+    session.remember_rewrite(key, standalone)
+    trace.attrs["rewrite"] = "llm"
+    return standalone
+
+
+def _session_scope(collection: str, version: str, search_filter: Optional[SearchFilter]) -> str:
+    """セッション内の検索結果を再利用できる範囲（コレクション・インデックスのバージョン・絞り込み条件）。"""
+    scope = f"{collection}@{version}"
+    return scope if _cacheable(search_filter) else f"{scope}:{search_filter!r}"
+
+
+async def prepare_query(
+    query: str,
+    session: Optional[Session],
+    scope: str,
+    trace: Trace,
+) -> Tuple[str, list, Optional[List[Dict]]]:
+    """検索する質問と、その埋め込みを用意する。
+
+    session があれば追加の質問を単独の質問に書き換え、同じセッションで同じ（または埋め込みが
+    SESSION_REUSE_THRESHOLD 以上に近い）質問を検索済みなら、その検索結果も返す（埋め込み・検索を省く）。
+
+    Returns:
+        (検索する質問, 埋め込み, 再利用する検索結果。なければ None)
+    """
+    standalone = await condense_query(query, session, trace)
+    if session is not None:
+        reused = session.find_retrieval(scope, standalone)
+        if reused is not None:
+            trace.attrs["session_reuse"] = "exact"
+            return standalone, reused["embedding"], reused["docs"]
+    with trace.span("embed"):
+        q_emb = await aget_embedding(standalone)
+    if session is not None:
+        reused = session.find_retrieval(scope, standalone, q_emb)
+        if reused is not None:
+            trace.attrs["session_reuse"] = "similar"
+            return standalone, q_emb, reused["docs"]
+    return standalone, q_emb, None
+
+
+async def record_turn(
+    session: Optional[Session],
+    query: str,
+    standalone: str,
+    content: str,
+    scope: str,
+    q_emb,
+    docs: List[Dict],
+) -> None:
+    """ターンと検索結果をセッションに追加して保存する（失効までの時間も延びる）。"""
+    if session is None:
+        return
+    session.add_turn(query, standalone, content)
+    session.remember_retrieval(scope, standalone, q_emb, docs)
+    await asyncio.to_thread(get_session_store().save, session)
+
+
+def _cacheable(search_filter: Optional[SearchFilter]) -> bool:
+    # 絞り込み条件で回答が変わるため、条件付きの質問はキャッシュを引かず、保存もしない
+    return search_filter is None or search_filter.is_empty
+
+
+async def lookup_cached(
+    q_emb: list[float],
+    version: str,
+    search_filter: Optional[SearchFilter] = None,
+    collection: str = DEFAULT_COLLECTION,
+) -> Optional[CachedAnswer]:
+    """意味的に同じ質問への、コレクションのインデックスの version での回答がキャッシュにあれば返す。"""
+    cache = get_answer_cache(collection)
+    if cache is None or not _cacheable(search_filter):
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_search_pool, cache.lookup, q_emb, version)
+
+
+async def store_cached(
+    q_emb: list[float],
+    query: str,
+    content: str,
+    docs: List[Dict],
+    version: str,
+    search_filter: Optional[SearchFilter] = None,
+    collection: str = DEFAULT_COLLECTION,
+) -> None:
+    cache = get_answer_cache(collection)
+    if cache is None or not _cacheable(search_filter):
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_search_pool, cache.store, q_emb, query, content, docs, version)
+
+
+async def aanswer(
+    query: str,
+    retriever: Optional[Retriever] = None,
+    search_filter: Optional[SearchFilter] = None,
+    trace: Optional[Trace] = None,
+    collection: Optional[str] = None,
+    session: Optional[Session] = None,
+) -> Tuple[str, List[Dict]]:
+    """answer の非同期版。API サーバーから呼ばれる。
+
+    埋め込み・チャット補完は共有の AsyncOpenAI で、検索はスレッドプールで実行するため、
+    1ワーカーで多数の質問を同時に処理できる。
+    言い回しだけが違う既出の質問には、セマンティックキャッシュの回答をそのまま返す。
+    collection（省略時は default）のコレクションから回答し、回答キャッシュもコレクションごとに引く。
+    retriever を省略した場合は、呼び出し時点で公開中のスナップショットで検索する。
+    search_filter があれば、条件に一致するチャンクだけから回答する（キャッシュは使わない）。
+    各段階の所要時間とトークン数は trace（省略時は新しく作る）に記録し、成功したら finish する。
+    session があれば会話の続きとして扱い、追加の質問を単独の質問に書き換えてから検索・回答し、
+    ターン（書き換えた質問を含む）を session に追加して保存する。
+    """
+    collection = get_collection(collection).name
+    retriever = retriever or get_retriever(collection)
+    trace = trace or Trace("ask")
+    trace.attrs["collection"] = collection
+    trace.attrs["index_version"] = retriever.version
+    scope = _session_scope(collection, retriever.version, search_filter)
+    # 1. 質問の書き換え（セッションの続きの場合）とクエリ埋め込み
+    standalone, q_emb, docs = await prepare_query(query, session, scope, trace)
+
+    with trace.span("cache"):
+        cached = await lookup_cached(q_emb, retriever.version, search_filter, collection)
+    if cached is not None:
+        trace.cached = True
+        await record_turn(session, query, standalone, cached.answer, scope, q_emb, cached.docs)
+        trace.finish()
+        return cached.answer, cached.docs
+
+    # 2. 類似チャンク検索（同じセッションで検索済みなら省く）
+    if docs is None:
+        with trace.span("search"):
+            docs = await search(
+                q_emb, k=top_k(), query=standalone, retriever=retriever, search_filter=search_filter
+            )
+    trace.attrs["chunks"] = len(docs)
+
+    # 3. コンテキスト組み立て
+    with trace.span("assemble"):
+        messages = build_messages(standalone, docs)
+
+    with trace.span("llm"):
+        content = await _acomplete(messages, trace)
+    await store_cached(q_emb, standalone, content, docs, retriever.version, search_filter, collection)
+    await record_turn(session, query, standalone, content, scope, q_emb, docs)
+    trace.finish()
+    return content, docs
+
+
+async def astream_answer(
+    query: str,
+    retriever: Optional[Retriever] = None,
+    search_filter: Optional[SearchFilter] = None,
+    trace: Optional[Trace] = None,
+    collection: Optional[str] = None,
+    session: Optional[Session] = None,
+) -> AsyncIterator[Dict]:
+    """回答をストリーミングで返す。
+
+    以下のイベントを順に yield する。
+        {"type": "sources", "sources": [...]}         検索結果（生成開始前）
+        {"type": "token", "delta": "..."}             生成されたテキストの差分
+        {"type": "done", "usage": {...}, "timing": {...}, "cached": bool}  トークン数と各段階の所要時間（ms）
+
+    キャッシュに当たった場合は回答全体を1つの token イベントで返し、usage は None になる。
+    timing のキーは Trace.timing_ms と同じ（ttft_ms は質問の受け付けから最初のトークンまで）。
+    session の扱いは aanswer と同じ（ターンは回答を最後まで生成してから保存する）。
+    途中で失敗した場合やクライアントの切断で中断された場合も、trace は finish してメトリクスに残す。
+    """
+    collection = get_collection(collection).name
+    retriever = retriever or get_retriever(collection)
+    trace = trace or Trace("stream")
+    trace.attrs["collection"] = collection
+    trace.attrs["index_version"] = retriever.version
+    try:
+        async for ev in _stream_events(query, retriever, search_filter, trace, collection, session):
+            yield ev
+    except Exception as e:
+        trace.finish(error=repr(e))
+        raise
+    finally:
+        # 切断による中断（CancelledError / GeneratorExit）は Exception ではないため、ここで記録する
+        if not trace.finished:
+            trace.finish(error="client disconnected")
+
+
+async def _stream_events(
+    query: str,
+    retriever: Retriever,
+    search_filter: Optional[SearchFilter],
+    trace: Trace,
+    collection: str,
+    session: Optional[Session],
+) -> AsyncIterator[Dict]:
+    scope = _session_scope(collection, retriever.version, search_filter)
+    standalone, q_emb, docs = await prepare_query(query, session, scope, trace)
+
+    with trace.span("cache"):
+        cached = await lookup_cached(q_emb, retriever.version, search_filter, collection)
+    if cached is not None:
+        trace.cached = True
+        yield {"type": "sources", "sources": cached.docs}
+        trace.mark_first_token()
+        yield {"type": "token", "delta": cached.answer}
+        await record_turn(session, query, standalone, cached.answer, scope, q_emb, cached.docs)
+        yield {"type": "done", "usage": None, "timing": trace.finish(), "cached": True}
+        return
+    if docs is None:
+        with trace.span("search"):
+            docs = await search(
+                q_emb, k=top_k(), query=standalone, retriever=retriever, search_filter=search_filter
+            )
+    trace.attrs["chunks"] = len(docs)
+    yield {"type": "sources", "sources": docs}
+
+    with trace.span("assemble"):
+        messages = build_messages(standalone, docs)
+    usage = None
+    parts: List[str] = []
+    llm_started = time.perf_counter()
+    async for chunk in llm_client.astream_chat(messages):
+        if chunk.usage is not None:
+            usage = chunk.usage.model_dump()
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            trace.mark_first_token()
+            parts.append(delta)
+            yield {"type": "token", "delta": delta}
+    # クライアントへの送出を待つ時間も含む
+    trace.stages["llm"] = time.perf_counter() - llm_started
+    # 空の応答でも ttft_ms を返す
+    trace.mark_first_token()
+    trace.add_usage(usage)
+
+    content = "".join(parts)
+    await store_cached(q_emb, standalone, content, docs, retriever.version, search_filter, collection)
+    await record_turn(session, query, standalone, content, scope, q_emb, docs)
+    yield {"type": "done", "usage": usage, "timing": trace.finish(), "cached": False}
+
+
+def _check_batch(queries: List[str]) -> List[Dict]:
+    """結果リストを用意し、空の質問にはあらかじめエラーを入れておく。"""
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise ValueError(f"Too many queries in one batch: {len(queries)} > {BATCH_MAX_QUERIES}")
+    return [
+        {"answer": None, "sources": [], "error": None if q and q.strip() else "empty query"}
+        for q in queries
+    ]
+
+
+def answer_many(
+    queries: List[str],
+    k: Optional[int] = None,
+    max_concurrency: int = BATCH_LLM_CONCURRENCY,
+    search_filter: Optional[SearchFilter] = None,
+    trace: Optional[Trace] = None,
+    collection: Optional[str] = None,
+) -> List[Dict]:
+    """複数の質問にまとめて回答する。
+
+    埋め込みは get_embeddings でバッチ取得し、検索はクエリ行列に対する1回の index.search で行い、
+    chat 補完だけを max_concurrency 並列で投げる。1件の失敗でバッチ全体を失敗させない。
+
+    Args:
+        queries: 質問のリスト（最大 BATCH_MAX_QUERIES 件）
+        k: 1質問あたりの検索件数（省略時は top_k()）
+        max_concurrency: 同時に投げる chat リクエスト数
+        search_filter: 全質問に共通の絞り込み条件
+        trace: バッチ全体の段階ごとの所要時間とトークン数の記録先
+        collection: 検索するコレクション（省略時は default）
+
+    Returns:
+        queries と同じ順序の {"answer", "sources", "error"} のリスト。失敗した項目は error にメッセージが入る
+    """
+    k = k or top_k()
+    trace = trace or Trace("answer_batch")
+    results = _check_batch(queries)
+    valid = [i for i, r in enumerate(results) if r["error"] is None]
+    trace.attrs["queries"] = len(valid)
+    if not valid:
+        trace.finish()
+        return results
+
+    try:
+        with trace.span("embed"):
+            embeddings = get_embeddings([queries[i] for i in valid])
+    except Exception as e:
+        logger.exception("Batch embedding failed")
+        for i in valid:
+            results[i]["error"] = f"embedding failed: {e}"
+        trace.finish(error=f"embedding failed: {e}")
+        return results
+    with trace.span("search"):
+        docs_list = get_retriever(collection).query_many(
+            embeddings, k=k, query_texts=[queries[i] for i in valid], search_filter=search_filter
+        )
+
+    def complete(i: int, docs: List[Dict]):
+        return llm_client.chat(build_messages(queries[i], docs))
+
+    with trace.span("llm"), ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+        futures = {pool.submit(complete, i, docs): (i, docs) for i, docs in zip(valid, docs_list)}
+        for fut in as_completed(futures):
+            i, docs = futures[fut]
+            results[i]["sources"] = docs
+            try:
+                resp = fut.result()
+            except Exception as e:
+                logger.warning(f"Answer failed for batch item {i}: {e}")
+                results[i]["error"] = str(e)
+                continue
+            trace.add_usage(resp.usage)
+            results[i]["answer"] = resp.choices[0].message.content
+    trace.finish()
+    return results
+
+
+async def aanswer_many(
+    queries: List[str],
+    k: Optional[int] = None,
+    max_concurrency: int = BATCH_LLM_CONCURRENCY,
+    retriever: Optional[Retriever] = None,
+    search_filter: Optional[SearchFilter] = None,
+    trace: Optional[Trace] = None,
+    collection: Optional[str] = None,
+) -> List[Dict]:
+    """answer_many の非同期版。/ask/batch から呼ばれる。
+
+    セマンティックキャッシュに当たった質問は検索・chat 補完を省く。
+    chat 補完はバッチ内で max_concurrency 件まで、プロセス全体では LLM_MAX_CONCURRENCY 件までに制限される。
+    バッチ内の質問は全て同じスナップショット（retriever、省略時は呼び出し時点で公開中のもの）で検索する。
+    """
+    collection = get_collection(collection).name
+    retriever = retriever or get_retriever(collection)
+    k = k or top_k()
+    trace = trace or Trace("batch")
+    trace.attrs["collection"] = collection
+    trace.attrs["index_version"] = retriever.version
+    results = _check_batch(queries)
+    valid = [i for i, r in enumerate(results) if r["error"] is None]
+    trace.attrs["queries"] = len(valid)
+    if not valid:
+        trace.finish()
+        return results
+
+    try:
+        # 埋め込みのバッチ取得（キャッシュ・リトライ込み）は同期 API なのでスレッドで実行する
+        with trace.span("embed"):
+            embeddings = await asyncio.to_thread(get_embeddings, [queries[i] for i in valid])
+    except Exception as e:
+        logger.exception("Batch embedding failed")
+        for i in valid:
+            results[i]["error"] = f"embedding failed: {e}"
+        trace.finish(error=f"embedding failed: {e}")
+        return results
+
+    pending = []
+    with trace.span("cache"):
+        for i, q_emb in zip(valid, embeddings):
+            cached = await lookup_cached(q_emb, retriever.version, search_filter, collection)
+            if cached is not None:
+                results[i].update(answer=cached.answer, sources=cached.docs)
+            else:
+                pending.append((i, q_emb))
+    trace.attrs["cache_hits"] = len(valid) - len(pending)
+    if not pending:
+        trace.cached = True
+        trace.finish()
+        return results
+
+    loop = asyncio.get_running_loop()
+    texts = [queries[i] for i, _ in pending]
+    with trace.span("search"):
+        docs_list = await loop.run_in_executor(
+            _search_pool,
+            partial(
+                retriever.query_many,
+                np.stack([e for _, e in pending]),
+                k,
+                query_texts=texts,
+                search_filter=search_filter,
+            ),
+        )
+    batch_semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def complete(i: int, q_emb: np.ndarray, docs: List[Dict]) -> None:
+        results[i]["sources"] = docs
+        try:
+            async with batch_semaphore:
+                content = await _acomplete(build_messages(queries[i], docs), trace)
+        except Exception as e:
+            logger.warning(f"Answer failed for batch item {i}: {e}")
+            results[i]["error"] = str(e)
+            return
+        results[i]["answer"] = content
+        await store_cached(q_emb, queries[i], content, docs, retriever.version, search_filter, collection)
+
+    with trace.span("llm"):
+        await asyncio.gather(*(complete(i, e, docs) for (i, e), docs in zip(pending, docs_list)))
+    trace.finish()
+    return results
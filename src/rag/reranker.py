@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.config import (
+    RERANK_MODEL,
+    RERANK_BUDGET_MS,
+    RERANK_BATCH_SIZE,
+    RERANK_MAX_LENGTH,
+    RERANK_THREADS,
+    RERANK_QUANTIZE,
+    RERANK_CACHE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# レイテンシの統計に残すサンプル数
+_LATENCY_SAMPLES = 1000
+
+
+class CrossEncoderReranker:
+    """ローカルの cross-encoder で (質問, チャンク) の組をスコアリングし、検索の候補を並べ替える。
+
+    推論は専用の1スレッドで1ジョブずつ実行し（バッチ内の並列化は torch のスレッドに任せる）、
+    呼び出し側は予算（budget_ms）までしか待たない。間に合わなければ1段目の順位をそのまま返し、
+    まだ始まっていないジョブは取り消す。始まっていたジョブはそのまま終わらせ、結果をキャッシュに残す。
+    スコアは (質問, チャンク本文) のハッシュごとに LRU でキャッシュする。
+    モデルは最初の推論（または warmup）のときに推論スレッドで読み込む。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        threads: int,
+        batch_size: int,
+        max_length: int,
+        quantize: str,
+        cache_size: int,
+    ) -> None:
+        if quantize not in ("", "int8"):
+            raise ValueError(f"Unknown RERANK_QUANTIZE: {quantize} (expected '' or 'int8')")
+        self.model_name = model_name
+        self.threads = threads
+        self.batch_size = max(1, batch_size)
+        self.max_length = max_length
+        self.quantize = quantize
+        self.cache_size = cache_size
+        self._model = None
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        self._cache: "OrderedDict[bytes, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.pairs_scored = 0
+        self._latency: deque = deque(maxlen=_LATENCY_SAMPLES)
+
+    def _load(self):
+        if self._model is None:
+            try:
+                import torch
+                from sentence_transformers import CrossEncoder
+            except ImportError as e:
+                raise ImportError("Reranking requires sentence-transformers: pip install sentence-transformers") from e
+            torch.set_num_threads(max(1, self.threads))
+            model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+            if self.quantize == "int8":
+                model.model = torch.ao.quantization.quantize_dynamic(
+                    model.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            self._model = model
+            logger.info(
+                f"Loaded reranker {self.model_name} (threads={self.threads}, quantize={self.quantize or 'none'})"
+            )
+        return self._model
+
+    def warmup(self) -> None:
+        """推論スレッドでモデルを読み込んでおく（完了は待たない）。"""
+        self._pool.submit(self._load)
+
+    @staticmethod
+    def _key(query: str, text: str) -> bytes:
+        return hashlib.blake2b(f"{query}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    def _score(self, pairs: List[Tuple[str, str]], keys: List[bytes]) -> None:
+        """推論スレッドで実行する。スコアはキャッシュに入れる。"""
+        model = self._load()
+        # 長さの近い組を同じバッチにしてパディングを減らす
+        order = np.argsort([len(q) + len(t) for q, t in pairs], kind="stable")
+        scores = model.predict(
+            [pairs[i] for i in order], batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False
+        )
+        with self._lock:
+            self.pairs_scored += len(pairs)
+            for i, score in zip(order, np.asarray(scores, dtype="float32").reshape(len(pairs), -1)[:, -1]):
+                self._cache[keys[i]] = float(score)
+                self._cache.move_to_end(keys[i])
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank_many(
+        self,
+        queries: List[str],
+        candidates: List[List[Dict]],
+        k: int,
+        budget_ms: float = RERANK_BUDGET_MS,
+    ) -> List[List[Dict]]:
+        """質問ごとの候補をスコア順に並べ替えて上位k件を返す。
+
+        全質問のうちキャッシュにない組だけを1ジョブで推論する。budget_ms 以内に終わらない場合や
+        推論に失敗した場合は、全質問とも1段目の順位の上位k件を返す。
+        """
+        started = time.perf_counter()
+        keys = [[self._key(q, d["text"]) for d in docs] for q, docs in zip(queries, candidates)]
+        with self._lock:
+            self.requests += 1
+            missing = {key: (q, d["text"]) for q, docs, ks in zip(queries, candidates, keys)
+                       for d, key in zip(docs, ks) if key not in self._cache}
+            self.cache_hits += sum(len(ks) for ks in keys) - len(missing)
+
+        if missing:
+            fut = self._pool.submit(self._score, list(missing.values()), list(missing))
+            try:
+                fut.result(timeout=max(0.0, budget_ms / 1000 - (time.perf_counter() - started)))
+            except FutureTimeout:
+                fut.cancel()
+                with self._lock:
+                    self.fallbacks += 1
+                logger.info(f"Reranking {len(missing)} pairs exceeded {budget_ms:.0f}ms; using first-stage order")
+                return [docs[:k] for docs in candidates]
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.warning(f"Reranking failed; using first-stage order: {e}")
+                return [docs[:k] for docs in candidates]
+
+        results = []
+        with self._lock:
+            for docs, ks in zip(candidates, keys):
+                # 予算内に終わっていれば全組がキャッシュにある（直後に押し出された分は最下位扱い）
+                scores = np.array([self._cache.get(key, -np.inf) for key in ks], dtype="float64")
+                top = np.argsort(-scores, kind="stable")[:k]
+                results.append([docs[i] for i in top])
+            self._latency.append(time.perf_counter() - started)
+        return results
+
+    def stats(self) -> Dict:
+        with self._lock:
+            latency = np.asarray(self._latency, dtype="float64") * 1000
+            return {
+                "model": self.model_name,
+                "loaded": self._model is not None,
+                "requests": self.requests,
+                "fallbacks": self.fallbacks,
+                "errors": self.errors,
+                "cache_hits": self.cache_hits,
+                "pairs_scored": self.pairs_scored,
+                "cache_entries": len(self._cache),
+                "p50_ms": float(np.percentile(latency, 50)) if len(latency) else 0.0,
+                "p99_ms": float(np.percentile(latency, 99)) if len(latency) else 0.0,
+            }
+
+
+_reranker: Optional[CrossEncoderReranker] = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Optional[CrossEncoderReranker]:
+    """RERANK_MODEL の再ランキング器（プロセス内で共有）。RERANK_MODEL が空なら None。"""
+    global _reranker
+    if not RERANK_MODEL:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker(
+                    RERANK_MODEL,
+                    RERANK_THREADS,
+                    RERANK_BATCH_SIZE,
+                    RERANK_MAX_LENGTH,
+                    RERANK_QUANTIZE,
+                    RERANK_CACHE_SIZE,
+                )
+    return _reranker
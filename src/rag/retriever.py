@@ -1,43 +1,347 @@
-import json
+import logging
 import os
-from typing import List, Dict
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict, Optional
 
 import numpy as np
-try:
-    import faiss
-except ImportError:
-    # faiss-cpu の場合
-    from faiss import swigfaiss as faiss
 
-from src.config import FAISS_INDEX_PATH, FAISS_META_PATH, VECTORSTORE_DIR
+from src.config import (
+    VECTORSTORE_DIR,
+    INDEX_RELOAD_INTERVAL,
+    FILTER_EXACT_MAX,
+    FILTER_MAX_EXPANSION,
+    RERANK_CANDIDATES,
+    RETRIEVAL_MODE,
+    HYBRID_CANDIDATES,
+    RRF_K,
+    RESCORE_OVERSAMPLE,
+)
+from src.ingestion.manifest import load_manifest
+from src.models.embedder import embed_model_id
+from src.rag.chunk_store import ChunkStore
+from src.rag.filters import FilterIndex, SearchFilter, Selection
+from src.rag.full_vectors import open_full_vectors, rescore
+from src.rag.index_factory import faiss, load_params, prepare_vectors, search_parameters
+from src.rag.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from src.rag.reranker import get_reranker
+from src.rag.shards import index_bytes, read_sharded_index
+from src.rag.snapshots import current_snapshot
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+
+
+def index_version(index_dir: str | Path) -> str:
+    """ベクトルストアのバージョンを返す。
+
+    マニフェストに記録されたビルドバージョンを使い、マニフェストのない古いストアでは
+    index.faiss のサイズと更新時刻から作る。
+    """
+    manifest = load_manifest(Path(index_dir) / "manifest.json")
+    if manifest and manifest.get("version"):
+        return manifest["version"]
+    st = os.stat(Path(index_dir) / "index.faiss")
+    return f"legacy-{st.st_size}-{st.st_mtime_ns}"
+
+
+def check_embed_model(index_dir: str | Path) -> None:
+    """インデックスを作った埋め込みモデルが現在の EMBED_MODEL と違えば ValueError。
+
+    別モデルのクエリ埋め込みで検索しても結果は無意味なので、読み込みを拒否する。
+    マニフェストのない古いストアは確認できないため警告のみ。
+    """
+    manifest = load_manifest(Path(index_dir) / "manifest.json")
+    if manifest is None:
+        logger.warning(f"No manifest in {index_dir}; cannot check which embedding model built the index")
+        return
+    built_with = manifest.get("embed_model")
+    if built_with != embed_model_id():
+        raise ValueError(
+            f"Index in {index_dir} was built with embedding model {built_with!r}, "
+            f"but EMBED_MODEL is {embed_model_id()!r}; rebuild it with python -m src.ingestion.build_index"
+        )
+
+
+def _load_lexical(lexical_dir: Path, n_rows: int) -> Optional[LexicalIndex]:
+    if not Path(lexical_dir).exists():
+        logger.warning(f"Lexical index not found at {lexical_dir}; using vector search only")
+        return None
+    lexical = LexicalIndex(lexical_dir)
+    if len(lexical) != n_rows:
+        logger.warning("Lexical index does not match the chunk store; using vector search only")
+        return None
+    return lexical
+
+
+def _load_filters(filters_dir: Path, store: ChunkStore) -> Optional[FilterIndex]:
+    if not (filters_dir / "header.json").exists():
+        logger.warning(f"Filter index not found at {filters_dir}; filtered search needs a rebuild")
+        return None
+    try:
+        return FilterIndex(filters_dir, store.ids)
+    except ValueError as e:
+        logger.warning(f"{e}; filtered search needs a rebuild")
+        return None
 
 
 class Retriever:
-    def __init__(self, index_path: str = FAISS_INDEX_PATH, meta_path: str = FAISS_META_PATH) -> None:
-        # FAISSは日本語パスを扱えないため、作業ディレクトリを変更して読み込む
-        original_dir = os.getcwd()
-        try:
-            os.chdir(VECTORSTORE_DIR)
-            self.index = faiss.read_index("index.faiss")
-        finally:
-            os.chdir(original_dir)
-        
-        with open(meta_path, encoding="utf-8") as f:
-            meta = json.load(f)
-        self.texts: List[str] = meta["texts"]
-        self.metadatas: List[Dict] = meta["metadatas"]
-
-    def query(self, query_embedding: list[float], k: int = 5) -> List[Dict]:
-        """クエリ埋め込みに近いチャンクを上位k件返す。"""
-        vec = np.array([query_embedding], dtype="float32")
-        distances, indices = self.index.search(vec, k)
-
-        results: List[Dict] = []
-        for idx in indices[0]:
-            results.append(
-                {
-                    "text": self.texts[idx],
-                    "metadata": self.metadatas[idx],
-                }
+    def __init__(self, index_dir: Optional[str | Path] = None) -> None:
+        """index_dir のスナップショットを読み込む。省略時は公開中（current）のスナップショット。"""
+        if index_dir is None:
+            index_dir = current_snapshot()
+            if index_dir is None:
+                raise FileNotFoundError(
+                    f"No index found in {VECTORSTORE_DIR}; build it with python -m src.ingestion.build_index"
+                )
+        index_dir = Path(index_dir)
+        self.index_dir = index_dir
+        check_embed_model(index_dir)
+        # インデックスの種類・正規化の有無・検索時パラメータの既定値・シャード数
+        self.params = load_params(index_dir)
+        # シャードが複数あれば、全シャードを並列に検索して上位k件をマージする ShardedIndex
+        self.index = read_sharded_index(index_dir, self.params)
+        # 本文・メタデータは mmap で開くだけで、検索結果の k 件だけを取り出す
+        self.store = ChunkStore(index_dir / "chunks")
+        # 圧縮・切り詰めたインデックスの候補を並べ直す全精度ベクトル（mmap。行番号はチャンクストアと同じ）
+        self.vectors = open_full_vectors(index_dir, self.params)
+        if self.vectors is not None and len(self.vectors) != len(self.store):
+            logger.warning("Full-precision vectors do not match the chunk store; results keep the compressed scores")
+            self.vectors = None
+        # BM25 の転置インデックス（行番号はチャンクストアと同じ）。ない場合はベクトル検索のみ
+        self.lexical = _load_lexical(index_dir / "lexical", len(self.store))
+        # ファイル・種類・更新時刻・タグによる絞り込み用の属性（行番号はチャンクストアと同じ）
+        self.filters = _load_filters(index_dir / "filters", self.store)
+        # ビルドごとに変わる識別子。回答キャッシュの無効化に使う
+        self.version = index_version(index_dir)
+        # プロセスのヒープに読み込む FAISS インデックスの大きさ（チャンクストア・全精度ベクトルは mmap なので含めない）。
+        # コレクションをメモリ予算内に収めるのに使う
+        self.memory_bytes = index_bytes(index_dir, self.params)
+
+    def query(
+        self,
+        query_embedding: Optional[list[float]],
+        k: int = 5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        query_text: Optional[str] = None,
+        mode: Optional[str] = None,
+        search_filter: Optional[SearchFilter] = None,
+        rerank: Optional[bool] = None,
+    ) -> List[Dict]:
+        """クエリに近いチャンクを上位k件返す。
+
+        nprobe（IVF）/ ef_search（HNSW）を指定すると、ビルド時の既定値を上書きして検索する。
+        mode は vector / lexical / hybrid（省略時は RETRIEVAL_MODE）。lexical・hybrid には query_text が必要で、
+        query_text がない場合や BM25 インデックスがない場合はベクトル検索になる。
+        search_filter を渡すと、条件に一致するチャンクの中での上位k件を返す。
+        RERANK_MODEL が設定されていれば、query_text で候補を再ランキングする（rerank=False で無効）。
+        """
+        texts = [query_text] if query_text is not None else None
+        return self.query_many(
+            [query_embedding],
+            k=k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            query_texts=texts,
+            mode=mode,
+            search_filter=search_filter,
+            rerank=rerank,
+        )[0]
+
+    def query_many(
+        self,
+        query_embeddings,
+        k: int = 5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        query_texts: Optional[List[str]] = None,
+        mode: Optional[str] = None,
+        search_filter: Optional[SearchFilter] = None,
+        rerank: Optional[bool] = None,
+    ) -> List[List[Dict]]:
+        """複数クエリをまとめて検索する。
+
+        クエリ行列に対して index.search を1回だけ呼ぶため、1件ずつ query を呼ぶより速い。
+        hybrid ではベクトル検索と BM25 の上位 HYBRID_CANDIDATES 件ずつを RRF で統合する。
+        search_filter は全クエリに共通で、ベクトル検索・BM25 とも検索の中で一致する行だけを候補にする
+        （上位を多めに取ってから捨てる後段の絞り込みはしない）。
+        再ランキングが有効な場合は、上位 RERANK_CANDIDATES 件を cross-encoder で並べ替えて上位k件にする
+        （RERANK_BUDGET_MS を超えたら1段目の順位のまま）。
+        戻り値はクエリと同じ順序の、上位k件のチャンクのリスト。
+        """
+        mode = mode or RETRIEVAL_MODE
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {mode} (expected one of {RETRIEVAL_MODES})")
+        if mode != "vector" and (self.lexical is None or query_texts is None):
+            mode = "vector"
+        selection = self._select(search_filter)
+        if selection is not None and selection.count == 0:
+            return [[] for _ in query_embeddings]
+        row_mask = selection.mask if selection is not None else None
+        reranker = get_reranker() if rerank is not False and query_texts is not None else None
+        # 再ランキングする場合は1段目で候補を多めに取る
+        fetch = max(k, RERANK_CANDIDATES) if reranker is not None else k
+
+        if mode == "vector":
+            rows = self._vector_rows(query_embeddings, fetch, nprobe, ef_search, selection)
+        elif mode == "lexical":
+            rows = [self.lexical.search(text, fetch, row_mask)[0] for text in query_texts]
+        else:
+            n = max(fetch, HYBRID_CANDIDATES)
+            vector_rows = self._vector_rows(query_embeddings, n, nprobe, ef_search, selection)
+            rows = [
+                reciprocal_rank_fusion([v.tolist(), self.lexical.search(text, n, row_mask)[0].tolist()], fetch, RRF_K)
+                for v, text in zip(vector_rows, query_texts)
+            ]
+        docs = [[self.store.get(int(row)) for row in q_rows] for q_rows in rows]
+        if reranker is not None:
+            docs = reranker.rerank_many(query_texts, docs, k)
+        return docs
+
+    def _select(self, search_filter: Optional[SearchFilter]) -> Optional[Selection]:
+        """フィルタに一致する行。フィルタがなければ None。"""
+        if search_filter is None or search_filter.is_empty:
+            return None
+        if self.filters is None:
+            raise ValueError(
+                f"Index in {self.index_dir} has no filter index; "
+                "rebuild it with python -m src.ingestion.build_index to use filters"
             )
-        return results
\ No newline at end of file
+        return self.filters.select(search_filter)
+
+    def _vector_rows(
+        self,
+        query_embeddings,
+        k: int,
+        nprobe: Optional[int],
+        ef_search: Optional[int],
+        selection: Optional[Selection] = None,
+    ) -> List[np.ndarray]:
+        """ベクトル検索の結果をチャンクストアの行番号で返す。
+
+        selection があれば IDSelectorBitmap で一致するチャンクIDだけを検索の中で候補にする。
+        一致が FILTER_EXACT_MAX 件以下の場合、IVF は全リストを走査し（一致しない点は距離を計算しない）、
+        HNSW は一致したベクトルだけを総当たりする。それより多い場合は一致する割合に応じて
+        nprobe / efSearch を最大 FILTER_MAX_EXPANSION 倍に広げる。
+        全精度ベクトルがある（圧縮・切り詰めたインデックス）場合は k * RESCORE_OVERSAMPLE 件を候補に取り、
+        全次元の内積で並べ直して上位k件にする。
+        """
+        vecs = prepare_vectors(query_embeddings, self.params)
+        if self.vectors is not None:
+            full = prepare_vectors(query_embeddings, {"normalize": True})
+            fetch = k * max(1, RESCORE_OVERSAMPLE)
+        else:
+            full, fetch = None, k
+        if selection is None:
+            params = search_parameters(self.params, nprobe=nprobe, ef_search=ef_search)
+        elif self.params["type"] == "hnsw" and selection.count <= FILTER_EXACT_MAX:
+            # HNSW のグラフ探索は一致しない点も辿るため、一致が少ないと上位k件に届く前に探索が終わる
+            return self._exact_rows(vecs if full is None else full, k, selection)
+        else:
+            if selection.count <= FILTER_EXACT_MAX:
+                expansion = float(self.params.get("nlist", 1))
+            else:
+                expansion = min(FILTER_MAX_EXPANSION, len(self.store) / selection.count)
+            sel = faiss.IDSelectorBitmap(len(selection.id_bitmap), faiss.swig_ptr(selection.id_bitmap))
+            params = search_parameters(self.params, nprobe=nprobe, ef_search=ef_search, sel=sel, expansion=expansion)
+        distances, indices = self.index.search(vecs, fetch, params=params)
+
+        # インデックスの件数が k 未満の場合は -1 が返り、行番号も -1 になる
+        rows = self.store.rows_of(indices.ravel()).reshape(indices.shape)
+        rows = [q_rows[q_rows >= 0] for q_rows in rows]
+        if full is not None:
+            rows = rescore(self.vectors, full, rows, k)
+        return rows
+
+    def _exact_rows(self, vecs: np.ndarray, k: int, selection: Selection) -> List[np.ndarray]:
+        """一致したチャンクのベクトルだけを取り出して総当たりで検索する。
+
+        全精度ベクトルがあればそれを使う（vecs は全次元のクエリ）。なければインデックスから復元する。
+        """
+        if self.vectors is not None:
+            base = np.ascontiguousarray(self.vectors[selection.rows], dtype="float32")
+        else:
+            base = self.index.reconstruct_batch(self.store.ids[selection.rows])
+        metric = faiss.METRIC_INNER_PRODUCT if self.params["metric"] == "ip" else faiss.METRIC_L2
+        _, indices = faiss.knn(vecs, base, min(k, selection.count), metric=metric)
+        return [selection.rows[q[q >= 0]] for q in indices]
+
+
+class RetrieverHolder:
+    """ベクトルストア（store_dir）の公開中のスナップショットの Retriever を保持し、current ポインタが変わったら差し替える。
+
+    新しい Retriever はバックグラウンドのスレッドで読み込み、読み込みが終わってから参照を1回の代入で
+    入れ替える。リクエストは開始時に get() で取得した Retriever を最後まで使うので、処理中のリクエストは
+    古いスナップショットのまま完了し、古い Retriever は参照がなくなった時点で解放される。
+    """
+
+    def __init__(self, store_dir: Path = VECTORSTORE_DIR, interval: float = INDEX_RELOAD_INTERVAL) -> None:
+        self.store_dir = Path(store_dir)
+        self.interval = interval
+        snapshot = current_snapshot(self.store_dir)
+        if snapshot is None:
+            raise FileNotFoundError(
+                f"No index found in {self.store_dir}; build it with python -m src.ingestion.build_index"
+            )
+        self._retriever = Retriever(snapshot)
+        self.loaded_at = time.time()
+        self.reloads = 0
+        self.last_error: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self) -> Retriever:
+        return self._retriever
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._retriever.memory_bytes
+
+    def reload_if_changed(self) -> bool:
+        """current ポインタが今のスナップショットと違えば読み込み直す。差し替えたら True。"""
+        snapshot = current_snapshot(self.store_dir)
+        if snapshot is None or snapshot == self._retriever.index_dir:
+            return False
+        started = time.perf_counter()
+        retriever = Retriever(snapshot)
+        old, self._retriever = self._retriever, retriever
+        self.loaded_at = time.time()
+        self.reloads += 1
+        self.last_error = None
+        logger.info(
+            f"Swapped index {old.version} -> {retriever.version} "
+            f"({len(retriever.store)} chunks, loaded in {time.perf_counter() - started:.2f}s)"
+        )
+        return True
+
+    def check(self) -> None:
+        """reload_if_changed を呼び、失敗は last_error に記録する（例外は投げない）。"""
+        try:
+            self.reload_if_changed()
+        except Exception as e:
+            # 読み込みに失敗した（ビルド直後に削除された・モデル不一致など）場合は今の版で検索を続け、次の確認で再試行する
+            if str(e) != self.last_error:
+                logger.warning(f"Index reload failed; keeping version {self._retriever.version}: {e}")
+            self.last_error = str(e)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self) -> None:
+        """current ポインタの監視を始める。interval が 0 以下なら何もしない。"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="index-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
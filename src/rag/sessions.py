@@ -0,0 +1,335 @@
+import base64
+import hashlib
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.config import (
+    SESSION_BACKEND,
+    SESSION_DB_PATH,
+    SESSION_TTL,
+    SESSION_MAX_SESSIONS,
+    SESSION_HISTORY_TURNS,
+    SESSION_CACHE_ENTRIES,
+    SESSION_REUSE_THRESHOLD,
+)
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKENDS = ("memory", "sqlite")
+
+
+def new_session_id() -> str:
+    # 推測できない ID にする（ID を知っていれば誰でも会話の続きを読める）
+    return secrets.token_urlsafe(16)
+
+
+@dataclass
+class Session:
+    """1つの会話。直近のターンと、書き換えた質問・検索結果のセッション内キャッシュを持つ。
+
+    turns は {"query", "standalone_query", "answer"} のリスト（古い順）。
+    rewrites は書き換えのキー（rewrite_key）-> 単独の質問。
+    retrievals は {"scope", "query", "embedding", "docs"} のリスト（古い順）で、scope（コレクション・
+    インデックスのバージョン・絞り込み条件）が同じものだけを再利用する。いずれも SESSION_CACHE_ENTRIES 件まで。
+    """
+
+    id: str
+    created: float
+    updated: float
+    turns: List[Dict] = field(default_factory=list)
+    rewrites: "OrderedDict[str, str]" = field(default_factory=OrderedDict)
+    retrievals: List[Dict] = field(default_factory=list)
+
+    def history(self) -> List[Dict]:
+        """書き換えに使う直近の SESSION_HISTORY_TURNS ターン。"""
+        return self.turns[-SESSION_HISTORY_TURNS:] if SESSION_HISTORY_TURNS > 0 else []
+
+    def rewrite_key(self, query: str) -> str:
+        # 直近の会話（単独の質問に直したもの）と追加の質問が同じなら、同じ書き換えになる
+        recent = [turn["standalone_query"] for turn in self.history()]
+        return hashlib.sha256(json.dumps([recent, query], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def find_rewrite(self, key: str) -> Optional[str]:
+        standalone = self.rewrites.get(key)
+        if standalone is not None:
+            self.rewrites.move_to_end(key)
+        return standalone
+
+    def remember_rewrite(self, key: str, standalone: str) -> None:
+        self.rewrites[key] = standalone
+        self.rewrites.move_to_end(key)
+        while len(self.rewrites) > SESSION_CACHE_ENTRIES:
+            self.rewrites.popitem(last=False)
+
+    def find_retrieval(self, scope: str, query: str, embedding=None) -> Optional[Dict]:
+        """同じ scope の過去の検索のうち、質問が同じもの（embedding があれば、コサイン類似度が
+        SESSION_REUSE_THRESHOLD 以上で最も近いもの）を返す。なければ None。"""
+        candidates = [r for r in self.retrievals if r["scope"] == scope]
+        for entry in candidates:
+            if entry["query"] == query:
+                return entry
+        if embedding is None or not candidates:
+            return None
+        vec = _unit(embedding)
+        sims = np.stack([_unit(r["embedding"]) for r in candidates]) @ vec
+        best = int(np.argmax(sims))
+        return candidates[best] if sims[best] >= SESSION_REUSE_THRESHOLD else None
+
+    def remember_retrieval(self, scope: str, query: str, embedding, docs: List[Dict]) -> None:
+        self.retrievals = [r for r in self.retrievals if not (r["scope"] == scope and r["query"] == query)]
+        self.retrievals.append(
+            {"scope": scope, "query": query, "embedding": np.asarray(embedding, dtype="float32"), "docs": docs}
+        )
+        del self.retrievals[:-SESSION_CACHE_ENTRIES]
+
+    def add_turn(self, query: str, standalone: str, answer: str) -> None:
+        self.turns.append({"query": query, "standalone_query": standalone, "answer": answer})
+        del self.turns[:-SESSION_CACHE_ENTRIES]
+
+    def to_json(self) -> str:
+        retrievals = [
+            {**r, "embedding": base64.b64encode(np.asarray(r["embedding"], dtype="<f4").tobytes()).decode("ascii")}
+            for r in self.retrievals
+        ]
+        return json.dumps(
+            {
+                "id": self.id,
+                "created": self.created,
+                "updated": self.updated,
+                "turns": self.turns,
+                "rewrites": list(self.rewrites.items()),
+                "retrievals": retrievals,
+            },
+            ensure_ascii=False,
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "Session":
+        d = json.loads(data)
+        retrievals = [
+            {**r, "embedding": np.frombuffer(base64.b64decode(r["embedding"]), dtype="<f4")}
+            for r in d["retrievals"]
+        ]
+        return cls(
+            id=d["id"],
+            created=d["created"],
+            updated=d["updated"],
+            turns=d["turns"],
+            rewrites=OrderedDict(d["rewrites"]),
+            retrievals=retrievals,
+        )
+
+
+def _unit(embedding) -> np.ndarray:
+    vec = np.asarray(embedding, dtype="float32")
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+class MemorySessionStore:
+    """ワーカーのプロセス内にセッションを保持するストア。
+
+    最後の質問から ttl 秒で失効し、件数が max_sessions を超えたら最終利用の古いものから削除する。
+    ワーカーが複数ある場合はワーカーごとに別のセッションになる（共有するなら SqliteSessionStore）。
+    """
+
+    def __init__(self, ttl: float, max_sessions: int) -> None:
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        # ID -> セッション（先頭ほど最終利用が古い）
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self) -> Session:
+        now = time.time()
+        session = Session(id=new_session_id(), created=now, updated=now)
+        with self._lock:
+            self.created += 1
+        self.save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """有効なセッションを返す。ない・失効した場合は None。"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.updated > self.ttl:
+                del self._sessions[session_id]
+                self.expired += 1
+                session = None
+            if session is None:
+                self.misses += 1
+                return None
+            # 並び順は save で更新する（最終利用と失効の判定を同じ順序にする）
+            self.hits += 1
+            return session
+
+    def save(self, session: Session) -> None:
+        session.updated = time.time()
+        with self._lock:
+            self._sessions[session.id] = session
+            self._sessions.move_to_end(session.id)
+            self._purge_expired(session.updated)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _purge_expired(self, now: float) -> None:
+        # 先頭ほど最終利用が古いので、失効していないものが出たら止める
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.updated <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "created": self.created,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated);
+"""
+
+
+class SqliteSessionStore:
+    """セッションを SQLite に保存するストア。WAL モードなので複数のワーカーから同じセッションを使える。
+
+    失効・件数の上限は MemorySessionStore と同じ（保存のたびに、失効したものと上限を超えた古いものを削除する）。
+    """
+
+    def __init__(self, path: str | Path, ttl: float, max_sessions: int) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def create(self) -> Session:
+        now = time.time()
+        session = Session(id=new_session_id(), created=now, updated=now)
+        with self._lock:
+            self.created += 1
+        self.save(session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT data, updated FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                self._conn.commit()
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return Session.from_json(row[0])
+
+    def save(self, session: Session) -> None:
+        session.updated = time.time()
+        data = session.to_json()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)",
+                (session.id, data, session.updated),
+            )
+            self.expired += self._conn.execute(
+                "DELETE FROM sessions WHERE updated < ?", (session.updated - self.ttl,)
+            ).rowcount
+            excess = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY updated LIMIT ?)", (excess,)
+                )
+                self.evicted += excess
+            self._conn.commit()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount
+            self._conn.commit()
+        return deleted > 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sessions = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "backend": "sqlite",
+            "sessions": sessions,
+            "created": self.created,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+_store: Optional[MemorySessionStore | SqliteSessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> MemorySessionStore | SqliteSessionStore:
+    """プロセス内で共有するセッションストア（SESSION_BACKEND）を返す。"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if SESSION_BACKEND == "memory":
+                    _store = MemorySessionStore(SESSION_TTL, SESSION_MAX_SESSIONS)
+                elif SESSION_BACKEND == "sqlite":
+                    _store = SqliteSessionStore(SESSION_DB_PATH, SESSION_TTL, SESSION_MAX_SESSIONS)
+                else:
+                    raise ValueError(
+                        f"Unknown SESSION_BACKEND: {SESSION_BACKEND!r} (expected one of {SESSION_BACKENDS})"
+                    )
+                logger.info(f"Conversation sessions: backend={SESSION_BACKEND}, ttl={SESSION_TTL:.0f}s")
+    return _store
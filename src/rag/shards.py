@@ -0,0 +1,132 @@
+import os
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+try:
+    import faiss
+except ImportError:
+    # faiss-cpu の場合
+    from faiss import swigfaiss as faiss
+
+from src.config import SHARD_THREADS
+from src.rag.index_io import read_index, write_index
+
+
+# ファイル構成（スナップショット内）
+#   シャード数 1   index.faiss
+#   シャード数 N   index.000.faiss 〜 index.<N-1>.faiss（シャード数は index_params.json の shards）
+# チャンクストア・BM25・フィルタ用の属性は全シャードで共通（行番号・チャンクIDはシャードをまたいで一意）
+
+
+def n_shards(params: Dict) -> int:
+    return int(params.get("shards", 1))
+
+
+def shard_of(key: str, shards: int) -> int:
+    """ファイル（マニフェストのキー）を置くシャード。同じファイルのチャンクは同じシャードに入る。
+
+    プロセスごとに変わる hash() ではなく crc32 を使い、ビルドをまたいで同じシャードに割り当てる。
+    """
+    if shards <= 1:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def shard_file(shard: int, shards: int) -> str:
+    return "index.faiss" if shards <= 1 else f"index.{shard:03d}.faiss"
+
+
+def shard_paths(directory: str | Path, params: Dict) -> List[Path]:
+    shards = n_shards(params)
+    return [Path(directory) / shard_file(s, shards) for s in range(shards)]
+
+
+def index_bytes(directory: str | Path, params: Dict) -> int:
+    """インデックスファイルの合計サイズ（読み込むとほぼこの大きさのメモリを使う）。"""
+    return sum(os.path.getsize(path) for path in shard_paths(directory, params))
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def shard_pool() -> ThreadPoolExecutor:
+    """シャードの検索・構築に使うスレッドプール（プロセス内で共有）。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=SHARD_THREADS or os.cpu_count() or 1, thread_name_prefix="faiss-shard"
+                )
+    return _pool
+
+
+class ShardedIndex:
+    """シャードごとの FAISS インデックスを1つのインデックスとして検索する。
+
+    search は全シャードを shard_pool で並列に検索し（FAISS は検索中に GIL を解放する）、
+    シャードごとの上位k件を faiss.ResultHeap でマージする。チャンクIDはシャードをまたいで一意なので、
+    SearchParameters の IDSelector（絞り込み）はそのまま全シャードに渡せる。
+    Retriever からは search / reconstruct_batch / ntotal だけを使う。
+    """
+
+    def __init__(self, shards: Sequence) -> None:
+        self.shards = list(shards)
+        self.d = self.shards[0].d
+        self.metric_type = self.shards[0].metric_type
+        self.ntotal = sum(shard.ntotal for shard in self.shards)
+        # シャードごとのチャンクID（reconstruct_batch でどのシャードにあるかを引く）
+        self._ids = [np.sort(faiss.vector_to_array(shard.id_map)) for shard in self.shards]
+
+    def search(self, x: np.ndarray, k: int, params=None):
+        futures = [shard_pool().submit(shard.search, x, k, params=params) for shard in self.shards]
+        heap = faiss.ResultHeap(len(x), k, keep_max=self.metric_type == faiss.METRIC_INNER_PRODUCT)
+        for fut in futures:
+            # 件数が k 未満のシャードは -1 で埋まった結果を返すが、ヒープには入らない
+            heap.add_result(*fut.result())
+        heap.finalize()
+        return heap.D, heap.I
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype="int64")
+        out = np.empty((len(ids), self.d), dtype="float32")
+        for shard, shard_ids in zip(self.shards, self._ids):
+            pos = np.minimum(np.searchsorted(shard_ids, ids), max(len(shard_ids) - 1, 0))
+            mask = shard_ids[pos] == ids if len(shard_ids) else np.zeros(len(ids), dtype=bool)
+            if mask.any():
+                out[mask] = shard.reconstruct_batch(ids[mask])
+        return out
+
+
+def read_sharded_index(directory: str | Path, params: Dict):
+    """スナップショットのインデックスを読み込む。シャードが1つならそのまま、複数なら ShardedIndex。"""
+    paths = shard_paths(directory, params)
+    if len(paths) == 1:
+        return read_index(directory, paths[0].name)
+    return ShardedIndex([read_index(directory, path.name) for path in paths])
+
+
+def write_shards(shards: Sequence[Optional[object]], directory: str | Path, base_dir: Optional[Path] = None) -> None:
+    """シャードごとのインデックスを書き込む。
+
+    None のシャードは変更がないので、base_dir（前回のスナップショット）の同じファイルをハードリンクする
+    （ファイルシステムが対応していなければコピーする）。
+    """
+    count = len(shards)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for s, shard in enumerate(shards):
+        name = shard_file(s, count)
+        if shard is not None:
+            write_index(shard, directory, name)
+            continue
+        target = Path(directory) / name
+        try:
+            os.link(base_dir / name, target)
+        except OSError:
+            shutil.copy2(base_dir / name, target)
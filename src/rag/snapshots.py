@@ -0,0 +1,98 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from src.config import SNAPSHOT_KEEP, VECTORSTORE_DIR
+
+logger = logging.getLogger(__name__)
+
+# スナップショット導入前はベクトルストア直下に置いていたファイル・ディレクトリ
+# （metadata.json はチャンクストア導入前の形式）
+LEGACY_ENTRIES = ("index.faiss", "index_params.json", "manifest.json", "metadata.json", "chunks", "lexical")
+
+
+# 以下の store_dir はベクトルストアのディレクトリ（default コレクションは VECTORSTORE_DIR）
+
+
+def _pointer_path(store_dir: Path) -> Path:
+    return Path(store_dir) / "current"
+
+
+def snapshot_dir(version: str, store_dir: Path = VECTORSTORE_DIR) -> Path:
+    return Path(store_dir) / "snapshots" / version
+
+
+def read_pointer(store_dir: Path = VECTORSTORE_DIR) -> Optional[str]:
+    """current ポインタに書かれたスナップショット名。ポインタがなければ None。"""
+    try:
+        name = _pointer_path(store_dir).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    return name or None
+
+
+def current_snapshot(store_dir: Path = VECTORSTORE_DIR) -> Optional[Path]:
+    """公開中のスナップショットのディレクトリ。
+
+    ポインタがなく、ベクトルストア直下に旧形式のインデックスがある場合はそのディレクトリを返す。
+    どちらもなければ None。
+    """
+    name = read_pointer(store_dir)
+    if name is not None:
+        return snapshot_dir(name, store_dir)
+    if (Path(store_dir) / "index.faiss").exists():
+        return Path(store_dir)
+    return None
+
+
+def publish_snapshot(version: str, store_dir: Path = VECTORSTORE_DIR) -> None:
+    """current ポインタを version に切り替える。
+
+    一時ファイルに書いて fsync してから os.replace で置き換えるので、読み手には切り替え前か後の
+    どちらかの名前だけが見える。シンボリックリンクは Windows で権限が要るため使わない。
+    """
+    pointer = _pointer_path(store_dir)
+    tmp = pointer.with_name(pointer.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, pointer)
+
+
+def prune_snapshots(keep: int = SNAPSHOT_KEEP, store_dir: Path = VECTORSTORE_DIR) -> None:
+    """公開中のもの以外で、新しい方から keep 個を残して古いスナップショットを削除する。
+
+    バージョン名は作成日時で始まるので名前順が作成順になる。
+    削除に失敗した（Windows で API がまだファイルを開いている等）ものは次回のビルドで再び削除を試みる。
+    """
+    snapshots = Path(store_dir) / "snapshots"
+    if not snapshots.exists():
+        return
+    current = read_pointer(store_dir)
+    old = sorted(p for p in snapshots.iterdir() if p.is_dir() and p.name != current)
+    for path in old[:max(0, len(old) - keep)]:
+        try:
+            shutil.rmtree(path)
+            logger.info(f"Removed old snapshot {path.name}")
+        except OSError as e:
+            logger.warning(f"Could not remove old snapshot {path}: {e}")
+
+
+def remove_legacy_files(store_dir: Path = VECTORSTORE_DIR) -> None:
+    """スナップショットへ移行した後に、ベクトルストア直下の旧形式のファイルを削除する。"""
+    for name in LEGACY_ENTRIES:
+        path = Path(store_dir) / name
+        try:
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+            else:
+                continue
+        except OSError as e:
+            logger.warning(f"Could not remove legacy {path}: {e}")
+            continue
+        logger.info(f"Removed legacy {path}")
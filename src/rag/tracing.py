@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.config import SLOW_REQUEST_MS
+
+logger = logging.getLogger(__name__)
+
+# 所要時間のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 1リクエストのトークン数のバケット
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def format_counter(name: str, help_text: str, samples: Dict[Labels, float]) -> str:
+    """カウンタを Prometheus のテキスト形式にする。samples は ((ラベル名, 値), ...) -> 値。"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in samples.items()]
+    return "\n".join(lines) + "\n"
+
+
+class Histogram:
+    """ラベル付きのヒストグラム。observe はロック内でバケットの件数を1つ足すだけなので、ホットパスで呼んでよい。"""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # ラベルの値 -> [バケットごとの件数（最後は +Inf）, 合計]
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: Tuple[str, ...], value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(values, list(counts), total) for values, (counts, total) in sorted(self._series.items())]
+        for values, counts, total in items:
+            labels = tuple(zip(self.label_names, values))
+            cumulative = 0
+            for le, n in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "docqa_stage_duration_seconds",
+    "Time spent in each stage of a question (rewrite, embed, cache, search, assemble, ttft, llm, total).",
+    ("endpoint", "stage"),
+    LATENCY_BUCKETS,
+)
+LLM_TOKENS = Histogram(
+    "docqa_llm_tokens",
+    "Prompt and completion tokens per question.",
+    ("endpoint", "kind"),
+    TOKEN_BUCKETS,
+)
+
+# 終了した質問の件数（(endpoint, status) -> 件数）
+_requests: Dict[Tuple[str, str], int] = {}
+_requests_lock = threading.Lock()
+
+
+class Trace:
+    """1回の質問（/ask なら1件、/ask/batch なら1バッチ）の段階ごとの所要時間とトークン数。
+
+    qa_chain の各段階を span で囲んで計測し、finish で /metrics のヒストグラムに反映する。
+    全体が SLOW_REQUEST_MS 以上かかった場合は内訳をログに出す。
+    段階:
+        rewrite   会話の続きの質問を単独の質問に書き換える LLM 呼び出し（セッションのみ）
+        embed     質問の埋め込み
+        cache     回答キャッシュの照合
+        search    検索（再ランキングを含む）
+        assemble  コンテキストとプロンプトの組み立て
+        ttft      質問の受け付けから最初のトークンまで（ストリーミングのみ）
+        llm       chat 補完の呼び出し全体
+        total     全体
+    """
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+        self.cached = False
+        # スローログに添える情報（件数・インデックスのバージョンなど）
+        self.attrs: Dict[str, object] = {}
+        self.finished = False
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - started
+
+    def mark_first_token(self) -> None:
+        self.stages.setdefault("ttft", time.perf_counter() - self.started)
+
+    def add_usage(self, usage) -> None:
+        """chat 補完の usage（オブジェクトまたは dict）のトークン数を加える。"""
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = usage.model_dump()
+        for kind in ("prompt", "completion"):
+            n = usage.get(f"{kind}_tokens")
+            if n is not None:
+                self.tokens[kind] = self.tokens.get(kind, 0) + n
+
+    def timing_ms(self) -> Dict[str, float]:
+        """段階ごとの所要時間（ミリ秒）。キーは "<段階>_ms"。"""
+        return {f"{stage}_ms": seconds * 1000 for stage, seconds in self.stages.items()}
+
+    def finish(self, error: Optional[str] = None) -> Dict[str, float]:
+        """計測を終えてメトリクスに反映し、段階ごとの所要時間（ミリ秒）を返す。2回目以降は何もしない。"""
+        if self.finished:
+            return self.timing_ms()
+        self.finished = True
+        self.stages["total"] = time.perf_counter() - self.started
+        status = "error" if error is not None else "ok"
+        with _requests_lock:
+            _requests[(self.endpoint, status)] = _requests.get((self.endpoint, status), 0) + 1
+        for stage, seconds in self.stages.items():
+            STAGE_SECONDS.observe((self.endpoint, stage), seconds)
+        for kind, n in self.tokens.items():
+            LLM_TOKENS.observe((self.endpoint, kind), n)
+        if SLOW_REQUEST_MS > 0 and self.stages["total"] * 1000 >= SLOW_REQUEST_MS:
+            fields = [f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.stages.items()]
+            fields += [f"{kind}_tokens={n}" for kind, n in self.tokens.items()]
+            fields += [f"cached={self.cached}"] + [f"{k}={v}" for k, v in self.attrs.items()]
+            if error is not None:
+                fields.append(f"error={error}")
+            logger.warning(f"Slow request ({self.endpoint}, {status}): {' '.join(fields)}")
+        return self.timing_ms()
+
+
+def render() -> str:
+    """パイプラインのメトリクスを Prometheus のテキスト形式で返す。"""
+    with _requests_lock:
+        requests = {(("endpoint", e), ("status", s)): n for (e, s), n in sorted(_requests.items())}
+    return (
+        format_counter("docqa_requests_total", "Questions answered, by endpoint and status.", requests)
+        + STAGE_SECONDS.render()
+        + LLM_TOKENS.render()
+    )
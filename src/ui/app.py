@@ -1,3 +1,6 @@
+import json
+import time
+
 import streamlit as st
 import requests
 
@@ -55,12 +58,44 @@ if "history" not in st.session_state:
 if "current_query" not in st.session_state:
     st.session_state.current_query = ""
 
+if "session_id" not in st.session_state:
+    # API 側の会話セッション（追加の質問を会話の続きとして検索してもらう）
+    st.session_state.session_id = None
+
+
+def api_base(api_url: str) -> str:
+    return api_url.rstrip("/").removesuffix("/ask")
+
+
+def start_session(api_url: str) -> None:
+    """API で会話セッションを作る。失敗した場合（古い API など）はセッションなしで質問する。"""
+    try:
+        resp = requests.post(api_base(api_url) + "/sessions", timeout=10)
+        resp.raise_for_status()
+        st.session_state.session_id = resp.json()["session_id"]
+    except Exception:
+        st.session_state.session_id = None
+
+
+def end_session(api_url: str) -> None:
+    if st.session_state.session_id:
+        try:
+            requests.delete(api_base(api_url) + "/sessions/" + st.session_state.session_id, timeout=10)
+        except Exception:
+            pass
+    st.session_state.session_id = None
+
+
 # --- サイドバー設定 ---
 with st.sidebar:
     st.markdown("### ⚙️ 設定")
     api_url = st.text_input("APIエンドポイント", "http://localhost:8000/ask")
+    use_stream = st.checkbox("回答をストリーミング表示", value=True)
+    collection = st.text_input("コレクション（空欄なら default）", "")
+    source_prefix = st.text_input("検索対象のフォルダ・ファイル（data/raw/ からのパスの先頭、空欄なら全て）", "")
     if st.button("🗑️ 履歴をクリア"):
         st.session_state.history = []
+        end_session(api_url)
         st.rerun()
 
 # --- 会話履歴の表示（上部に配置） ---
@@ -78,6 +113,8 @@ else:
             <div class="message-content">{turn["query"]}</div>
         </div>
         """, unsafe_allow_html=True)
+        if turn.get("standalone_query") and turn["standalone_query"] != turn["query"]:
+            st.caption(f"🔎 検索した質問: {turn['standalone_query']}")
         
         # ボットの回答（左寄せ、青背景）
         st.markdown(f"""
@@ -97,6 +134,10 @@ else:
                         f"**[{j+1}]** `{meta.get('source')}` (chunk: {meta.get('chunk_id')})  \n"
                         f"> {text_preview}..."
                     )
+
+        if turn.get("timing"):
+            timing = turn["timing"]
+            st.caption(f"⏱️ 最初の応答まで {timing['ttft_ms'] / 1000:.2f}秒 / 全体 {timing['total_ms'] / 1000:.2f}秒")
         
         st.markdown("<br>", unsafe_allow_html=True)  # 会話間のスペース
 
@@ -122,26 +163,119 @@ with col2:
         st.session_state.current_query = ""
         st.rerun()
 
+
+
+def render_bot_message(text: str) -> str:
+    return f"""
+    <div class="bot-message">
+        <div class="message-header">🤖 アシスタント</div>
+        <div class="message-content">{text}</div>
+    </div>
+    """
+
+
+def request_body(query: str) -> dict:
+    body = {"query": query}
+    if st.session_state.session_id:
+        body["session_id"] = st.session_state.session_id
+    if collection.strip():
+        body["collection"] = collection.strip()
+    if source_prefix.strip():
+        body["filters"] = {"source_prefix": source_prefix.strip()}
+    return body
+
+
+def post_ask(api_url: str, query: str, stream: bool = False) -> requests.Response:
+    """/ask（stream なら /ask/stream）に質問する。"""
+    url = api_url.rstrip("/") + "/stream" if stream else api_url
+    resp = requests.post(url, json=request_body(query), stream=stream, timeout=120)
+    if resp.status_code == 404 and st.session_state.session_id:
+        # 会話セッションが失効した（SESSION_TTL・API の再起動）ので、新しい会話として聞き直す
+        resp.close()
+        start_session(api_url)
+        resp = requests.post(url, json=request_body(query), stream=stream, timeout=120)
+    return resp
+
+
+def ask_streaming(api_url: str, query: str):
+    """/ask/stream の Server-Sent Events を受け取りながら回答を描画する。"""
+    st.markdown(f"""
+    <div class="user-message">
+        <div class="message-header">👤 あなた</div>
+        <div class="message-content">{query}</div>
+    </div>
+    """, unsafe_allow_html=True)
+    placeholder = st.empty()
+    placeholder.markdown(render_bot_message("…"), unsafe_allow_html=True)
+
+    answer, sources, timing, standalone = "", [], None, None
+    last_render = 0.0
+    with post_ask(api_url, query, stream=True) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"API error: {resp.status_code} {resp.text}")
+        resp.encoding = "utf-8"
+        event = None
+        for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+                continue
+            if not line.startswith("data: "):
+                continue
+            data = json.loads(line[len("data: "):])
+            if event == "sources":
+                sources = data
+            elif event == "token":
+                answer += data["delta"]
+                # 描画回数を抑えるため 50ms ごとに更新する
+                if time.monotonic() - last_render > 0.05:
+                    placeholder.markdown(render_bot_message(answer + "▌"), unsafe_allow_html=True)
+                    last_render = time.monotonic()
+            elif event == "done":
+                timing = data.get("timing")
+                standalone = data.get("standalone_query")
+            elif event == "error":
+                raise RuntimeError(data.get("message", "unknown error"))
+    placeholder.markdown(render_bot_message(answer), unsafe_allow_html=True)
+    return answer, sources, timing, standalone
+
+
 # --- 送信処理 ---
 if send_clicked and query.strip():
     st.session_state.current_query = query
+    if st.session_state.session_id is None:
+        start_session(api_url)
     try:
-        with st.spinner("問い合わせ中..."):
-            resp = requests.post(api_url, json={"query": query})
-        if resp.status_code != 200:
-            st.error(f"API error: {resp.status_code} {resp.text}")
-        else:
-            data = resp.json()
-            # 履歴に追加
+        if use_stream:
+            answer, sources, timing, standalone = ask_streaming(api_url, query)
             st.session_state.history.append(
                 {
                     "query": query,
-                    "answer": data.get("answer", ""),
-                    "sources": data.get("sources", []),
+                    "answer": answer,
+                    "sources": sources,
+                    "timing": timing,
+                    "standalone_query": standalone,
                 }
             )
-            # 入力欄をクリア（次回の再実行時に反映される）
             st.session_state.current_query = ""
-            st.rerun()  # 画面を再描画して入力欄をクリア
+            st.rerun()
+        else:
+            with st.spinner("問い合わせ中..."):
+                resp = post_ask(api_url, query)
+            if resp.status_code != 200:
+                st.error(f"API error: {resp.status_code} {resp.text}")
+            else:
+                data = resp.json()
+                # 履歴に追加
+                st.session_state.history.append(
+                    {
+                        "query": query,
+                        "answer": data.get("answer", ""),
+                        "sources": data.get("sources", []),
+                        "standalone_query": data.get("standalone_query"),
+                    }
+                )
+                # 入力欄をクリア（次回の再実行時に反映される）
+                st.session_state.current_query = ""
+                st.rerun()  # 画面を再描画して入力欄をクリア
     except Exception as e:
-        st.error(f"❌ リクエスト中にエラーが発生しました: {e}")
\ No newline at end of file
+        st.error(f"❌ リクエスト中にエラーが発生しました: {e}")
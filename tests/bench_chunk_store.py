@@ -0,0 +1,154 @@
+"""
+チャンクストアと旧形式 metadata.json の起動時間・メモリ使用量の比較スクリプト
+
+件数ごとに両形式のファイルを生成し、別プロセスで読み込み + k件取り出しを行って
+起動時間と RSS を計測する。RSS は Linux では匿名メモリ（ワーカーごとに専有）と
+ファイルマップ（ページキャッシュとしてワーカー間で共有）に分けて表示する。
+
+使用方法:
+    python tests/bench_chunk_store.py --sizes 100000 1000000
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+SAMPLE_SENTENCES = [
+    "パスワードを再設定するには、ログイン画面の「パスワードを忘れた場合」を選択します。",
+    "経費精算は月末締めで、領収書の原本を経理部へ提出してください。",
+    "VPN に接続できない場合は、クライアントのバージョンを確認してください。",
+    "有給休暇の申請は勤怠システムから行い、上長の承認が必要です。",
+    "エラーコード E-1024 は認証トークンの有効期限切れを示します。",
+]
+
+
+def _text_pool(size: int = 1000, chars: int = 800) -> list[str]:
+    rng = random.Random(0)
+    pool = []
+    for i in range(size):
+        parts = [f"第{i}節 "]
+        while sum(len(p) for p in parts) < chars:
+            parts.append(rng.choice(SAMPLE_SENTENCES))
+        pool.append("".join(parts)[:chars])
+    return pool
+
+
+def generate(directory: Path, n: int) -> None:
+    """同じ内容を旧 JSON 形式とチャンクストアの両方で書き出す。"""
+    from src.rag.chunk_store import write_chunk_store
+
+    pool = _text_pool()
+    texts = [pool[i % len(pool)] for i in range(n)]
+    metadatas = [{"source": f"/data/raw/manual{i // 50}.pdf", "chunk_id": i % 50} for i in range(n)]
+
+    # json.dump(..., indent=2) と同じ形式をストリーミングで書く（生成側のメモリを抑えるため）
+    with open(directory / "metadata.json", "w", encoding="utf-8") as f:
+        f.write('{\n  "texts": [\n')
+        f.write(",\n".join("    " + json.dumps(t, ensure_ascii=False) for t in texts))
+        f.write('\n  ],\n  "metadatas": [\n')
+        f.write(",\n".join(
+            "    " + json.dumps(m, ensure_ascii=False, indent=2).replace("\n", "\n    ") for m in metadatas
+        ))
+        f.write("\n  ]\n}")
+
+    write_chunk_store(directory / "chunks", list(range(n)), texts, metadatas)
+
+
+def _memory() -> dict:
+    status = Path("/proc/self/status")
+    if status.exists():
+        fields = {}
+        for line in status.read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                fields[key] = int(value.split()[0]) / 1024
+        return {"rss_mb": fields.get("VmRSS"), "anon_mb": fields.get("RssAnon"), "file_mb": fields.get("RssFile")}
+    import resource
+    return {"rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "anon_mb": None, "file_mb": None}
+
+
+def worker(fmt: str, directory: Path, k: int, queries: int) -> None:
+    """1ワーカー分の起動（読み込み）と検索結果の取り出しを計測する。"""
+    import numpy as np
+
+    baseline = _memory()
+    started = time.perf_counter()
+    if fmt == "json":
+        with open(directory / "metadata.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        texts, metadatas = meta["texts"], meta["metadatas"]
+        n = len(texts)
+
+        def fetch(row):
+            return {"text": texts[row], "metadata": metadatas[row]}
+    else:
+        from src.rag.chunk_store import ChunkStore
+        store = ChunkStore(directory / "chunks")
+        n = len(store)
+        fetch = store.get
+    load_s = time.perf_counter() - started
+
+    rng = np.random.default_rng(0)
+    started = time.perf_counter()
+    for _ in range(queries):
+        for row in rng.integers(0, n, size=k):
+            fetch(int(row))
+    fetch_us = (time.perf_counter() - started) / queries * 1e6
+
+    mem = _memory()
+    print(json.dumps({
+        "load_s": load_s,
+        "fetch_us_per_query": fetch_us,
+        "rss_mb": mem["rss_mb"] - baseline["rss_mb"],
+        "anon_mb": None if mem["anon_mb"] is None else mem["anon_mb"] - baseline["anon_mb"],
+        "file_mb": None if mem["file_mb"] is None else mem["file_mb"] - baseline["file_mb"],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunk store vs metadata.json benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--worker", choices=["json", "store"], help=argparse.SUPPRESS)
+    parser.add_argument("--dir", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.dir, args.k, args.queries)
+        return
+
+    print(f"{'chunks':>9} {'format':>6} {'disk MB':>9} {'load s':>8} {'fetch us':>9} "
+          f"{'RSS MB':>8} {'anon MB':>8} {'file MB':>8}")
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp)
+            generate(directory, n)
+            disk = {
+                "json": (directory / "metadata.json").stat().st_size,
+                "store": sum(p.stat().st_size for p in (directory / "chunks").iterdir()),
+            }
+            for fmt in ("json", "store"):
+                out = subprocess.run(
+                    [sys.executable, __file__, "--worker", fmt, "--dir", str(directory),
+                     "--k", str(args.k), "--queries", str(args.queries)],
+                    capture_output=True, text=True, check=True,
+                )
+                r = json.loads(out.stdout.strip().splitlines()[-1])
+                fmt_mb = lambda v: f"{v:8.1f}" if v is not None else f"{'-':>8}"  # noqa: E731
+                print(f"{n:>9} {fmt:>6} {disk[fmt] / 2**20:9.1f} {r['load_s']:8.3f} "
+                      f"{r['fetch_us_per_query']:9.1f} {fmt_mb(r['rss_mb'])} {fmt_mb(r['anon_mb'])} "
+                      f"{fmt_mb(r['file_mb'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+チャンク分割の速度と結果を測るベンチマークスクリプト
+
+見出し・表・コードブロックを含む合成の Markdown（または指定ディレクトリのドキュメント）を
+structured_split と simple_split で分割し、処理速度（MB/s）・チャンク数・トークン数の分布を比較する。
+
+使用方法:
+    python tests/bench_chunker.py --mb 100
+    python tests/bench_chunker.py --docs data/raw
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.ingestion.load_docs import iter_docs, list_doc_files  # noqa: E402
+from src.ingestion.split_docs import _token_byte_lengths, simple_split, structured_split  # noqa: E402
+from src.models.embedder import get_encoding  # noqa: E402
+
+SENTENCES = [
+    "本製品は業務用の高性能なサーバーです。",
+    "設定ファイルを編集したら、サービスを再起動してください。",
+    "「詳細は管理者に問い合わせてください。」",
+    "エラーコード E-1024 が表示された場合はネットワーク設定を確認します！",
+    "バックアップは毎日午前3時に実行されますか？",
+    "The API returns HTTP 429 when the rate limit is exceeded.",
+]
+
+
+def make_document(rng: np.random.Generator, n_sections: int) -> str:
+    parts = [f"# 製品マニュアル {rng.integers(10000)}\n"]
+    for s in range(n_sections):
+        parts.append(f"\n## 第{s + 1}章\n")
+        for sub in range(int(rng.integers(1, 4))):
+            parts.append(f"\n### {s + 1}.{sub + 1} 手順\n\n")
+            n = int(rng.integers(3, 40))
+            parts.append("".join(SENTENCES[i] for i in rng.integers(len(SENTENCES), size=n)))
+            parts.append("\n")
+            if rng.random() < 0.2:
+                parts.append("\n| 項目 | 値 |\n|---|---|\n| タイムアウト | 30秒 |\n| 再試行 | 3回 |\n")
+            if rng.random() < 0.2:
+                parts.append("\n```bash\n# 再起動する\nsudo systemctl restart app\n```\n")
+    return "".join(parts)
+
+
+def make_corpus(total_mb: float, seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    docs, size = [], 0
+    while size < total_mb * 2**20:
+        doc = make_document(rng, int(rng.integers(2, 30)))
+        docs.append(doc)
+        size += len(doc.encode("utf-8"))
+    return docs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark document chunking")
+    parser.add_argument("--mb", type=float, default=50, help="合成コーパスのサイズ（MB）")
+    parser.add_argument("--docs", help="合成コーパスの代わりに使うドキュメントのディレクトリ")
+    args = parser.parse_args()
+
+    if args.docs:
+        texts = [doc["text"] for doc in iter_docs(list_doc_files(args.docs))]
+    else:
+        texts = make_corpus(args.mb)
+    total_mb = sum(len(t.encode("utf-8")) for t in texts) / 2**20
+    print(f"{len(texts)} documents, {total_mb:.1f} MB")
+
+    # 語彙表の作成は初回のみなので計測から除く
+    _token_byte_lengths()
+    enc = get_encoding()
+
+    started = time.perf_counter()
+    structured = [c for t in texts for c in structured_split(t)]
+    elapsed = time.perf_counter() - started
+    tokens = np.array([c["tokens"] for c in structured])
+    print(
+        f"structured_split: {elapsed:6.2f}s ({total_mb / elapsed:6.1f} MB/s), {len(structured)} chunks, "
+        f"tokens total={tokens.sum()} p50={np.percentile(tokens, 50):.0f} p99={np.percentile(tokens, 99):.0f} "
+        f"max={tokens.max()}"
+    )
+
+    started = time.perf_counter()
+    simple = [c for t in texts for c in simple_split(t)]
+    elapsed = time.perf_counter() - started
+    # simple_split はトークン数を持たないので、比較のためにチャンクごとにエンコードする（計測外）
+    simple_tokens = np.array([len(ids) for ids in enc.encode_ordinary_batch(simple)])
+    print(
+        f"simple_split    : {elapsed:6.2f}s ({total_mb / elapsed:6.1f} MB/s), {len(simple)} chunks, "
+        f"tokens total={simple_tokens.sum()} p50={np.percentile(simple_tokens, 50):.0f} "
+        f"p99={np.percentile(simple_tokens, 99):.0f} max={simple_tokens.max()}"
+    )
+
+
+if __name__ == "__main__":
+    main()
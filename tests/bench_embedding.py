@@ -0,0 +1,119 @@
+"""
+埋め込みパイプラインのスループット計測スクリプト
+
+逐次の get_embedding と、バッチ・並列化した get_embeddings（ingest の chunks/s）、
+同時実行した aget_embedding（API のクエリ/s）を計測する。埋め込みキャッシュは無効にして測る。
+OpenAI の経路はモックサーバーを先に起動しておくこと。--model local:... でローカル CPU 推論を測る。
+
+使用方法:
+    python tests/mock_openai_server.py --port 8001 --latency-ms 150
+    python tests/bench_embedding.py --base-url http://127.0.0.1:8001/v1 --chunks 5000
+    python tests/bench_embedding.py --model local:sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2
+    EMBED_LOCAL_QUANTIZE=int8 python tests/bench_embedding.py --model local:...
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+SAMPLE_SENTENCES = [
+    "パスワードを再設定するには、ログイン画面の「パスワードを忘れた場合」を選択します。",
+    "経費精算は月末締めで、領収書の原本を経理部へ提出してください。",
+    "VPN に接続できない場合は、クライアントのバージョンを確認してください。",
+    "有給休暇の申請は勤怠システムから行い、上長の承認が必要です。",
+    "エラーコード E-1024 は認証トークンの有効期限切れを示します。",
+    "新入社員研修では、情報セキュリティ規程の読み合わせを行います。",
+]
+
+
+def make_chunks(n: int, chars: int = 800, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        parts = [f"第{i}章 "]
+        while sum(len(p) for p in parts) < chars:
+            parts.append(rng.choice(SAMPLE_SENTENCES))
+        chunks.append("".join(parts)[:chars])
+    return chunks
+
+
+async def bench_queries(aget_embedding, queries: list[str], levels: list[int]) -> None:
+    """同時実行数ごとに aget_embedding のスループットとレイテンシを測る（イベントループは1つ）。"""
+    for concurrency in levels:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one(q: str) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                await aget_embedding(q)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(f"{q} c{concurrency}") for q in queries))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(
+            f"aget_embedding c={concurrency:<3}: {len(queries) / elapsed:8.1f} queries/s "
+            f"p50={latencies[len(latencies) // 2] * 1000:6.1f}ms "
+            f"p99={latencies[int(len(latencies) * 0.99)] * 1000:6.1f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding throughput benchmark")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001/v1")
+    parser.add_argument("--model", help="EMBED_MODEL（未指定なら設定値）")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--serial-sample", type=int, default=50, help="逐次版で計測する件数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--queries", type=int, default=500, help="クエリ経路で計測する件数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    args = parser.parse_args()
+
+    # src.config の読み込み前に接続先・モデルを差し替え、キャッシュを無効にする
+    os.environ["OPENAI_BASE_URL"] = args.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    os.environ["EMBED_CACHE_ENABLED"] = "0"
+    if args.model:
+        os.environ["EMBED_MODEL"] = args.model
+
+    from src.models.embedder import EmbeddingStats, LocalEmbeddingBackend, aget_embedding, get_backend
+    from src.models.embedder import get_embedding, get_embeddings
+
+    backend = get_backend()
+    print(f"model: {backend.model_id}")
+    texts = make_chunks(args.chunks)
+
+    sample = texts[: args.serial_sample]
+    started = time.perf_counter()
+    for t in sample:
+        get_embedding(t)
+    elapsed = time.perf_counter() - started
+    print(f"serial get_embedding : {len(sample) / elapsed:8.1f} chunks/s ({len(sample)} chunks)")
+
+    # ローカル推論では並列度はスレッド数（EMBED_LOCAL_THREADS）で決まるため1回だけ測る
+    for workers in args.workers[:1] if isinstance(backend, LocalEmbeddingBackend) else args.workers:
+        stats = EmbeddingStats()
+        vectors = get_embeddings(texts, max_workers=workers, stats=stats)
+        assert vectors.shape[0] == len(texts)
+        print(
+            f"get_embeddings w={workers:<3}: {stats.chunks_per_sec:8.1f} chunks/s "
+            f"{stats.tokens_per_sec:10.0f} tokens/s "
+            f"({stats.requests} requests, {stats.retries} retries, {stats.seconds:.1f}s)"
+        )
+
+    queries = [f"{SAMPLE_SENTENCES[i % len(SAMPLE_SENTENCES)]} ({i})" for i in range(args.queries)]
+    asyncio.run(bench_queries(aget_embedding, queries, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
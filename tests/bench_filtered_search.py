@@ -0,0 +1,138 @@
+"""
+メタデータフィルタ付き検索のレイテンシと recall を測るベンチマークスクリプト
+
+合成ベクトルで一時ディレクトリにスナップショット（インデックス・チャンクストア・フィルタ用の属性）を作り、
+Retriever.query_many に search_filter を渡して、絞り込みの割合（100% / 10% / 1% / 0.1% / 0.01%）ごとに
+1クエリあたりのレイテンシと、一致するベクトルだけでの厳密検索に対する recall@k を表示する。
+比較として、フィルタなしで k * overfetch 件を検索してから条件で捨てる後段絞り込みの結果も表示する。
+
+使用方法:
+    python tests/bench_filtered_search.py --n 200000 --dim 768
+    python tests/bench_filtered_search.py --types hnsw --overfetch 20
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.ingestion.manifest import new_manifest, save_manifest  # noqa: E402
+from src.models.embedder import embed_model_id  # noqa: E402
+from src.rag.chunk_store import ChunkStoreWriter  # noqa: E402
+from src.rag.filters import SearchFilter, write_filter_index  # noqa: E402
+from src.rag.index_factory import create_index, index_spec, prepare_vectors, resolve_params, save_params  # noqa: E402
+from src.rag.index_io import write_index  # noqa: E402
+from src.rag.retriever import Retriever  # noqa: E402
+
+N_FILES = 10000
+# ファイル名は 0000.md〜9999.md なので、前方一致の桁数で一致する割合が 1/10 ずつ変わる
+PREFIXES = ["", "0", "00", "000", "0000"]
+
+
+def synthetic_vectors(n: int, dim: int, n_queries: int, seed: int = 0):
+    """埋め込みに近い、クラスタ構造を持つベクトルを生成する。"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n // 500)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    assign = rng.integers(0, n_clusters, size=n + n_queries)
+    x = centers[assign] + 0.6 * rng.standard_normal((n + n_queries, dim)).astype("float32")
+    return x[:n], x[n:]
+
+
+def build_snapshot(directory: Path, index_type: str, base: np.ndarray, file_of: np.ndarray) -> None:
+    n, dim = base.shape
+    params = resolve_params(index_spec(index_type, shards=1), n, dim)
+    vectors = prepare_vectors(base, params)
+    index = create_index(params, vectors)
+    index.add_with_ids(vectors, np.arange(n, dtype="int64"))
+    write_index(index, directory)
+    save_params(params, directory)
+
+    writer = ChunkStoreWriter(directory / "chunks")
+    keys = [f"{i:04d}.md" for i in range(N_FILES)]
+    writer.append(
+        list(range(n)),
+        [f"chunk {i}" for i in range(n)],
+        [{"source": keys[f], "chunk_id": i} for i, f in enumerate(file_of)],
+    )
+    writer.commit()
+
+    order = np.argsort(file_of, kind="stable")
+    bounds = np.searchsorted(file_of[order], np.arange(N_FILES + 1))
+    files = [(keys[f], order[bounds[f]:bounds[f + 1]], 0.0, []) for f in range(N_FILES)]
+    write_filter_index(directory / "filters", n, files)
+    save_manifest(new_manifest(embed_model_id()), directory / "manifest.json")
+
+
+def measure(fn, queries: np.ndarray):
+    latencies, results = [], []
+    for q in queries:
+        started = time.perf_counter()
+        results.append(fn(q))
+        latencies.append(time.perf_counter() - started)
+    lat = np.array(latencies) * 1000
+    return results, float(np.percentile(lat, 50)), float(np.percentile(lat, 99))
+
+
+def recall(results, truth, k: int) -> float:
+    hits = sum(len(set(r) & set(t)) for r, t in zip(results, truth))
+    return hits / sum(min(k, len(t)) for t in truth) if truth else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark metadata-filtered vector search")
+    parser.add_argument("--n", type=int, default=100000, help="ベクトル数")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--types", nargs="+", default=["flat", "ivf_flat", "hnsw"])
+    parser.add_argument("--overfetch", type=int, default=10, help="後段絞り込みで取る件数の倍率")
+    args = parser.parse_args()
+
+    base, queries = synthetic_vectors(args.n, args.dim, args.queries)
+    file_of = np.random.default_rng(1).integers(0, N_FILES, size=args.n)
+    print(f"base={args.n} queries={args.queries} dim={args.dim} k={args.k}")
+
+    print(f"{'type':<9} {'match':>7} {'filtered p50/p99 ms':>20} {'recall':>7} "
+          f"{'post-filter p50/p99 ms':>23} {'recall':>7}")
+    for index_type in args.types:
+        with tempfile.TemporaryDirectory() as tmp:
+            build_snapshot(Path(tmp), index_type, base, file_of)
+            retriever = Retriever(tmp)
+            unit = prepare_vectors(base, retriever.params)
+            unit_queries = prepare_vectors(queries, retriever.params)
+
+            for prefix in PREFIXES:
+                f = SearchFilter(source_prefix=(prefix,))
+                selection = retriever.filters.select(f)
+                # 正解は一致するベクトルだけでの厳密な内積検索
+                scores = unit_queries @ unit[selection.rows].T
+                top = np.argsort(-scores, axis=1)[:, :args.k]
+                truth = [selection.rows[t].tolist() for t in top]
+
+                def filtered(q):
+                    return retriever._vector_rows(q[None], args.k, None, None, selection)[0].tolist()
+
+                def post_filter(q):
+                    rows = retriever._vector_rows(q[None], args.k * args.overfetch, None, None)[0]
+                    return rows[selection.mask[rows]][:args.k].tolist()
+
+                res, p50, p99 = measure(filtered, queries)
+                post, post50, post99 = measure(post_filter, queries)
+                print(
+                    f"{index_type:<9} {selection.count / args.n:7.2%} {p50:9.3f} / {p99:8.3f} "
+                    f"{recall(res, truth, args.k):7.3f} {post50:10.3f} / {post99:10.3f} "
+                    f"{recall(post, truth, args.k):7.3f}"
+                )
+            del retriever
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+ベクトル圧縮（INDEX_QUANTIZE / INDEX_DIM）のメモリ削減と recall を測るベンチマークスクリプト
+
+float32・全次元のインデックス（現在の既定）を基準に、fp16 / int8 のスカラー量子化と
+次元の切り詰め（--dims）の組み合わせごとに、インデックスの大きさ（ワーカーのヒープに載る量）と削減率、
+全精度ベクトルのファイル（vectors.f32、mmap なのでヒープには載らない）の大きさ、
+厳密な内積検索（float32・全次元）に対する recall@k を、再スコアリングなし・あり（k * --oversample 件を候補に
+取って全精度ベクトルで並べ直す）で表示する。レイテンシは再スコアリングを含む1クエリあたりの p50。
+recall は同点を考慮し、返った k 件のうち真のスコアが正解の k 位のスコア以上のものの割合とする
+（同じ本文のチャンクは同じベクトルになるため）。
+
+合成データは Matryoshka 型の学習をしていないので、次元を切り詰めた結果は --vectorstore
+（text-embedding-3 系で埋め込み直したチャンク）で確認すること。
+
+使用方法:
+    python tests/bench_quantization.py --synthetic 200000 --dim 1536
+    python tests/bench_quantization.py --vectorstore --dims 512 256
+    python tests/bench_quantization.py --vectorstore --type hnsw --oversample 4
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.rag.full_vectors import FULL_VECTORS_NAME, FullVectorWriter, open_full_vectors, rescore  # noqa: E402
+from src.rag.index_factory import create_index, faiss, index_spec, prepare_vectors, resolve_params  # noqa: E402
+
+
+def synthetic_vectors(n: int, dim: int, n_queries: int, seed: int = 0):
+    """埋め込みに近い、クラスタ構造を持つベクトルを生成する。"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n // 500)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    assign = rng.integers(0, n_clusters, size=n + n_queries)
+    x = centers[assign] + 0.6 * rng.standard_normal((n + n_queries, dim)).astype("float32")
+    return x[:n], x[n:]
+
+
+def vectorstore_vectors(n_queries: int, seed: int = 0):
+    from src.models.embedder import get_embeddings
+    from src.rag.chunk_store import ChunkStore
+    from src.rag.snapshots import current_snapshot
+
+    store = ChunkStore(current_snapshot() / "chunks")
+    texts = [store.text(row) for row in range(len(store))]
+    base = get_embeddings(texts)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(base), size=min(n_queries, len(base)), replace=False)
+    queries = base[picks] + 0.01 * rng.standard_normal((len(picks), base.shape[1])).astype("float32")
+    return base, queries
+
+
+def tie_aware_recall(rows_list, unit_queries, vectors, truth_scores, k: int) -> float:
+    hits = 0
+    for rows, query, scores in zip(rows_list, unit_queries, truth_scores):
+        hits += int(np.sum(vectors[rows] @ query >= scores[-1] - 1e-5))
+    return hits / (len(unit_queries) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory and recall of compressed vector indexes")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--synthetic", type=int, default=100000, help="合成ベクトル数")
+    source.add_argument("--vectorstore", action="store_true", help="公開中のスナップショットのチャンクを埋め込み直して使う")
+    parser.add_argument("--dim", type=int, default=1536, help="合成ベクトルの次元")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--type", default="flat", choices=["flat", "ivf_flat", "hnsw"])
+    parser.add_argument("--dims", type=int, nargs="*", default=[512, 256], help="切り詰める次元（全次元に加えて試す）")
+    parser.add_argument("--oversample", type=int, default=4, help="再スコアリングで取る候補の倍率")
+    args = parser.parse_args()
+
+    if args.vectorstore:
+        base, queries = vectorstore_vectors(args.queries)
+    else:
+        base, queries = synthetic_vectors(args.synthetic, args.dim, args.queries)
+    n, dim = base.shape
+    k, fetch = args.k, args.k * args.oversample
+
+    # 正解は float32・全次元での厳密な内積検索
+    unit = prepare_vectors(base, {"normalize": True})
+    unit_queries = prepare_vectors(queries, {"normalize": True})
+    truth_scores, _ = faiss.knn(unit_queries, unit, k, metric=faiss.METRIC_INNER_PRODUCT)
+    ids = np.arange(n, dtype="int64")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 全精度ベクトルは build_index と同じ形式で書き出し、mmap で開いて並べ直しに使う
+        writer = FullVectorWriter(Path(tmp) / FULL_VECTORS_NAME)
+        writer.append(unit)
+        writer.commit()
+        full_mb = (Path(tmp) / FULL_VECTORS_NAME).stat().st_size / 2**20
+        full_vectors = open_full_vectors(tmp, {"rescore": True, "embed_dim": dim})
+
+        print(f"type={args.type} base={n} dim={dim} queries={len(queries)} k={k} "
+              f"oversample={args.oversample} vectors.f32={full_mb:.1f}MB (mmap)")
+        print(f"{'quantize':>8} {'dim':>5} {'index MB':>9} {'reduction':>9} "
+              f"{'recall':>7} {'rescored':>8} {'p50 ms':>7}")
+        baseline_mb = None
+        for truncate_dim in [0] + [d for d in args.dims if 0 < d < dim]:
+            for quantize in ("", "fp16", "int8"):
+                spec = index_spec(args.type, shards=1, quantize=quantize, truncate_dim=truncate_dim)
+                params = resolve_params(spec, n, dim)
+                vectors = prepare_vectors(base, params)
+                index = create_index(params, vectors)
+                index.add_with_ids(vectors, ids)
+                del vectors
+                index_mb = faiss.serialize_index(index).nbytes / 2**20
+                if baseline_mb is None:
+                    baseline_mb = index_mb
+                search_queries = prepare_vectors(queries, params)
+
+                _, plain = index.search(search_queries, k)
+                plain_recall = tie_aware_recall([r[r >= 0] for r in plain], unit_queries, unit, truth_scores, k)
+                latencies, rescored = [], []
+                for q, full in zip(search_queries, unit_queries):
+                    started = time.perf_counter()
+                    _, rows = index.search(q[None], fetch)
+                    rescored += rescore(full_vectors, full[None], [rows[0][rows[0] >= 0]], k)
+                    latencies.append(time.perf_counter() - started)
+                rescored_recall = tie_aware_recall(rescored, unit_queries, unit, truth_scores, k)
+                print(f"{quantize or 'float32':>8} {truncate_dim or dim:>5} {index_mb:9.1f} "
+                      f"{baseline_mb / index_mb:8.1f}x {plain_recall:7.3f} {rescored_recall:8.3f} "
+                      f"{np.percentile(latencies, 50) * 1000:7.2f}")
+                del index
+        del full_vectors
+
+
+if __name__ == "__main__":
+    main()
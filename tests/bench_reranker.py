@@ -0,0 +1,73 @@
+"""
+cross-encoder による再ランキングのレイテンシを測るベンチマークスクリプト
+
+合成の質問と候補チャンクを作り、CrossEncoderReranker.rerank_many を候補数ごとに呼び出して、
+1質問あたりのレイテンシ（p50 / p99）と、予算（--budget-ms）を超えて1段目の順位に戻した割合を表示する。
+スコアのキャッシュが効かないよう、質問は毎回異なる文字列にする。
+
+使用方法:
+    python tests/bench_reranker.py --model cross-encoder/mmarco-mMiniLMv2-L12-H384-v1
+    python tests/bench_reranker.py --model <モデル> --candidates 20 50 100 --quantize int8 --threads 4
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.config import RERANK_BATCH_SIZE, RERANK_MAX_LENGTH, RERANK_THREADS  # noqa: E402
+from src.rag.reranker import CrossEncoderReranker  # noqa: E402
+
+WORDS = ["就業規則", "有給休暇", "申請", "経費", "精算", "承認", "期限", "出張", "在宅勤務", "手当",
+         "システム", "障害", "手順", "問い合わせ", "E-1024", "様式", "提出", "部署", "規程", "改定"]
+
+
+def synthetic_text(rng: np.random.Generator, n_words: int) -> str:
+    return "。".join("、".join(rng.choice(WORDS, size=5)) for _ in range(max(1, n_words // 5))) + "。"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cross-encoder reranking latency")
+    parser.add_argument("--model", required=True, help="sentence-transformers の CrossEncoder モデル名またはパス")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 50, 100])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--words", type=int, default=150, help="候補チャンクあたりの語数")
+    parser.add_argument("--budget-ms", type=float, default=300)
+    parser.add_argument("--threads", type=int, default=RERANK_THREADS)
+    parser.add_argument("--batch-size", type=int, default=RERANK_BATCH_SIZE)
+    parser.add_argument("--quantize", default="", choices=["", "int8"])
+    args = parser.parse_args()
+
+    reranker = CrossEncoderReranker(
+        args.model, args.threads, args.batch_size, RERANK_MAX_LENGTH, args.quantize, cache_size=0
+    )
+    rng = np.random.default_rng(0)
+    # モデルの読み込みと初回推論を計測から外す
+    reranker.rerank_many(["warmup"], [[{"text": "warmup"}]], 1, budget_ms=float("inf"))
+    print(f"model={args.model} threads={args.threads} quantize={args.quantize or 'none'} "
+          f"budget={args.budget_ms:.0f}ms")
+
+    print(f"{'candidates':>10} {'p50 ms':>9} {'p99 ms':>9} {'fallback':>9}")
+    for n in args.candidates:
+        docs = [{"text": synthetic_text(rng, args.words)} for _ in range(n)]
+        latencies = []
+        fallbacks = reranker.fallbacks
+        for i in range(args.queries):
+            query = f"{i}: " + synthetic_text(rng, 10)
+            started = time.perf_counter()
+            reranker.rerank_many([query], [docs], args.k, budget_ms=args.budget_ms)
+            latencies.append(time.perf_counter() - started)
+        lat = np.array(latencies) * 1000
+        rate = (reranker.fallbacks - fallbacks) / args.queries
+        print(f"{n:>10} {np.percentile(lat, 50):9.1f} {np.percentile(lat, 99):9.1f} {rate:9.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+シャード数ごとのインデックス構築時間と検索レイテンシを測るベンチマークスクリプト
+
+合成ベクトルをシャード数（--shards）ごとに振り分けてシャードごとのインデックスを作り、
+構築（学習・追加）・保存・読み込みの時間と、ShardedIndex での1クエリずつの検索レイテンシ（p50 / p99）、
+まとめて投げたときのスループット、厳密な内積検索に対する recall@k を表示する。
+ベクトルはファイル単位の振り分けを模して、ランダムにシャードへ割り当てる。
+シャードの並列度は SHARD_THREADS（0 なら CPU コア数）で決まる。
+
+使用方法:
+    python tests/bench_shards.py --n 2000000 --dim 768 --shards 1 2 4 8
+    python tests/bench_shards.py --type hnsw --n 500000 --shards 1 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.config import SHARD_THREADS  # noqa: E402
+from src.rag.index_factory import create_index, faiss, index_spec, prepare_vectors, resolve_params  # noqa: E402
+from src.rag.shards import read_sharded_index, shard_pool, write_shards  # noqa: E402
+
+
+def synthetic_vectors(n: int, dim: int, n_queries: int, seed: int = 0):
+    """埋め込みに近い、クラスタ構造を持つベクトルを生成する。"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n // 500)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    base = np.empty((n, dim), dtype="float32")
+    # 数百万件でも一時配列が大きくならないよう分けて生成する
+    for start in range(0, n, 100000):
+        stop = min(n, start + 100000)
+        assign = rng.integers(0, n_clusters, size=stop - start)
+        base[start:stop] = centers[assign] + 0.6 * rng.standard_normal((stop - start, dim)).astype("float32")
+    queries = centers[rng.integers(0, n_clusters, size=n_queries)]
+    queries += 0.6 * rng.standard_normal(queries.shape).astype("float32")
+    return base, queries
+
+
+def build_shards(vectors: np.ndarray, shard_ids: np.ndarray, params: dict):
+    """build_index と同じく、学習は1回だけ行って全シャードに複製し、シャードごとの追加は並列に行う。"""
+    trained = create_index(params, vectors)
+    shards = [trained] + [faiss.clone_index(trained) for _ in range(params.get("shards", 1) - 1)]
+    ids = np.arange(len(vectors), dtype="int64")
+
+    def add_to(s: int) -> None:
+        mask = shard_ids == s
+        shards[s].add_with_ids(vectors[mask], ids[mask])
+
+    list(shard_pool().map(add_to, range(len(shards))))
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sharded index build time and search latency")
+    parser.add_argument("--n", type=int, default=1000000, help="ベクトル数")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--type", default="flat", choices=["flat", "ivf_flat", "ivf_pq", "hnsw"])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch", type=int, default=32, help="スループット計測でまとめて投げるクエリ数")
+    args = parser.parse_args()
+
+    base, queries = synthetic_vectors(args.n, args.dim, args.queries)
+    print(f"type={args.type} base={args.n} dim={args.dim} queries={args.queries} k={args.k} "
+          f"cores={os.cpu_count()} shard_threads={SHARD_THREADS or os.cpu_count()}")
+
+    print(f"{'shards':>6} {'build s':>8} {'save s':>7} {'load s':>7} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'batch qps':>10} {'recall':>7}")
+    # 正解は全ベクトルでの厳密な内積検索
+    unit = prepare_vectors(base, {"normalize": True})
+    _, truth = faiss.knn(prepare_vectors(queries, {"normalize": True}), unit, args.k, metric=faiss.METRIC_INNER_PRODUCT)
+    del unit
+    rng = np.random.default_rng(1)
+    for n_shards in args.shards:
+        params = resolve_params(index_spec(args.type, shards=n_shards), args.n, args.dim)
+        vectors = prepare_vectors(base, params)
+        unit_queries = prepare_vectors(queries, params)
+        shard_ids = rng.integers(0, n_shards, size=args.n)
+
+        started = time.perf_counter()
+        shards = build_shards(vectors, shard_ids, params)
+        build_s = time.perf_counter() - started
+        del vectors
+
+        with tempfile.TemporaryDirectory() as tmp:
+            started = time.perf_counter()
+            write_shards(shards, tmp)
+            save_s = time.perf_counter() - started
+            del shards
+            started = time.perf_counter()
+            index = read_sharded_index(tmp, params)
+            load_s = time.perf_counter() - started
+
+        latencies, results = [], []
+        for q in unit_queries:
+            started = time.perf_counter()
+            _, ids = index.search(q[None], args.k)
+            latencies.append(time.perf_counter() - started)
+            results.append(ids[0])
+        lat = np.array(latencies) * 1000
+        started = time.perf_counter()
+        for i in range(0, len(unit_queries), args.batch):
+            index.search(unit_queries[i:i + args.batch], args.k)
+        qps = len(unit_queries) / (time.perf_counter() - started)
+
+        hits = sum(len(set(r.tolist()) & set(t.tolist())) for r, t in zip(results, truth))
+        print(f"{n_shards:>6} {build_s:8.2f} {save_s:7.2f} {load_s:7.2f} {np.percentile(lat, 50):8.2f} "
+              f"{np.percentile(lat, 99):8.2f} {qps:10.0f} {hits / (len(truth) * args.k):7.3f}")
+        del index
+
+
+if __name__ == "__main__":
+    main()
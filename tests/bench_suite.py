@@ -0,0 +1,374 @@
+"""
+取り込み・検索・/ask の性能をまとめて測るベンチマークスイート
+
+合成の日本語 Markdown と PDF のコーパスを指定の文書数ごとに生成し、モック OpenAI サーバー（遅延は固定）に
+向けて以下を測る。
+    取り込み  読み込み（MB/s）・分割・埋め込み（chunks/s）・インデックス追加（vectors/s）を段階ごとに、
+              build_index 全体（files/s, chunks/s）を通しで
+    検索      Retriever.query の vector / hybrid それぞれの p50 / p99
+    /ask      API サーバー（uvicorn 1ワーカー）への同時実行数ごとの req/s と p50 / p99
+設定は起動時に読まれるため、コーパスごとに環境変数を変えた子プロセスで測る。キャッシュは全て無効にする。
+
+結果は JSON（--output）に書き、基準値（--baseline）があれば指標ごとに比較する。スループットが下がるか
+レイテンシが上がった割合が --threshold を超えた指標を回帰として表示し、終了コード 1 で終わる。
+
+使用方法:
+    python tests/bench_suite.py --sizes 200 1000 --output bench_results.json
+    python tests/bench_suite.py --save-baseline                  # 結果を基準値として保存する
+    python tests/bench_suite.py --baseline tests/bench_baseline.json --threshold 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from tests.load_test_ask import run_level, wait_until_up  # noqa: E402
+
+SENTENCES = [
+    "パスワードを再設定するには、ログイン画面の「パスワードを忘れた場合」を選択します。",
+    "経費精算は月末締めで、領収書の原本を経理部へ提出してください。",
+    "VPN に接続できない場合は、クライアントのバージョンを確認してください。",
+    "有給休暇の申請は勤怠システムから行い、上長の承認が必要です。",
+    "エラーコード E-1024 は認証トークンの有効期限切れを示します。",
+    "新入社員研修では、情報セキュリティ規程の読み合わせを行います。",
+    "出張の航空券は総務部の指定代理店で手配してください。",
+    "The API returns HTTP 429 when the rate limit is exceeded.",
+]
+QUERIES = [
+    "VPN に接続できないときはどうすればよいですか？",
+    "経費精算の締め日はいつですか？",
+    "E-1024 エラーの意味を教えてください",
+    "有給休暇の申請方法は？",
+]
+# 子プロセスの結果の行の目印
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def make_markdown(rng: np.random.Generator, i: int) -> str:
+    parts = [f"# 社内マニュアル {i}\n"]
+    for s in range(int(rng.integers(2, 8))):
+        parts.append(f"\n## 第{s + 1}章 手順\n\n")
+        parts.append("".join(SENTENCES[j] for j in rng.integers(len(SENTENCES), size=int(rng.integers(5, 40)))))
+        parts.append("\n")
+    return "".join(parts)
+
+
+def make_pdf(lines: list[str]) -> bytes:
+    """テキストを1行ずつ置いた1ページの PDF。
+
+    フォントは埋め込まず、文字コード = Unicode のコードポイントとする ToUnicode を付けるので、
+    表示は崩れるが pypdf での抽出結果は元のテキストになる。
+    """
+    text = " ".join(f"<{''.join(f'{ord(c):04X}' for c in line)}> Tj T*" for line in lines)
+    content = f"BT /F1 10 Tf 12 TL 40 800 Td {text} ET"
+    to_unicode = (
+        "/CIDInit /ProcSet findresource begin 12 dict begin begincmap /CMapName /Identity-UCS def "
+        "1 begincodespacerange <0000> <FFFF> endcodespacerange 1 beginbfrange <0000> <FFFF> <0000> endbfrange "
+        "endcmap CMapName currentdict /CMap defineresource pop end end"
+    )
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> "
+        "/Contents 4 0 R >>",
+        f"<< /Length {len(content.encode('ascii'))} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type0 /BaseFont /Bench /Encoding /Identity-H /DescendantFonts [6 0 R] "
+        "/ToUnicode 7 0 R >>",
+        "<< /Type /Font /Subtype /CIDFontType2 /BaseFont /Bench "
+        "/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /DW 1000 >>",
+        f"<< /Length {len(to_unicode)} >>\nstream\n{to_unicode}\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{obj}\nendobj\n".encode("ascii")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("ascii")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+    return bytes(out)
+
+
+def write_corpus(raw_dir: Path, n_docs: int, pdf_ratio: float, seed: int = 0) -> None:
+    """n_docs 件のうち pdf_ratio の割合を PDF、残りを Markdown で書く（seed が同じなら同じ内容）。"""
+    rng = np.random.default_rng(seed)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    n_pdf = int(round(n_docs * pdf_ratio))
+    for i in range(n_docs):
+        sub = raw_dir / f"dept{i % 10}"
+        sub.mkdir(exist_ok=True)
+        if i < n_pdf:
+            lines = [SENTENCES[j] for j in rng.integers(len(SENTENCES), size=int(rng.integers(20, 60)))]
+            (sub / f"form{i}.pdf").write_bytes(make_pdf(lines))
+        else:
+            (sub / f"manual{i}.md").write_text(make_markdown(rng, i), encoding="utf-8")
+
+
+def percentiles(seconds: list[float]) -> tuple[float, float]:
+    ms = np.array(seconds) * 1000
+    return float(np.percentile(ms, 50)), float(np.percentile(ms, 99))
+
+
+def measure_stages(n_queries: int, k: int) -> dict:
+    """子プロセスで実行する。環境変数（RAW_DATA_DIR など）で指定されたコーパスを測る。"""
+    from src.config import RAW_DATA_DIR
+    from src.ingestion.build_index import build_index
+    from src.ingestion.load_docs import iter_docs, list_doc_files
+    from src.ingestion.split_docs import split_document
+    from src.models.embedder import get_embeddings
+    from src.rag.index_factory import create_index, index_spec, prepare_vectors, resolve_params
+    from src.rag.retriever import Retriever
+
+    r = {}
+    files = list_doc_files(str(RAW_DATA_DIR))
+    mb = sum(f.stat().st_size for f in files) / 2**20
+
+    started = time.perf_counter()
+    docs = list(iter_docs(files))
+    seconds = time.perf_counter() - started
+    r["load_mb_per_s"] = mb / seconds
+    r["load_files_per_s"] = len(files) / seconds
+
+    # 分割は速く揺らぎが大きいので3回の最良値を取る
+    seconds = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        chunks = [c for d in docs for c in split_document(d["text"], d["path"])[0]]
+        seconds = min(seconds, time.perf_counter() - started)
+    r["split_chunks_per_s"] = len(chunks) / seconds
+
+    started = time.perf_counter()
+    embeddings = get_embeddings(chunks)
+    r["embed_chunks_per_s"] = len(chunks) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    params = resolve_params(index_spec(shards=1), len(embeddings), embeddings.shape[1])
+    vectors = prepare_vectors(embeddings, params)
+    index = create_index(params, vectors)
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype="int64"))
+    r["index_vectors_per_s"] = len(vectors) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    build_index(full=True)
+    seconds = time.perf_counter() - started
+    r["build_files_per_s"] = len(files) / seconds
+    r["build_chunks_per_s"] = len(chunks) / seconds
+
+    retriever = Retriever()
+    texts = [f"{QUERIES[i % len(QUERIES)]} ({i})" for i in range(n_queries)]
+    query_embeddings = get_embeddings(texts)
+    for mode in ("vector", "hybrid"):
+        # 1周目はページキャッシュ・mmap の読み込みを含むので捨てる
+        for text, q_emb in zip(texts, query_embeddings):
+            retriever.query(q_emb, k=k, query_text=text, mode=mode)
+        latencies = []
+        for text, q_emb in zip(texts, query_embeddings):
+            started = time.perf_counter()
+            retriever.query(q_emb, k=k, query_text=text, mode=mode)
+            latencies.append(time.perf_counter() - started)
+        r[f"retrieval_{mode}_p50_ms"], r[f"retrieval_{mode}_p99_ms"] = percentiles(latencies)
+
+    r["info"] = {"files": len(files), "mb": mb, "chunks": len(chunks), "index": params["type"]}
+    return r
+
+
+def measure_ask(env: dict, args) -> dict:
+    """コーパスのスナップショットで API サーバーを起動し、同時実行数ごとに /ask を測る。"""
+    r = {}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.api.main:app",
+         "--port", str(args.api_port), "--workers", "1", "--log-level", "warning"],
+        cwd=project_root, env=env,
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{args.api_port}/docs")
+        url = f"http://127.0.0.1:{args.api_port}/ask"
+        offset = 0
+        for c in args.concurrency:
+            level = asyncio.run(run_level(url, c, args.ask_requests, offset))
+            offset += args.ask_requests
+            r[f"ask_c{c}_req_per_s"] = level["rps"]
+            r[f"ask_c{c}_p50_ms"] = level["p50_ms"]
+            r[f"ask_c{c}_p99_ms"] = level["p99_ms"]
+            r[f"ask_c{c}_errors"] = level["errors"]
+    finally:
+        proc.terminate()
+        proc.wait()
+    return r
+
+
+def flatten(results: dict) -> dict:
+    """比較する指標だけを "<文書数>/<指標>" -> 値 にする。"""
+    return {
+        f"{size}/{name}": value
+        for size, metrics in results["corpora"].items()
+        for name, value in metrics.items()
+        if name.endswith(("_per_s", "_ms"))
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """指標ごとの変化を表示し、threshold を超えて悪化した指標の名前を返す。"""
+    if current["meta"]["settings"] != baseline["meta"].get("settings"):
+        print("warning: benchmark settings differ from the baseline; the comparison may not be meaningful")
+    now, base = flatten(current), flatten(baseline)
+    regressions = []
+    width = max((len(name) for name in now), default=10)
+    print(f"\n{'metric':<{width}} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, value in now.items():
+        if name not in base:
+            print(f"{name:<{width}} {'-':>10} {value:10.2f} {'new':>8}")
+            continue
+        ref = base[name]
+        change = (value - ref) / ref if ref else 0.0
+        # スループットは下がったら、レイテンシは上がったら悪化
+        worse = -change if name.endswith("_per_s") else change
+        status = ""
+        if worse > threshold:
+            status = "  REGRESSION"
+            regressions.append(name)
+        elif worse < -threshold:
+            status = "  improved"
+        print(f"{name:<{width}} {ref:10.2f} {value:10.2f} {change:+8.1%}{status}")
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=project_root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproducible performance benchmarks for ingest, retrieval and /ask")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 1000], help="コーパスの文書数")
+    parser.add_argument("--pdf-ratio", type=float, default=0.2, help="PDF にする文書の割合")
+    parser.add_argument("--queries", type=int, default=200, help="検索のレイテンシを測るクエリ数")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 16, 64], help="空なら /ask は測らない")
+    parser.add_argument("--ask-requests", type=int, default=256, help="同時実行数ごとの /ask のリクエスト数")
+    parser.add_argument("--embed-latency-ms", type=float, default=50)
+    parser.add_argument("--chat-latency-ms", type=float, default=200)
+    parser.add_argument("--token-ms", type=float, default=1)
+    parser.add_argument("--mock-port", type=int, default=8001)
+    parser.add_argument("--api-port", type=int, default=8000)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=str(project_root / "tests" / "bench_baseline.json"))
+    parser.add_argument("--threshold", type=float, default=0.2, help="回帰とみなす悪化の割合")
+    parser.add_argument("--save-baseline", action="store_true", help="結果を --baseline に保存する")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        import logging
+        logging.basicConfig(level=logging.WARNING)
+        print(RESULT_PREFIX + json.dumps(measure_stages(args.queries, args.k)))
+        return
+
+    settings = {
+        key: getattr(args, key)
+        for key in ("pdf_ratio", "queries", "k", "index_type", "concurrency", "ask_requests",
+                    "embed_latency_ms", "chat_latency_ms", "token_ms")
+    }
+    results = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": settings,
+        },
+        "corpora": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # ジッタと 429 を無くして、同じ設定なら同じ条件で測れるようにする
+        mock = subprocess.Popen(
+            [sys.executable, str(project_root / "tests" / "mock_openai_server.py"),
+             "--port", str(args.mock_port), "--jitter-ms", "0", "--rate-limit", "0",
+             "--latency-ms", str(args.embed_latency_ms),
+             "--chat-latency-ms", str(args.chat_latency_ms),
+             "--token-ms", str(args.token_ms)],
+        )
+        try:
+            wait_until_up(f"http://127.0.0.1:{args.mock_port}/docs")
+            for size in args.sizes:
+                corpus = Path(tmp) / str(size)
+                write_corpus(corpus / "raw", size, args.pdf_ratio)
+                env = {
+                    **os.environ,
+                    "OPENAI_BASE_URL": f"http://127.0.0.1:{args.mock_port}/v1",
+                    "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "dummy"),
+                    "RAW_DATA_DIR": str(corpus / "raw"),
+                    "VECTORSTORE_DIR": str(corpus / "vectorstore"),
+                    "INDEX_TYPE": args.index_type,
+                    "EMBED_CACHE_ENABLED": "0",
+                    "ANSWER_CACHE_ENABLED": "0",
+                    "RERANK_MODEL": "",
+                }
+                proc = subprocess.run(
+                    [sys.executable, __file__, "--worker", "--queries", str(args.queries), "--k", str(args.k)],
+                    cwd=project_root, env=env, capture_output=True, text=True,
+                )
+                lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+                if proc.returncode != 0 or not lines:
+                    sys.stderr.write(proc.stderr)
+                    raise SystemExit(f"Benchmark worker failed for {size} documents")
+                metrics = json.loads(lines[-1][len(RESULT_PREFIX):])
+                if args.concurrency:
+                    metrics.update(measure_ask(env, args))
+                results["corpora"][str(size)] = metrics
+
+                info = metrics["info"]
+                print(f"\n{size} docs ({info['mb']:.1f} MB, {info['chunks']} chunks, {info['index']})")
+                for name, value in metrics.items():
+                    if name != "info":
+                        print(f"  {name:<28} {value:10.2f}")
+        finally:
+            mock.terminate()
+            mock.wait()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    regressions = []
+    baseline_path = Path(args.baseline)
+    if baseline_path.exists() and not args.save_baseline:
+        with open(baseline_path, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        else:
+            print(f"\nNo regressions beyond {args.threshold:.0%}")
+    elif not args.save_baseline:
+        print(f"No baseline at {baseline_path}; run with --save-baseline to store one")
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
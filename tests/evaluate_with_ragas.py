@@ -19,10 +19,8 @@ from ragas import evaluate
 from ragas.metrics import faithfulness, answer_relevancy
 
 # 独自のRAG システムをインポート
-from src.rag.retriever import Retriever
-from src.rag.qa_chain import answer
-from src.models.embedder import get_embedding
-from src.config import OPENAI_API_KEY
+from src.rag.qa_chain import answer_many
+from src.config import OPENAI_API_KEY, BATCH_MAX_QUERIES
 
 
 def load_test_data(filepath: str) -> list:
@@ -31,34 +29,30 @@ def load_test_data(filepath: str) -> list:
         return json.load(f)
 
 
-def run_rag_system(question: str) -> dict:
+def run_rag_system(questions: list) -> list:
     """
     RAGシステムを実行して回答と検索コンテキストを取得
     
+    埋め込み・検索・回答生成は BATCH_MAX_QUERIES 件ずつまとめて実行する（answer_many）。
+    contexts には、回答の生成時に LLM に渡したのと同じ検索結果（sources）を使う
+    
     Args:
-        question: ユーザーの質問
+        questions: ユーザーの質問のリスト
         
     Returns:
-        answer: 生成された回答
-        contexts: 検索されたドキュメントのリスト
+        質問と同じ順序の {answer: 生成された回答, contexts: 検索されたドキュメントのリスト}
     """
-    # 1. クエリ埋め込みを取得
-    query_embedding = get_embedding(question)
-    
-    # 2. Retrieverで類似ドキュメントを検索
-    retriever = Retriever()
-    similar_docs = retriever.query(query_embedding, k=3)
-    
-    # 3. コンテキストを抽出
-    contexts = [doc['text'] for doc in similar_docs]
-    
-    # 4. qa_chainで回答を生成
-    answer_text, _ = answer(question)
-    
-    return {
-        "answer": answer_text,
-        "contexts": contexts
-    }
+    results = []
+    for start in range(0, len(questions), BATCH_MAX_QUERIES):
+        answers = answer_many(questions[start:start + BATCH_MAX_QUERIES])
+        for ans in answers:
+            if ans["error"] is not None:
+                print(f"  ⚠️ 回答生成に失敗しました: {ans['error']}")
+            results.append({
+                "answer": ans["answer"] or "",
+                "contexts": [doc['text'] for doc in ans["sources"]]
+            })
+    return results
 
 
 def prepare_ragas_dataset(test_cases: list) -> Dataset:
@@ -79,15 +73,13 @@ def prepare_ragas_dataset(test_cases: list) -> Dataset:
     }
     
     print("RAGシステムを実行中...")
-    for i, case in enumerate(test_cases, 1):
+    results = run_rag_system([case["question"] for case in test_cases])
+    for i, (case, result) in enumerate(zip(test_cases, results), 1):
         question = case["question"]
         ground_truth = case["ground_truth"]
         
         print(f"\n[{i}/{len(test_cases)}] 質問: {question}")
         
-        # RAGシステムを実行
-        result = run_rag_system(question)
-        
         # データを追加
         data["question"].append(question)
         data["answer"].append(result["answer"])
@@ -0,0 +1,156 @@
+"""
+/ask の同時実行性能を測る負荷試験スクリプト
+
+モック OpenAI サーバーと API サーバー（uvicorn 1ワーカー）を起動し、
+小さなコーパスでインデックスを作ったうえで、同時実行数を変えながら /ask を叩く。
+同時実行数に比例してスループットが伸びれば、イベントループがブロックされていないことを示す。
+
+使用方法:
+    python tests/load_test_ask.py --concurrency 1 16 64 256 --requests 512
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+SAMPLE_SENTENCES = [
+    "パスワードを再設定するには、ログイン画面の「パスワードを忘れた場合」を選択します。",
+    "経費精算は月末締めで、領収書の原本を経理部へ提出してください。",
+    "VPN に接続できない場合は、クライアントのバージョンを確認してください。",
+    "有給休暇の申請は勤怠システムから行い、上長の承認が必要です。",
+    "エラーコード E-1024 は認証トークンの有効期限切れを示します。",
+]
+
+
+def write_corpus(raw_dir: Path, n_docs: int) -> None:
+    rng = np.random.default_rng(0)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(n_docs):
+        body = "".join(SAMPLE_SENTENCES[j] for j in rng.integers(0, len(SAMPLE_SENTENCES), size=40))
+        (raw_dir / f"manual{i}.md").write_text(f"# マニュアル{i}\n\n{body}", encoding="utf-8")
+
+
+def wait_until_up(url: str, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start: {url}")
+
+
+async def run_level(url: str, concurrency: int, n_requests: int, offset: int) -> dict:
+    latencies = []
+    errors = 0
+    counter = iter(range(n_requests))
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        for i in counter:
+            # 質問文を毎回変えて埋め込みキャッシュに当たらないようにする
+            query = f"質問{offset + i}: VPN に接続できない場合はどうすればよいですか？"
+            started = time.perf_counter()
+            try:
+                resp = await client.post(url, json={"query": query})
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    lat = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p99_ms": float(np.percentile(lat, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for /ask against a mock OpenAI server")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64, 256])
+    parser.add_argument("--requests", type=int, default=512, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--embed-latency-ms", type=float, default=100)
+    parser.add_argument("--chat-latency-ms", type=float, default=400)
+    parser.add_argument("--token-ms", type=float, default=2, help="モックの1トークンあたりの生成時間")
+    parser.add_argument("--mock-port", type=int, default=8001)
+    parser.add_argument("--api-port", type=int, default=8000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_corpus(tmp / "raw", args.docs)
+        env = {
+            **os.environ,
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{args.mock_port}/v1",
+            "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "dummy"),
+            "RAW_DATA_DIR": str(tmp / "raw"),
+            "VECTORSTORE_DIR": str(tmp / "vectorstore"),
+            "EMBED_CACHE_ENABLED": "0",
+        }
+
+        procs = []
+        try:
+            procs.append(subprocess.Popen(
+                [sys.executable, str(project_root / "tests" / "mock_openai_server.py"),
+                 "--port", str(args.mock_port),
+                 "--latency-ms", str(args.embed_latency_ms),
+                 "--chat-latency-ms", str(args.chat_latency_ms),
+                 "--token-ms", str(args.token_ms)],
+            ))
+            wait_until_up(f"http://127.0.0.1:{args.mock_port}/docs")
+
+            subprocess.run(
+                [sys.executable, "-m", "src.ingestion.build_index"],
+                cwd=project_root, env=env, check=True, capture_output=True,
+            )
+
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "src.api.main:app",
+                 "--port", str(args.api_port), "--workers", "1", "--log-level", "warning"],
+                cwd=project_root, env=env,
+            ))
+            wait_until_up(f"http://127.0.0.1:{args.api_port}/docs")
+
+            url = f"http://127.0.0.1:{args.api_port}/ask"
+            print(f"mock latency: embed={args.embed_latency_ms}ms chat={args.chat_latency_ms}ms, 1 API worker")
+            print(f"{'concurrency':>11} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'gain':>6}")
+            base_rps = None
+            offset = 0
+            for c in args.concurrency:
+                r = asyncio.run(run_level(url, c, args.requests, offset))
+                offset += args.requests
+                base_rps = base_rps or r["rps"]
+                print(f"{c:>11} {r['requests']:>8} {r['errors']:>6} {r['rps']:8.1f} "
+                      f"{r['p50_ms']:8.0f} {r['p99_ms']:8.0f} {r['rps'] / base_rps:5.1f}x")
+        finally:
+            for p in reversed(procs):
+                p.terminate()
+                p.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+ベンチマーク用のモック OpenAI サーバー
+
+Embeddings / Chat Completions API を最小限の互換レスポンスで返す。
+埋め込みは文字バイグラムのハッシュから作るため、似た文章ほど近いベクトルになる。
+
+使用方法:
+    python tests/mock_openai_server.py --port 8001 --latency-ms 200 --rate-limit 0.05
+
+    # 別ターミナルで
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy python -m src.ingestion.build_index
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+import zlib
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="mock-openai")
+
+# 起動オプション（main() で上書きされる）
+SETTINGS = {
+    "dim": 1536,
+    "latency_ms": 100.0,
+    "per_item_ms": 0.5,
+    "jitter_ms": 20.0,
+    "rate_limit": 0.0,
+    "chat_latency_ms": 500.0,
+    "token_ms": 20.0,
+    "completion_tokens": 200,
+}
+
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    """文字バイグラムを符号付きハッシュでdim次元に射影し、L2正規化したベクトルを返す。"""
+    vec = np.zeros(dim, dtype="float32")
+    for i in range(max(1, len(text) - 1)):
+        h = zlib.crc32(text[i:i + 2].encode("utf-8"))
+        vec[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+async def _simulate_latency(base_ms: float, n_items: int = 0) -> None:
+    ms = base_ms + SETTINGS["per_item_ms"] * n_items + random.uniform(0, SETTINGS["jitter_ms"])
+    await asyncio.sleep(ms / 1000)
+
+
+def _rate_limited() -> JSONResponse | None:
+    if SETTINGS["rate_limit"] > 0 and random.random() < SETTINGS["rate_limit"]:
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": "0.2"},
+            content={"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+        )
+    return None
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    limited = _rate_limited()
+    if limited is not None:
+        return limited
+    await _simulate_latency(SETTINGS["latency_ms"], len(inputs))
+
+    dim = body.get("dimensions") or SETTINGS["dim"]
+    use_base64 = body.get("encoding_format") == "base64"
+    data = []
+    tokens = 0
+    for i, text in enumerate(inputs):
+        vec = fake_embedding(text, dim)
+        tokens += len(text)
+        data.append(
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(vec.tobytes()).decode() if use_base64 else vec.tolist(),
+            }
+        )
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "mock-embedding"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+
+    limited = _rate_limited()
+    if limited is not None:
+        return limited
+    await _simulate_latency(SETTINGS["chat_latency_ms"])
+
+    prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []))
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+    head = f"これはモックの回答です（prompt={digest}）。"
+    content = head + "詳" * max(0, SETTINGS["completion_tokens"] - len(head))
+    prompt_tokens = len(prompt)
+    completion_tokens = len(content)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if body.get("stream"):
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        return StreamingResponse(
+            _stream_chunks(digest, body.get("model", "mock-llm"), content, usage if include_usage else None),
+            media_type="text/event-stream",
+        )
+    # 非ストリーミングでは全トークンの生成を待ってから返す
+    await asyncio.sleep(SETTINGS["token_ms"] * len(content) / 1000)
+    return {
+        "id": f"chatcmpl-mock-{digest}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock-llm"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": usage,
+    }
+
+
+async def _stream_chunks(digest: str, model: str, content: str, usage: dict | None):
+    """1文字を1トークンとみなし、token_ms 間隔で delta を送る。"""
+    base = {"id": f"chatcmpl-mock-{digest}", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": model}
+    first = {**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}
+    yield f"data: {json.dumps(first)}\n\n"
+    for ch in content:
+        await asyncio.sleep(SETTINGS["token_ms"] / 1000)
+        chunk = {**base, "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    last = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(last)}\n\n"
+    if usage is not None:
+        yield f"data: {json.dumps({**base, 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--dim", type=int, default=SETTINGS["dim"])
+    parser.add_argument("--latency-ms", type=float, default=SETTINGS["latency_ms"], help="embeddings の基本遅延")
+    parser.add_argument("--per-item-ms", type=float, default=SETTINGS["per_item_ms"], help="入力1件あたりの追加遅延")
+    parser.add_argument("--jitter-ms", type=float, default=SETTINGS["jitter_ms"])
+    parser.add_argument("--rate-limit", type=float, default=SETTINGS["rate_limit"], help="429 を返す確率 (0-1)")
+    parser.add_argument("--chat-latency-ms", type=float, default=SETTINGS["chat_latency_ms"],
+                        help="chat の最初のトークンまでの遅延")
+    parser.add_argument("--token-ms", type=float, default=SETTINGS["token_ms"], help="ストリーミング時のトークン間隔")
+    parser.add_argument("--completion-tokens", type=int, default=SETTINGS["completion_tokens"])
+    args = parser.parse_args()
+
+    SETTINGS.update(
+        dim=args.dim,
+        latency_ms=args.latency_ms,
+        per_item_ms=args.per_item_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        chat_latency_ms=args.chat_latency_ms,
+        token_ms=args.token_ms,
+        completion_tokens=args.completion_tokens,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+ANN インデックスの recall / レイテンシ / サイズを比較するチューニングスクリプト
+
+flat（厳密検索）の結果を正解として、IVF-Flat / IVF-PQ / HNSW の
+nprobe・efSearch を振ったときの recall@k、1クエリあたりの p50/p99 レイテンシ、
+インデックスサイズを表示する。結果を見て INDEX_TYPE / IVF_NPROBE / HNSW_EF_SEARCH を決める。
+
+使用方法:
+    # 合成データ（クラスタ構造を持つ正規乱数）で試す
+    python tests/tune_ann_index.py --synthetic 200000 --dim 1536
+
+    # 公開中のスナップショットのチャンク本文を埋め込み直して使う（埋め込みキャッシュが効く）
+    python tests/tune_ann_index.py --vectorstore
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from src.config import HNSW_EF_CONSTRUCTION, HNSW_M, IVF_NLIST, PQ_M  # noqa: E402
+from src.rag.index_factory import (  # noqa: E402
+    create_index,
+    faiss,
+    prepare_vectors,
+    resolve_params,
+    search_parameters,
+)
+
+
+def synthetic_vectors(n: int, dim: int, n_queries: int, seed: int = 0):
+    """埋め込みに近い、クラスタ構造を持つベクトルを生成する。"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n // 500)
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    assign = rng.integers(0, n_clusters, size=n + n_queries)
+    x = centers[assign] + 0.6 * rng.standard_normal((n + n_queries, dim)).astype("float32")
+    return x[:n], x[n:]
+
+
+def vectorstore_vectors(n_queries: int, seed: int = 0):
+    from src.models.embedder import get_embeddings
+    from src.rag.chunk_store import ChunkStore
+    from src.rag.snapshots import current_snapshot
+
+    store = ChunkStore(current_snapshot() / "chunks")
+    texts = [store.text(row) for row in range(len(store))]
+    base = get_embeddings(texts)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(base), size=min(n_queries, len(base)), replace=False)
+    queries = base[picks] + 0.01 * rng.standard_normal((len(picks), base.shape[1])).astype("float32")
+    return base, queries
+
+
+def sweep_values(params: dict) -> list:
+    if params["type"].startswith("ivf"):
+        return [v for v in (1, 2, 4, 8, 16, 32, 64, 128, 256) if v <= params["nlist"]]
+    if params["type"] == "hnsw":
+        return [16, 32, 64, 128, 256]
+    return [None]
+
+
+def evaluate(index, params, queries, truth, k, value) -> dict:
+    sp = search_parameters(
+        params,
+        nprobe=value if params["type"].startswith("ivf") else None,
+        ef_search=value if params["type"] == "hnsw" else None,
+    )
+    latencies = []
+    hits = 0
+    for i in range(len(queries)):
+        started = time.perf_counter()
+        _, ids = index.search(queries[i:i + 1], k, params=sp)
+        latencies.append(time.perf_counter() - started)
+        hits += len(set(ids[0].tolist()) & set(truth[i].tolist()))
+    lat = np.array(latencies) * 1000
+    return {
+        "recall": hits / (len(queries) * k),
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p99_ms": float(np.percentile(lat, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep ANN index parameters against exact search")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--synthetic", type=int, metavar="N", help="合成ベクトルの件数")
+    src.add_argument("--vectorstore", action="store_true", help="現在のチャンクストアを使う")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--types", nargs="+", default=["flat", "ivf_flat", "ivf_pq", "hnsw"])
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST, help="0 なら件数から自動決定")
+    parser.add_argument("--pq-m", type=int, default=PQ_M)
+    parser.add_argument("--hnsw-m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--json", type=Path, help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        base, queries = synthetic_vectors(args.synthetic, args.dim, args.queries)
+    else:
+        base, queries = vectorstore_vectors(args.queries)
+    n, dim = base.shape
+    ids = np.arange(n, dtype="int64")
+    print(f"base={n} queries={len(queries)} dim={dim} k={args.k}")
+
+    # 正解は正規化ベクトルの厳密な内積検索
+    exact_params = resolve_params({"type": "flat"}, n, dim)
+    base = prepare_vectors(base, exact_params)
+    queries = prepare_vectors(queries, exact_params)
+    exact = create_index(exact_params, base)
+    exact.add_with_ids(base, ids)
+    _, truth = exact.search(queries, args.k)
+
+    results = []
+    print(f"{'type':<9} {'knob':>10} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'size MB':>9} {'build s':>8}")
+    for index_type in args.types:
+        spec = {"type": index_type}
+        if index_type.startswith("ivf"):
+            spec["nlist"] = args.nlist
+        if index_type == "ivf_pq":
+            spec["pq_m"] = args.pq_m
+        if index_type == "hnsw":
+            spec.update(hnsw_m=args.hnsw_m, ef_construction=args.ef_construction)
+        params = resolve_params(spec, n, dim)
+        if params["type"] != index_type:
+            # 件数が少なすぎて resolve_params が別の種類に切り替えた（ivf_pq -> ivf_flat）
+            print(f"{index_type:<9} skipped: too few vectors ({n}) for {index_type}")
+            continue
+
+        started = time.perf_counter()
+        index = create_index(params, base)
+        index.add_with_ids(base, ids)
+        build_s = time.perf_counter() - started
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+
+        for value in sweep_values(params):
+            r = evaluate(index, params, queries, truth, args.k, value)
+            knob = "-" if value is None else (f"nprobe={value}" if index_type.startswith("ivf") else f"ef={value}")
+            print(f"{index_type:<9} {knob:>10} {r['recall']:9.3f} {r['p50_ms']:8.3f} {r['p99_ms']:8.3f} "
+                  f"{size_mb:9.1f} {build_s:8.1f}")
+            results.append({"type": index_type, "params": params, "knob": value, "size_mb": size_mb,
+                            "build_s": build_s, **r})
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Saved results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()